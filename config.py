@@ -22,6 +22,67 @@ class Settings(BaseSettings):
     XRAY_PORT: int = 8081
     XRAY_SECURITY: str = "none"
 
+    # کش QR (تعداد لینک‌هایی که PNG و file_id آن‌ها در حافظه نگه داشته می‌شود)
+    QR_CACHE_SIZE: int = 512
+    QR_RENDER_WORKERS: int = 2
+
+    # حالت اجرا: polling | webhook
+    RUN_MODE: str = "polling"
+    WEBHOOK_BASE_URL: str = ""           # مثل https://vira-vpn.liara.run
+    WEBHOOK_PATH: str = "/tg/webhook"
+    WEBHOOK_SECRET: str = ""             # X-Telegram-Bot-Api-Secret-Token؛ در حالت webhook اجباری (A-Z a-z 0-9 _ -)
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 80               # liara.json روی پورت 80 دیپلوی می‌کند
+    WEBHOOK_MAX_INFLIGHT: int = 64       # max_connections تلگرام؛ سقف اجرای هم‌زمان UPDATE_CONCURRENCY است
+    WEBHOOK_DRAIN_SEC: int = 25          # مهلت تخلیهٔ آپدیت‌های در جریان هنگام SIGTERM
+    WEBHOOK_CLAIM_STALE_SEC: int = 120   # ادعای processing بدون heartbeat (رپلیکای مرده) بعد از این مدت پس گرفته می‌شود
+
+    # ذخیره‌سازی FSM: memory | mongo | redis
+    FSM_STORAGE: str = "mongo"
+    REDIS_URL: str = "redis://localhost:6379/0"   # فقط برای FSM_STORAGE=redis (نیاز به پکیج redis)
+    FSM_STATE_TTL_SEC: int = 24 * 3600            # استیت‌های رهاشده بعد از این مدت پاک می‌شوند
+    FSM_CACHE_ENABLED: bool = True                # کش mongo (state/data از حافظه وقتی rev سند عوض نشده)
+
+    # سقف سراسری آپدیت‌های هم‌زمان (آپدیت‌های یک چت همیشه ترتیبی‌اند)
+    UPDATE_CONCURRENCY: int = 32
+
+    # لینک اشتراک HTTP (باندل base64 برای آپدیت خودکار کلاینت‌ها)
+    SUB_HTTP_ENABLED: bool = False
+    SUB_BASE_URL: str = ""               # آدرس عمومی، مثل https://sub.example.com
+    SUB_HTTP_HOST: str = "0.0.0.0"
+    SUB_HTTP_PORT: int = 8080            # در حالت webhook روی همان سرور وبهوک سرو می‌شود
+    SUB_CACHE_TTL_SEC: int = 60          # max-age کلاینت + عمر کش توکن‌های ناشناخته (404)
+    SUB_REVALIDATE_SEC: int = 300        # باندل کش‌شده بعد از این مدت فقط با خواندن version چک می‌شود
+
+    # محدودیت دستگاه از روی access log ایکس‌ری (خالی = خاموش)
+    XRAY_ACCESS_LOG: str = ""            # مثل /var/log/xray/access.log
+    DEVICE_WINDOW_SEC: int = 600         # پنجرهٔ زمانی شمارش IPهای متمایز
+    DEVICE_IP_TOLERANCE: int = 1         # IP اضافه مجاز (جابه‌جایی وای‌فای/دیتا)
+    DEVICE_LIMIT_ACTION: str = "flag"    # flag | suspend
+
+    # فشرده‌سازی لیست کلاینت‌های فایل کانفیگ Xray
+    XRAY_COMPACT_HOUR: int = 4           # ساعت خلوت (وقت تهران)
+    XRAY_COMPACT_STALE_RATIO: float = 0.3  # یا هر وقت سهم کلاینت‌های بی‌اشتراک از این بیشتر شد
+
+    # اجرای عملیات Xray: executor اختصاصی + timeout + circuit breaker
+    XRAY_WORKERS: int = 4
+    XRAY_OP_TIMEOUT: float = 30.0        # سقف کل یک عملیات (مثلاً add_client = نوشتن + reload)
+    XRAY_BREAKER_THRESHOLD: int = 5      # چند خطای پشت‌سرهم تا باز شدن مدار
+    XRAY_BREAKER_RESET_SEC: float = 30.0 # بعد از این مدت یک درخواست آزمایشی رد می‌شود
+    XRAY_CRITICAL_MAX_WAIT: float = 120.0  # کارهای حیاتی تا این مدت در صف می‌مانند
+
+    # پاک‌سازی سفارش/پرداخت‌های رهاشده و آرشیو
+    ORDER_PENDING_TTL_HOURS: int = 48    # سفارش pending بدون رسید بعد از این مدت expired می‌شود
+    PAYMENT_GRACE_MIN: int = 30          # مهلت بعد از due_at قبل از expired شدن pending_proof
+    ARCHIVE_AFTER_DAYS: int = 30         # اسناد پایانی قدیمی‌تر از این به *_archive منتقل می‌شوند
+    ARCHIVE_BATCH: int = 500
+
+    # خروجی حسابداری (/export و python -m services.export)
+    EXPORT_BATCH_SIZE: int = 1000        # اندازهٔ batch کرسر = اندازهٔ هر نوشتن در فایل
+
+    # «مصرف لحظه‌ای» در اشتراک‌های من
+    LIVE_USAGE_TTL_SEC: float = 10.0     # نتیجهٔ کوئری Xray هر اشتراک این مدت کش می‌شود
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
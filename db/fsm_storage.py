@@ -0,0 +1,139 @@
+# db/fsm_storage.py
+import copy
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import settings
+from db.mongo import fsm_states_col
+
+def _key_id(key: StorageKey) -> str:
+    parts = [
+        key.bot_id,
+        key.chat_id,
+        key.user_id,
+        key.thread_id or 0,
+        getattr(key, "business_connection_id", None) or "",
+        key.destiny,
+    ]
+    return ":".join(str(p) for p in parts)
+
+
+def _state_str(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+
+class MongoStorage(BaseStorage):
+    """
+    استیت FSM در کالکشن fsm_states (یک سند برای هر chat/user).
+    ایندکس TTL روی updated_at استیت‌های رهاشده را پاک می‌کند.
+    هر نوشتن rev را $inc می‌کند تا کش رپلیکاها بفهمند سند عوض شده است.
+    """
+
+    def __init__(self, col=fsm_states_col):
+        self._col = col
+
+    async def _write(self, key: StorageKey, field: str, value: Any) -> None:
+        await self._col.update_one(
+            {"_id": _key_id(key)},
+            {"$set": {field: value, "updated_at": datetime.utcnow()}, "$inc": {"rev": 1}},
+            upsert=True,
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, "state", _state_str(state))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        doc = await self._col.find_one({"_id": _key_id(key)}, {"state": 1})
+        return doc.get("state") if doc else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(key, "data", dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        doc = await self._col.find_one({"_id": _key_id(key)}, {"data": 1})
+        return dict(doc.get("data") or {}) if doc else {}
+
+    async def get_rev(self, key: StorageKey) -> int:
+        """فقط شمارهٔ نسخه؛ سند نبود (یا قدیمی بدون rev) → 0."""
+        doc = await self._col.find_one({"_id": _key_id(key)}, {"rev": 1})
+        return int((doc or {}).get("rev") or 0)
+
+    async def get_record(self, key: StorageKey) -> tuple[int, str | None, dict[str, Any]]:
+        """(rev, state, data) با یک خواندن."""
+        doc = await self._col.find_one({"_id": _key_id(key)}, {"rev": 1, "state": 1, "data": 1}) or {}
+        return int(doc.get("rev") or 0), doc.get("state"), dict(doc.get("data") or {})
+
+    async def close(self) -> None:
+        pass
+
+
+class CachedStorage(BaseStorage):
+    """
+    کش read-through جلوی MongoStorage.
+    هر خواندن فقط rev سند را می‌خواند (سند کوچک، بدون data)؛ اگر با rev کش‌شده یکی بود
+    state/data از حافظه می‌آیند، وگرنه کل رکورد یک‌جا دوباره خوانده می‌شود.
+    نوشتن رپلیکای دیگر rev را بالا می‌برد، پس کش هیچ‌وقت استیت کهنه برنمی‌گرداند.
+    """
+
+    MAX_ENTRIES = 10_000
+
+    def __init__(self, inner: MongoStorage):
+        self._inner = inner
+        # key_id -> (rev, state, data)
+        self._cache: "OrderedDict[str, tuple[int, str | None, dict[str, Any]]]" = OrderedDict()
+
+    async def _fresh(self, key: StorageKey) -> tuple[int, str | None, dict[str, Any]]:
+        kid = _key_id(key)
+        rev = await self._inner.get_rev(key)
+        entry = self._cache.get(kid)
+        if entry is None or entry[0] != rev:
+            entry = await self._inner.get_record(key)
+            self._cache[kid] = entry
+        self._cache.move_to_end(kid)
+        while len(self._cache) > self.MAX_ENTRIES:
+            self._cache.popitem(last=False)
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._inner.set_state(key, state)
+        # rev جدید را نمی‌دانیم؛ خواندن بعدی دوباره پر می‌کند
+        self._cache.pop(_key_id(key), None)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._fresh(key))[1]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._inner.set_data(key, data)
+        self._cache.pop(_key_id(key), None)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        # کپی عمیق تا تغییر مقادیر تودرتو در هندلر کش را خراب نکند
+        return copy.deepcopy((await self._fresh(key))[2])
+
+    async def close(self) -> None:
+        self._cache.clear()
+        await self._inner.close()
+
+
+def build_fsm_storage() -> BaseStorage:
+    """storage مربوط به FSM_STORAGE را (در صورت نیاز با کش) می‌سازد."""
+    kind = (settings.FSM_STORAGE or "memory").lower()
+    if kind == "memory":
+        return MemoryStorage()
+
+    if kind == "mongo":
+        storage = MongoStorage()
+        # کش فقط با rev معتبر است؛ Redis خودش ارزان است و کش نمی‌گیرد
+        return CachedStorage(storage) if settings.FSM_CACHE_ENABLED else storage
+    if kind == "redis":
+        # پکیج redis فقط در این حالت لازم است
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        ttl = int(settings.FSM_STATE_TTL_SEC)
+        return RedisStorage.from_url(settings.REDIS_URL, state_ttl=ttl, data_ttl=ttl)
+    raise ValueError(f"unknown FSM_STORAGE: {settings.FSM_STORAGE}")
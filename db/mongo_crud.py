@@ -1,14 +1,19 @@
 # db/mongo_crud.py
+import secrets
 from datetime import datetime, timedelta
 from bson import ObjectId
 from bson.int64 import Int64  # ✅ درست
 from typing import Any, Literal, TypedDict
 
-from db.mongo import users_col, plans_col, orders_col, subscriptions_col, admins_col, payments_col
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from db.mongo import users_col, plans_col, orders_col, subscriptions_col, admins_col, payments_col, trial_claims_col
 
 # ---- Users
 async def get_or_create_user(tg_id: int, username: str | None, first_name: str | None):
-    u = await users_col.find_one({"tg_id": {"$in": [tg_id, Int64(tg_id)]}})
+    # int32 و int64 در مقایسهٔ Mongo برابرند؛ یک برابری ساده = یک bound روی ایندکس tg_id
+    u = await users_col.find_one({"tg_id": Int64(tg_id)})
     if u:
         await users_col.update_one(
             {"_id": u["_id"]},
@@ -53,21 +58,38 @@ async def get_plan_by_code(code: str):
     return await plans_col.find_one({"code": code, "active": True})
 
 # ---- Orders
-async def create_order(user_id: ObjectId, plan_code: str, amount_toman: int, metadata: dict | None = None):
-    doc = {
-        "user_id": user_id,
-        "plan_code": plan_code,
+async def get_or_create_open_order(
+    user_id: ObjectId,
+    plan_code: str,
+    amount_toman: int,
+    metadata: dict | None = None,
+    renew_sub_id: ObjectId | None = None,
+):
+    """
+    یک سفارش pending به ازای کاربر + پلن؛ کلیک‌های تکراری همان را برمی‌گردانند
+    تا وقتی paid/canceled/expired شود (ایندکس یکتای partial روی status=pending).
+    سفارشی که درخواست پرداخت گرفته (has_payment) دیگر برگردانده نمی‌شود؛ کلیک بعد از
+    ارسال رسید سفارش تازه می‌سازد تا یک سفارش دو پرداخت نگیرد.
+    renew_sub_id: اگر ست باشد، بعد از پرداخت همان اشتراک تمدید می‌شود. جزو کلید است: خرید و تمدید
+    همان پلن دو سفارش باز جدا هستند و معنای سفارش موجود هیچ‌وقت عوض نمی‌شود.
+    """
+    filt = {"user_id": user_id, "plan_code": plan_code, "renew_sub_id": renew_sub_id,
+            "status": "pending", "has_payment": False}
+    update = {"$setOnInsert": {
         "amount_toman": amount_toman,
-        "status": "pending",
         "provider": None,
         "provider_ref": None,
         "metadata": metadata or {},
         "created_at": datetime.utcnow(),
         "paid_at": None,
-    }
-    res = await orders_col.insert_one(doc)
-    doc["_id"] = res.inserted_id
-    return doc
+    }}
+    try:
+        return await orders_col.find_one_and_update(
+            filt, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # دو upsert هم‌زمان: دیگری درج کرده، همان را بخوان
+        return await orders_col.find_one(filt)
 
 # ✅ امن‌تر: اطمینان از ObjectId بودن
 async def mark_order_paid(order_id: ObjectId | str, provider: str, provider_ref: str):
@@ -101,6 +123,55 @@ async def create_subscription_from_plan(user_id: ObjectId, order_id: ObjectId, p
     doc["_id"] = res.inserted_id
     return doc
 
+def new_sub_token() -> str:
+    """توکن غیرقابل‌حدس برای لینک اشتراک HTTP."""
+    return secrets.token_urlsafe(18)
+
+async def ensure_sub_token(sub_id: ObjectId | str) -> str | None:
+    """توکن اشتراک را برمی‌گرداند؛ اگر اشتراک قدیمی توکن نداشت، یکی می‌سازد."""
+    sub_id = _to_object_id(sub_id)
+    await subscriptions_col.update_one(
+        {"_id": sub_id, "sub_token": {"$exists": False}},
+        {"$set": {"sub_token": new_sub_token()}, "$inc": {"version": 1}}
+    )
+    doc = await subscriptions_col.find_one({"_id": sub_id}, {"sub_token": 1})
+    return doc.get("sub_token") if doc else None
+
+# ---- Trial claims
+# یک سند به ازای هر کاربر (_id = users._id): رکورد استحقاق تست.
+# status: provisioning → issued | failed
+async def claim_trial(user_id: ObjectId, sub_id: ObjectId, stale_after_sec: int = 300) -> tuple[bool, dict]:
+    """
+    ادعای اتمیک تست. خروجی: (برنده؟، سند claim).
+    برنده فقط یکی است؛ claim شکست‌خورده یا provisioning گیرکرده (کرش وسط کار) دوباره قابل ادعاست
+    و sub_id قبلی حفظ می‌شود تا ایمیل‌های Xray همان بمانند (add_client idempotent است).
+    """
+    now = datetime.utcnow()
+    doc = {"_id": user_id, "sub_id": sub_id, "status": "provisioning", "claimed_at": now}
+    try:
+        await trial_claims_col.insert_one(doc)
+        return True, doc
+    except DuplicateKeyError:
+        pass
+
+    retried = await trial_claims_col.find_one_and_update(
+        {"_id": user_id, "$or": [
+            {"status": "failed"},
+            {"status": "provisioning", "claimed_at": {"$lt": now - timedelta(seconds=stale_after_sec)}},
+        ]},
+        {"$set": {"status": "provisioning", "claimed_at": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if retried:
+        return True, retried
+    return False, await trial_claims_col.find_one({"_id": user_id}) or doc
+
+async def finish_trial_claim(user_id: ObjectId, status: Literal["issued", "failed"], sub_id: ObjectId | None = None):
+    update: dict[str, Any] = {"status": status, "finished_at": datetime.utcnow()}
+    if sub_id is not None:
+        update["sub_id"] = sub_id
+    await trial_claims_col.update_one({"_id": user_id}, {"$set": update})
+
 # ---- Admins
 async def add_admin(uid: int, username: str | None = None, added_by: int | None = None) -> bool:
     if await admins_col.find_one({"uid": uid}):
@@ -144,7 +215,7 @@ async def get_user_by_id(user_id: ObjectId | str) -> dict | None:
     return await users_col.find_one({"_id": _to_object_id(user_id)})
 
 async def get_user_by_tg_id(tg_id: int) -> dict | None:
-    return await users_col.find_one({"tg_id": {"$in": [tg_id, Int64(tg_id)]}})
+    return await users_col.find_one({"tg_id": Int64(tg_id)})
 
 # ========= Payments =========
 class Proof(TypedDict, total=False):
@@ -161,7 +232,10 @@ async def create_payment_request(
     meta: dict | None = None,
 ) -> dict:
     order_id = _to_object_id(order_id)
-    order = await get_order(order_id)
+    # اول سفارش از «سفارش باز قابل‌استفادهٔ مجدد» بیرون می‌رود، بعد پرداخت ساخته می‌شود
+    order = await orders_col.find_one_and_update(
+        {"_id": order_id}, {"$set": {"has_payment": True}}, return_document=ReturnDocument.AFTER
+    )
     if not order:
         raise ValueError("order not found")
 
@@ -239,9 +313,19 @@ async def approve_c2c_payment_and_mark_order_paid(payment_id: ObjectId | str, re
         return False
     order_id = payment["order_id"]
 
-    ok1 = await update_payment_status(payment_id, "approved", reviewer_uid=reviewer_uid, provider_ref=str(payment["_id"]))
-    await mark_order_paid(order_id, provider="c2c", provider_ref=str(payment["_id"]))
-    return ok1
+    # فقط گذار pending → paid؛ تایید پرداخت دوم همان سفارش نباید سرویس را دوباره صادر کند
+    res = await orders_col.update_one(
+        {"_id": order_id, "status": "pending"},
+        {"$set": {
+            "status": "paid",
+            "provider": "c2c",
+            "provider_ref": str(payment["_id"]),
+            "paid_at": datetime.utcnow()
+        }}
+    )
+    if not res.modified_count:
+        return False
+    return await update_payment_status(payment_id, "approved", reviewer_uid=reviewer_uid, provider_ref=str(payment["_id"]))
 
 async def reject_c2c_payment(payment_id: ObjectId | str, reviewer_uid: int | None = None, reason: str | None = None) -> bool:
     return await update_payment_status(payment_id, "rejected", reviewer_uid=reviewer_uid, reason=reason)
@@ -260,3 +344,38 @@ async def list_payments(status: Literal["pending_proof", "submitted", "approved"
         filt["status"] = status
     cursor = payments_col.find(filt).sort([("created_at", -1)]).limit(limit)
     return [doc async for doc in cursor]
+
+async def count_payments(status: Literal["pending_proof", "submitted", "approved", "rejected", "expired"]) -> int:
+    # فقط شمارش کلیدهای ایندکس (status, created_at, _id)
+    return await payments_col.count_documents({"status": status})
+
+async def list_payments_page(
+    status: Literal["pending_proof", "submitted", "approved", "rejected", "expired"],
+    after: tuple[datetime, ObjectId] | None = None,
+    before: tuple[datetime, ObjectId] | None = None,
+    limit: int = 5,
+) -> tuple[list[dict], bool]:
+    """
+    صفحه‌بندی keyset روی (status, created_at, _id)، قدیمی‌ترین اول (صف بررسی).
+    after: صفحهٔ بعد از این کلید؛ before: صفحهٔ قبل از این کلید. هزینهٔ هر صفحه مستقل از عمق است.
+    خروجی: (اسناد، آیا در همان جهت صفحهٔ دیگری هست)
+    """
+    # status داخل هر شاخهٔ $or تکرار می‌شود تا هر شاخه یک IXSCAN با bound کامل باشد (SORT_MERGE، نه SORT)
+    filt: dict[str, Any] = {"status": status}
+    direction = 1
+    if after:
+        c, i = after
+        filt = {"$or": [{"status": status, "created_at": {"$gt": c}},
+                        {"status": status, "created_at": c, "_id": {"$gt": i}}]}
+    elif before:
+        c, i = before
+        filt = {"$or": [{"status": status, "created_at": {"$lt": c}},
+                        {"status": status, "created_at": c, "_id": {"$lt": i}}]}
+        direction = -1
+    cursor = payments_col.find(filt).sort([("created_at", direction), ("_id", direction)]).limit(limit + 1)
+    docs = [d async for d in cursor]
+    more = len(docs) > limit
+    docs = docs[:limit]
+    if direction == -1:
+        docs.reverse()
+    return docs, more
@@ -0,0 +1,264 @@
+# db/query_catalog.py
+# فهرست شکل همهٔ کوئری‌های پرتکرار تولید + بررسی explain روی یک mongod محلی با دادهٔ واقعی‌نما.
+#   python -m db.query_catalog --uri mongodb://localhost:27017 --users 50000
+# هر کوئری‌ای که COLLSCAN یا SORT در حافظه داشته باشد (و allow_scan نخورده باشد) → exit 1
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.int64 import Int64
+
+from db.schema import INDEX_SPECS
+
+
+# ===== کاتالوگ =====
+# (نام، کالکشن، محل استفاده، سازندهٔ filter از نمونه، sort، limit، allow_scan)
+# filter با مقدار واقعی از دادهٔ seed شده ساخته می‌شود تا planner مثل تولید تصمیم بگیرد.
+QUERIES = [
+    # --- users ---
+    ("user_by_tg_id", "users", "mongo_crud.get_or_create_user / get_user_by_tg_id",
+     lambda s: {"tg_id": Int64(s["tg_id"])}, None, 1, False),
+    ("broadcast_users_page", "users", "broadcast._run_job",
+     lambda s: {"_id": {"$gt": s["user_id"]}}, [("_id", 1)], 200, False),
+
+    # --- plans / admins (کوچک؛ خواندن کامل عمدی است) ---
+    ("plan_by_code", "plans", "mongo_crud.get_plan_by_code / provision",
+     lambda s: {"code": "plan_eco", "active": True}, None, 1, False),
+    ("all_plans", "plans", "mongo_crud.ensure_default_plans",
+     lambda s: {}, None, 0, True),
+    ("admin_by_uid", "admins", "mongo_crud.is_admin_db / add_admin",
+     lambda s: {"uid": s["admin_uid"]}, None, 1, False),
+    ("all_admins", "admins", "admin_roles.refresh_admins / mongo_crud.list_admins",
+     lambda s: {}, None, 0, True),
+
+    # --- orders ---
+    ("order_by_id", "orders", "provision / mongo_crud.get_order",
+     lambda s: {"_id": s["order_id"]}, None, 1, False),
+    ("open_order", "orders", "mongo_crud.get_or_create_open_order",
+     lambda s: {"user_id": s["user_id"], "plan_code": "plan_eco", "renew_sub_id": None,
+                "status": "pending", "has_payment": False},
+     None, 1, False),
+    ("stale_pending_orders", "orders", "sweeper.expire_stale_orders",
+     lambda s: {"status": "pending", "created_at": {"$lt": s["now"]}}, [("created_at", 1), ("_id", 1)], 500, False),
+    ("archivable_orders", "orders", "sweeper._archive",
+     lambda s: {"status": {"$in": ["expired", "canceled", "failed"]}, "created_at": {"$lt": s["now"]}}, None, 500, False),
+
+    # --- subscriptions ---
+    ("mysubs_first_page", "subscriptions", "handlers.mysubs._page",
+     lambda s: {"user_id": s["user_id"]}, [("start_at", -1), ("_id", -1)], 6, False),
+    ("mysubs_next_page", "subscriptions", "handlers.mysubs._page (after)",
+     lambda s: {"$or": [
+         {"user_id": s["user_id"], "start_at": {"$lt": s["now"]}},
+         {"user_id": s["user_id"], "start_at": s["now"], "_id": {"$lt": s["order_id"]}}]},
+     [("start_at", -1), ("_id", -1)], 6, False),
+    ("trial_prior", "subscriptions", "handlers.trial._issue_trial",
+     lambda s: {"user_id": s["user_id"], "source_plan": "trial"}, [("status", 1), ("end_at", 1)], 1, False),
+    ("renew_active", "subscriptions", "handlers.renew._renewable_sub",
+     lambda s: {"user_id": s["user_id"], "status": "active"}, None, 1, False),
+    ("renew_latest_paid", "subscriptions", "handlers.renew._renewable_sub",
+     lambda s: {"user_id": s["user_id"], "source_plan": {"$ne": "trial"}}, [("start_at", -1)], 1, False),
+    ("active_subs", "subscriptions", "quota_loop / account_index / compactor",
+     lambda s: {"status": "active"}, None, 0, False),
+    ("expired_active_subs", "subscriptions", "enforcer.expire_loop",
+     lambda s: {"status": "active", "end_at": {"$lte": s["now"]}}, None, 0, False),
+    ("sub_by_token", "subscriptions", "sub_http._load_bundle",
+     lambda s: {"sub_token": s["sub_token"]}, None, 1, False),
+
+    # --- stats rollup (services.stats) ---
+    ("stats_orders_window", "orders", "stats.rollup",
+     lambda s: {"created_at": {"$gte": s["now"] - timedelta(days=1)}}, None, 0, False),
+    ("stats_paid_window", "orders", "stats.rollup",
+     lambda s: {"status": "paid", "paid_at": {"$gte": s["now"] - timedelta(days=1)}}, None, 0, False),
+    ("stats_subs_window", "subscriptions", "stats.rollup",
+     lambda s: {"start_at": {"$gte": s["now"] - timedelta(days=1)}}, None, 0, False),
+
+    # --- export (services.export) ---
+    ("export_orders", "orders", "export.export_to_file(orders)",
+     lambda s: {"created_at": {"$gte": s["now"] - timedelta(days=30), "$lt": s["now"]}}, [("created_at", 1)], 0, False),
+    ("export_payments", "payments", "export.export_to_file(payments)",
+     lambda s: {"created_at": {"$gte": s["now"] - timedelta(days=30), "$lt": s["now"]}}, [("created_at", 1)], 0, False),
+    ("export_usage", "subscriptions", "export.export_to_file(usage)",
+     lambda s: {"start_at": {"$gte": s["now"] - timedelta(days=30), "$lt": s["now"]}}, [("start_at", 1)], 0, False),
+
+    # --- payments ---
+    ("payments_of_order", "payments", "mongo_crud.expire_open_payments_for_order",
+     lambda s: {"order_id": s["order_id"], "status": {"$in": ["pending_proof", "submitted"]}}, None, 0, False),
+    ("payments_by_status", "payments", "mongo_crud.list_payments(status)",
+     lambda s: {"status": "submitted"}, [("created_at", -1)], 50, False),
+    ("inbox_first_page", "payments", "handlers.inbox (list_payments_page)",
+     lambda s: {"status": "submitted"}, [("created_at", 1), ("_id", 1)], 6, False),
+    ("inbox_next_page", "payments", "handlers.inbox (list_payments_page after)",
+     lambda s: {"$or": [
+         {"status": "submitted", "created_at": {"$gt": s["now"] - timedelta(days=90)}},
+         {"status": "submitted", "created_at": s["now"] - timedelta(days=90), "_id": {"$gt": s["order_id"]}}]},
+     [("created_at", 1), ("_id", 1)], 6, False),
+    ("payments_recent", "payments", "mongo_crud.list_payments()",
+     lambda s: {}, [("created_at", -1)], 50, False),
+    ("overdue_payments", "payments", "sweeper.expire_overdue_payments",
+     lambda s: {"status": "pending_proof", "due_at": {"$lt": s["now"]}}, None, 0, False),
+    ("archivable_payments", "payments", "sweeper._archive",
+     lambda s: {"status": {"$in": ["expired", "rejected"]}, "created_at": {"$lt": s["now"]}}, None, 500, False),
+
+    # --- broadcasts ---
+    ("running_broadcasts", "broadcasts", "broadcast.resume_broadcasts",
+     lambda s: {"status": "running"}, None, 0, False),
+    ("recent_broadcasts", "broadcasts", "broadcast.list_broadcasts",
+     lambda s: {}, [("created_at", -1)], 5, False),
+]
+
+
+# ===== seed =====
+def _seed(db, users: int) -> dict:
+    """حجم تقریبی تولید: هر کاربر ~۲ اشتراک (اکثراً منقضی) و ~۳ سفارش."""
+    from db.mongo_crud import DEFAULT_PLANS
+    from services.account_index import paid_account_email, trial_account_email
+
+    rnd = random.Random(42)
+    now = datetime.utcnow()
+    for name in ("users", "plans", "admins", "orders", "subscriptions", "payments", "broadcasts"):
+        db[name].drop()
+
+    db.plans.insert_many([dict(p) for p in DEFAULT_PLANS])
+    db.admins.insert_many([{"uid": 1000 + i, "added_at": now} for i in range(5)])
+
+    batch_users, batch_orders, batch_subs, batch_pays = [], [], [], []
+
+    def flush(force: bool = False):
+        for col, batch in (("users", batch_users), ("orders", batch_orders),
+                           ("subscriptions", batch_subs), ("payments", batch_pays)):
+            if batch and (force or len(batch) >= 5000):
+                db[col].insert_many(batch, ordered=False)
+                batch.clear()
+
+    for i in range(users):
+        uid = ObjectId()
+        batch_users.append({"_id": uid, "tg_id": Int64(10_000_000 + i), "username": None,
+                            "first_name": f"u{i}", "created_at": now - timedelta(days=rnd.randint(0, 365))})
+        # پلن‌های متمایز به ازای کاربر (حداکثر یک سفارش باز برای هر پلن)
+        for code in rnd.sample([p["code"] for p in DEFAULT_PLANS], rnd.choice((1, 2, 3, 4))):
+            oid = ObjectId()
+            created = now - timedelta(days=rnd.randint(0, 365))
+            status = rnd.choices(["paid", "pending", "expired", "failed"], [50, 10, 35, 5])[0]
+            batch_orders.append({"_id": oid, "user_id": uid, "plan_code": code, "amount_toman": 69000,
+                                 "status": status, "created_at": created, "paid_at": None, "has_payment": True})
+            batch_pays.append({"order_id": oid, "method": "c2c", "amount_toman": 69000, "created_at": created,
+                               "status": rnd.choice(["approved", "expired", "submitted", "rejected"]),
+                               "due_at": created + timedelta(hours=1)})
+            if status == "paid":
+                start = created
+                sub_id = ObjectId()
+                batch_subs.append({
+                    "_id": sub_id, "user_id": uid, "source_plan": code, "quota_mb": 30 * 1024,
+                    "used_mb": 0, "devices": 1, "start_at": start, "end_at": start + timedelta(days=30),
+                    "status": "active" if start + timedelta(days=30) > now else "expired",
+                    "xray": [{"email": paid_account_email(oid, 1)}],
+                    "sub_token": f"tok{sub_id}",
+                })
+        if rnd.random() < 0.4:
+            sub_id = ObjectId()
+            start = now - timedelta(hours=rnd.randint(0, 24 * 60))
+            batch_subs.append({
+                "_id": sub_id, "user_id": uid, "source_plan": "trial", "quota_mb": 1024, "used_mb": 0,
+                "devices": 1, "start_at": start, "end_at": start + timedelta(hours=24),
+                "status": "active" if start + timedelta(hours=24) > now else "expired",
+                "xray": [{"email": trial_account_email(sub_id, 1)}],
+            })
+        flush()
+    flush(force=True)
+
+    db.broadcasts.insert_many([
+        {"status": "done", "created_at": now - timedelta(days=d), "created_by": 1000} for d in range(50)
+    ])
+
+    sample_sub = db.subscriptions.find_one({"sub_token": {"$exists": True}})
+    sample_order = db.orders.find_one({})
+    return {
+        "now": now,
+        "user_id": sample_sub["user_id"],
+        "tg_id": int(db.users.find_one({"_id": sample_sub["user_id"]})["tg_id"]),
+        "order_id": sample_order["_id"],
+        "sub_token": sample_sub["sub_token"],
+        "admin_uid": 1002,
+    }
+
+
+# ===== explain =====
+def _stages(plan) -> list[str]:
+    """همهٔ stageهای یک winningPlan (شامل queryPlan موتور SBE و inputStage(s))."""
+    out = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            out.append(plan["stage"])
+        for v in plan.values():
+            out.extend(_stages(v))
+    elif isinstance(plan, list):
+        for v in plan:
+            out.extend(_stages(v))
+    return out
+
+
+def explain_query(db, collection: str, filt: dict, sort, limit: int) -> dict:
+    cmd = {"find": collection, "filter": filt}
+    if sort:
+        cmd["sort"] = dict(sort)
+    if limit:
+        cmd["limit"] = limit
+    res = db.command("explain", cmd, verbosity="executionStats")
+    stages = _stages(res["queryPlanner"]["winningPlan"])
+    stats = res.get("executionStats", {})
+    return {
+        "stages": stages,
+        "collscan": "COLLSCAN" in stages,
+        "in_memory_sort": "SORT" in stages,
+        "docs": stats.get("totalDocsExamined", 0),
+        "keys": stats.get("totalKeysExamined", 0),
+        "returned": stats.get("nReturned", 0),
+        "ms": stats.get("executionTimeMillis", 0),
+    }
+
+
+def run_catalog(db, sample: dict) -> int:
+    failures = 0
+    print(f"{'query':<24} {'plan':<34} {'keys':>8} {'docs':>8} {'ret':>6} {'ms':>5}")
+    for name, col, _where, build, sort, limit, allow_scan in QUERIES:
+        r = explain_query(db, col, build(sample), sort, limit)
+        bad = not allow_scan and (r["collscan"] or r["in_memory_sort"])
+        failures += bad
+        plan = ">".join(dict.fromkeys(r["stages"]))[:34]
+        print(f"{name:<24} {plan:<34} {r['keys']:>8} {r['docs']:>8} {r['returned']:>6} {r['ms']:>5}"
+              f"{'  ❌' if bad else ''}")
+    return failures
+
+
+def main(argv: list[str] | None = None) -> int:
+    from pymongo import MongoClient
+
+    ap = argparse.ArgumentParser(description="explain-based index coverage check for production queries")
+    ap.add_argument("--uri", default="mongodb://localhost:27017")
+    ap.add_argument("--db", default="vira_query_bench")
+    ap.add_argument("--users", type=int, default=50_000)
+    args = ap.parse_args(argv)
+
+    from config import settings
+    if args.db == settings.MONGO_DB:
+        # seed کالکشن‌ها را drop می‌کند
+        ap.error(f"refusing to seed the production database {args.db!r}")
+
+    db = MongoClient(args.uri)[args.db]
+    t0 = time.perf_counter()
+    sample = _seed(db, args.users)
+    for name, keys, opts in INDEX_SPECS:
+        db[name].create_index(keys, **opts)
+    print(f"seeded {args.users} users in {time.perf_counter() - t0:.1f}s "
+          f"(subs={db.subscriptions.estimated_document_count()}, orders={db.orders.estimated_document_count()})")
+
+    failures = run_catalog(db, sample)
+    print(f"\n{len(QUERIES) - failures}/{len(QUERIES)} OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,14 @@
 # db/schema.py
-from db.mongo import db, users_col, plans_col, orders_col, subscriptions_col
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+from config import settings
+from db.mongo import db, meta_col
 
 # --- Validators ---
 USERS_VALIDATOR = {
@@ -39,7 +48,7 @@ ORDERS_VALIDATOR = {
             "user_id": {"bsonType": "objectId"},
             "plan_code": {"bsonType": "string"},
             "amount_toman": {"bsonType": "int", "minimum": 0},
-            "status": {"enum": ["pending", "paid", "failed", "expired", "refunded"]},
+            "status": {"enum": ["pending", "paid", "failed", "expired", "canceled", "refunded"]},
             "created_at": {"bsonType": "date"},
         },
     }
@@ -62,37 +71,289 @@ SUBS_VALIDATOR = {
     }
 }
 
-# --- ایندکس‌ها ---
+# --- Validators (نام کالکشن → validator) ---
+VALIDATORS = {
+    "users": USERS_VALIDATOR,
+    "plans": PLANS_VALIDATOR,
+    "orders": ORDERS_VALIDATOR,
+    "subscriptions": SUBS_VALIDATOR,
+}
+
+# --- ایندکس‌ها (تنها منبع؛ (نام کالکشن، کلیدها، گزینه‌ها)) ---
 INDEX_SPECS = [
-    (users_col, [("tg_id", 1)], {"unique": True}),
-    (plans_col, [("code", 1)], {"unique": True}),
-    (orders_col, [("user_id", 1), ("status", 1)], {}),
-    (subscriptions_col, [("user_id", 1), ("status", 1)], {}),
-    (subscriptions_col, [("end_at", 1)], {}),
+    # === users ===
+    # هر کاربر تلگرام یکبار
+    ("users", [("tg_id", 1)], {"unique": True}),
+
+    # === plans ===
+    ("plans", [("code", 1)], {"unique": True}),
+    ("plans", [("active", 1)], {}),
+
+    # === orders ===
+    # جست‌وجوی پرتکرار: سفارش‌های کاربر بر اساس وضعیت و زمان
+    ("orders", [("user_id", 1), ("status", 1), ("created_at", -1)], {}),
+    ("orders", [("created_at", 1)], {}),
+    # رول‌آپ آمار: سفارش‌های پرداخت‌شده به ترتیب زمان پرداخت
+    ("orders", [("paid_at", 1)], {"partialFilterExpression": {"paid_at": {"$type": "date"}}}),
+    # sweeper: انقضای pendingهای قدیمی (keyset روی created_at, _id) و آرشیو وضعیت‌های پایانی
+    ("orders", [("status", 1), ("created_at", 1), ("_id", 1)], {}),
+    # حداکثر یک سفارش باز بدون پرداخت به ازای کاربر + پلن + (خرید | اشتراکِ تمدیدی)
+    # (upsert در get_or_create_open_order؛ renew_sub_id=null یعنی خرید تازه)
+    ("orders", [("user_id", 1), ("plan_code", 1), ("renew_sub_id", 1)],
+     {"unique": True, "partialFilterExpression": {"status": "pending", "has_payment": False},
+      "name": "open_order_per_plan"}),
+
+    # === subscriptions ===
+    # نمایش و مانیتورینگ: اشتراک‌های کاربر/وضعیت/نزدیک‌ترین پایان
+    ("subscriptions", [("user_id", 1), ("status", 1), ("end_at", -1)], {}),
+    # لیست «اشتراک‌های من»: جدیدترین‌ها بدون sort در حافظه؛ _id برای کرسر keyset (start_at, _id)
+    ("subscriptions", [("user_id", 1), ("start_at", -1), ("_id", -1)], {}),
+    # تست کاربر (برابری‌ها، بعد status/end_at برای sort)
+    ("subscriptions", [("user_id", 1), ("source_plan", 1), ("status", 1), ("end_at", 1)], {}),
+    # لوپ‌های پس‌زمینه فقط active می‌خوانند؛ partial تا اشتراک‌های منقضی (اکثریت) در ایندکس نباشند
+    ("subscriptions", [("status", 1), ("end_at", 1)],
+     {"partialFilterExpression": {"status": "active"}, "name": "active_status_end_at"}),
+    # برای کرون/لوپ‌های پایان اعتبار یا سهمیه
+    ("subscriptions", [("end_at", 1)], {}),
+    # ایمیل حساب‌های Xray یکتا در کل اشتراک‌ها (multikey روی لیست xray)
+    ("subscriptions", [("xray.email", 1)],
+     {"unique": True, "partialFilterExpression": {"xray.email": {"$exists": True}}}),
+    # حداکثر یک تست به ازای کاربر (trial_of فقط روی اشتراک‌های تست ست می‌شود)
+    ("subscriptions", [("trial_of", 1)],
+     {"unique": True, "partialFilterExpression": {"trial_of": {"$exists": True}}}),
+    # رول‌آپ آمار: اشتراک‌های جدید از آخرین watermark
+    ("subscriptions", [("start_at", 1)], {}),
+    # توکن لینک اشتراک HTTP (فقط اشتراک‌هایی که توکن دارند)
+    ("subscriptions", [("sub_token", 1)], {"unique": True, "sparse": True}),
+
+    # === payments ===
+    # گرفتن آخرین پرداخت‌های یک سفارش + فیلتر وضعیت
+    ("payments", [("order_id", 1), ("status", 1), ("created_at", -1)], {}),
+    # لیست/صندوق بررسی: keyset روی (status, created_at, _id) در هر دو جهت
+    ("payments", [("status", 1), ("created_at", 1), ("_id", 1)], {}),
+    ("payments", [("created_at", -1)], {}),
+    # sweeper: pending_proofهایی که due_at گذشته
+    ("payments", [("status", 1), ("due_at", 1)], {}),
+
+    # === archives ===
+    # فقط برای پیگیری پشتیبانی؛ کالکشن‌های اصلی کوچک می‌مانند
+    ("orders_archive", [("user_id", 1), ("created_at", -1)], {}),
+    ("payments_archive", [("order_id", 1)], {}),
+
+    # === admins ===
+    ("admins", [("uid", 1)], {"unique": True}),
+
+    # === processed_updates ===
+    # حذف خودکار update_idهای پردازش‌شده بعد از یک روز (تلگرام بیش از این ری‌دلیور نمی‌کند)
+    ("processed_updates", [("at", 1)], {"expireAfterSeconds": 24 * 3600}),
+
+    # === broadcasts ===
+    # ادامهٔ جاب‌های نیمه‌کاره بعد از ری‌استارت
+    ("broadcasts", [("status", 1), ("created_at", -1)], {}),
+    ("broadcasts", [("created_at", -1)], {}),
+
+    # === fsm_states ===
+    # استیت‌های رهاشده (مثلاً چک‌اوت نیمه‌کاره) خودکار پاک می‌شوند
+    ("fsm_states", [("updated_at", 1)], {"expireAfterSeconds": int(settings.FSM_STATE_TTL_SEC)}),
 ]
 
-async def ensure_collections_and_validators():
-    # ساخت کالکشن‌ها (اگر وجود نداشت)
+def schema_hash() -> str:
+    """اثر انگشت validatorها + ایندکس‌ها؛ با هر تغییر در این فایل عوض می‌شود."""
+    payload = json.dumps({"validators": VALIDATORS, "indexes": INDEX_SPECS}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def _ensure_validator(name: str, validator: dict) -> None:
+    # ساخت کالکشن (اگر وجود نداشت)، وگرنه به‌روزرسانی validator
     try:
-        await db.create_collection("users", validator=USERS_VALIDATOR, validationAction="error")
+        await db.create_collection(name, validator=validator, validationAction="error")
     except Exception:
-        await db.command({"collMod": "users", "validator": USERS_VALIDATOR, "validationAction": "error"})
+        await db.command({"collMod": name, "validator": validator, "validationAction": "error"})
+
 
+async def _ensure_index(name: str, keys: list, opts: dict) -> None:
     try:
-        await db.create_collection("plans", validator=PLANS_VALIDATOR, validationAction="error")
-    except Exception:
-        await db.command({"collMod": "plans", "validator": PLANS_VALIDATOR, "validationAction": "error"})
+        await db[name].create_index(keys, **opts)
+    except OperationFailure as e:
+        # 85/86: ایندکسی با همین نام یا کلیدها ولی گزینه‌های قدیمی (مثلاً partialFilter) هست → جایگزین
+        if e.code not in (85, 86):
+            raise
+        for idx_name, info in (await db[name].index_information()).items():
+            if idx_name == opts.get("name") or info["key"] == list(keys):
+                await db[name].drop_index(idx_name)
+        await db[name].create_index(keys, **opts)
+
 
+def _norm_keys(keys) -> tuple:
+    # index_information جهت را گاهی float برمی‌گرداند (1.0)
+    return tuple((k, int(v) if isinstance(v, (int, float)) else v) for k, v in keys)
+
+
+async def _drop_stale_indexes() -> list[str]:
+    """
+    ایندکس‌هایی از کالکشن‌های INDEX_SPECS که دیگر در آن نیستند (مثلاً بعد از تغییر کلیدها)
+    حذف می‌شوند تا روی هر نوشتن هزینه نگذارند. _id_ و کالکشن‌های بیرون از INDEX_SPECS دست نمی‌خورند.
+    """
+    wanted: dict[str, set] = {}
+    for name, keys, _ in INDEX_SPECS:
+        wanted.setdefault(name, set()).add(_norm_keys(keys))
+    dropped = []
+    for name, keys_set in wanted.items():
+        for idx_name, info in (await db[name].index_information()).items():
+            if idx_name != "_id_" and _norm_keys(info["key"]) not in keys_set:
+                await db[name].drop_index(idx_name)
+                dropped.append(f"{name}.{idx_name}")
+    return dropped
+
+
+async def _dedupe_open_orders() -> int:
+    """
+    سفارش‌های pending قدیمی has_payment می‌گیرند (هر کدام پرداختی دارد دست نمی‌خورد و از کلید
+    یکتا بیرون است)؛ از بقیهٔ هر گروه هم‌پلنِ یک کاربر فقط جدیدترین باز می‌ماند، باقی canceled.
+    """
+    legacy = [o["_id"] async for o in db["orders"].find(
+        {"status": "pending", "has_payment": {"$exists": False}}, {"_id": 1})]
+    if legacy:
+        paid_for = await db["payments"].distinct("order_id", {"order_id": {"$in": legacy}})
+        await db["orders"].update_many({"_id": {"$in": paid_for}}, {"$set": {"has_payment": True}})
+        await db["orders"].update_many(
+            {"_id": {"$in": legacy, "$nin": paid_for}}, {"$set": {"has_payment": False}})
+
+    pipeline = [
+        {"$match": {"status": "pending", "has_payment": False}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {"_id": {"u": "$user_id", "p": "$plan_code", "r": {"$ifNull": ["$renew_sub_id", None]}},
+                    "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    stale = []
+    async for g in db["orders"].aggregate(pipeline, allowDiskUse=True):
+        stale.extend(g["ids"][1:])
+    if not stale:
+        return 0
+    res = await db["orders"].update_many(
+        {"_id": {"$in": stale}, "status": "pending", "has_payment": False},
+        {"$set": {"status": "canceled", "canceled_at": datetime.utcnow(), "cancel_reason": "duplicate_open_order"}}
+    )
+    return res.modified_count or 0
+
+
+async def _dedupe_xray_emails() -> int:
+    """
+    دادهٔ قدیمی ممکن است یک ایمیل Xray را در چند اشتراک داشته باشد (تست‌های تکراری با ایمیل
+    trial-<tg_id>). در هر گروه اشتراک active و بعد جدیدترین ایمیل را نگه می‌دارد؛ بقیه
+    «<email>~dup-<sub_id>» می‌شوند تا ایندکس یکتای xray.email ساخته شود.
+    (در Xray هم فقط یک کلاینت با هر ایمیل هست؛ بقیه از قبل به کلاینتی وصل نبودند)
+    """
+    pipeline = [
+        {"$match": {"xray.email": {"$exists": True}}},
+        {"$project": {
+            "e": {"$cond": [{"$isArray": "$xray"}, "$xray.email", ["$xray.email"]]},
+            "rank": {"$cond": [{"$eq": ["$status", "active"]}, 0, 1]},
+            "start_at": 1,
+        }},
+        {"$unwind": "$e"},
+        {"$sort": {"rank": 1, "start_at": -1}},
+        {"$group": {"_id": "$e", "subs": {"$push": "$_id"}}},
+        {"$match": {"subs.1": {"$exists": True}}},
+    ]
+    renamed = 0
+    async for g in db["subscriptions"].aggregate(pipeline, allowDiskUse=True):
+        email = g["_id"]
+        # یک اشتراک ممکن است همان ایمیل را دو بار در لیستش داشته باشد
+        owners = list(dict.fromkeys(g["subs"]))
+        for sub_id in owners[1:]:
+            doc = await db["subscriptions"].find_one({"_id": sub_id}, {"xray": 1})
+            x = (doc or {}).get("xray")
+            new = f"{email}~dup-{sub_id}"
+            if isinstance(x, list):
+                x = [dict(a, email=new) if isinstance(a, dict) and a.get("email") == email else a for a in x]
+            elif isinstance(x, dict) and x.get("email") == email:
+                x = dict(x, email=new)
+            else:
+                continue
+            await db["subscriptions"].update_one({"_id": sub_id}, {"$set": {"xray": x}})
+            renamed += 1
+    return renamed
+
+
+async def _run_all(label: str, coros: list, labels: list[str]) -> bool:
+    """هم‌زمان اجرا می‌کند؛ خطاها لاگ می‌شوند. خروجی: همه موفق بودند؟"""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    ok = True
+    for lbl, res in zip(labels, results):
+        if isinstance(res, Exception):
+            print(f"⚠️ {label} {lbl} failed: {res}")
+            ok = False
+    return ok
+
+
+async def ensure_collections_and_validators(force: bool = False) -> dict[str, float]:
+    """
+    validatorها و ایندکس‌ها را اعمال می‌کند؛ اگر hash اسکیمای ذخیره‌شده در meta با
+    hash فعلی یکی باشد کل مرحله رد می‌شود. خروجی: زمان هر مرحله (ثانیه) برای لاگ استارتاپ.
+    """
+    timings: dict[str, float] = {}
+    t0 = time.perf_counter()
+    current = schema_hash()
+    stored = await meta_col.find_one({"_id": "schema"})
+    timings["schema_check"] = time.perf_counter() - t0
+    if not force and stored and stored.get("hash") == current:
+        return timings
+
+    t0 = time.perf_counter()
+    ok = await _run_all(
+        "validator",
+        [_ensure_validator(n, v) for n, v in VALIDATORS.items()],
+        list(VALIDATORS),
+    )
+    timings["validators"] = time.perf_counter() - t0
+
+    # دادهٔ قدیمی ممکن است چند سفارش باز برای یک پلن داشته باشد؛ قبل از ایندکس یکتا
+    t0 = time.perf_counter()
     try:
-        await db.create_collection("orders", validator=ORDERS_VALIDATOR, validationAction="error")
-    except Exception:
-        await db.command({"collMod": "orders", "validator": ORDERS_VALIDATOR, "validationAction": "error"})
+        await _dedupe_open_orders()
+    except Exception as e:
+        print(f"⚠️ open order dedupe failed: {e}")
+    timings["dedupe_orders"] = time.perf_counter() - t0
 
+    # همین‌طور ایمیل‌های تکراری Xray؛ اگر نشد ساخت ایندکس یکتا شکست می‌خورد و hash ثبت نمی‌شود
+    t0 = time.perf_counter()
     try:
-        await db.create_collection("subscriptions", validator=SUBS_VALIDATOR, validationAction="error")
-    except Exception:
-        await db.command({"collMod": "subscriptions", "validator": SUBS_VALIDATOR, "validationAction": "error"})
+        n = await _dedupe_xray_emails()
+        if n:
+            print(f"🧹 renamed {n} duplicate xray emails")
+    except Exception as e:
+        print(f"⚠️ xray email dedupe failed: {e}")
+    timings["dedupe_emails"] = time.perf_counter() - t0
+
+    # ایندکس‌ها بعد از validatorها، تا create_index کالکشن را بدون validator نسازد
+    t0 = time.perf_counter()
+    labels = [f"{n}.{keys[0][0]}" for n, keys, _ in INDEX_SPECS]
+    ok = await _run_all(
+        "index",
+        [_ensure_index(n, keys, opts) for n, keys, opts in INDEX_SPECS],
+        labels,
+    ) and ok
+    timings["indexes"] = time.perf_counter() - t0
+
+    # ایندکس‌های منسوخ فقط بعد از ساخت موفق جایگزین‌ها (کوئری‌ها بی‌ایندکس نمی‌مانند)
+    if ok:
+        t0 = time.perf_counter()
+        try:
+            dropped = await _drop_stale_indexes()
+            if dropped:
+                print(f"🧹 dropped stale indexes: {', '.join(dropped)}")
+        except Exception as e:
+            print(f"⚠️ stale index cleanup failed: {e}")
+            ok = False
+        timings["stale_indexes"] = time.perf_counter() - t0
 
-    # ایندکس‌ها
-    for col, keys, opts in INDEX_SPECS:
-        await col.create_index(keys, **opts)
+    # فقط وقتی همه‌چیز اعمال شد نسخه ثبت می‌شود؛ وگرنه استارت بعدی دوباره تلاش می‌کند
+    if ok:
+        await meta_col.update_one(
+            {"_id": "schema"},
+            {"$set": {"hash": current, "applied_at": datetime.utcnow()}},
+            upsert=True,
+        )
+    return timings
@@ -1,24 +1,27 @@
 # handlers/admin_manage.py
+import asyncio
+import os
+from datetime import datetime
+
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.types import FSInputFile, Message
 from aiogram.filters import Command, CommandObject
+from bson import ObjectId
 
-from config import settings
-from db.mongo_crud import add_admin, remove_admin, list_admins, is_admin_db
+from db.mongo import subscriptions_col, users_col
+from db.mongo_crud import add_admin, remove_admin, list_admins, get_user_by_tg_id
+from middlewares.ordering import QUEUE_WAIT
+from middlewares.throttling import THROTTLED
+from services.admin_roles import ROOT_ADMIN_ID, is_admin, is_root_admin, refresh_admins
+from services.compactor import format_compaction_report, run_compaction
+from services.export import EXPORTS, FORMATS, export_to_file, parse_range
+from services.reactivation import reactivate_subscription
+from services.stats import read_active, read_windows
+from services.xray_runner import XRAY_CALLS, breaker, soft_breaker
+from utils.locale import TEHRAN, fmt_dt
 
 router = Router()
 
-# List[int]؛ از settings خوانده می‌شود (در بخش 2 تنظیمش می‌کنیم)
-ADMIN_IDS: list[int] = list(getattr(settings, "ADMIN_CHAT_IDS", []))
-
-def is_root_admin(uid: int) -> bool:
-    """RootAdmin = اولین آیتمِ ADMIN_CHAT_IDS در .env"""
-    return bool(ADMIN_IDS) and int(uid) == int(ADMIN_IDS[0])
-
-async def is_admin(uid: int) -> bool:
-    """ادمین = Root یا داخل جدول admins."""
-    return is_root_admin(uid) or (await is_admin_db(uid))
-
 def _extract_uid_from_args_or_reply(m: Message, command: CommandObject) -> int | None:
     # اولویت با آرگومان
     if command and command.args:
@@ -32,20 +35,28 @@ def _extract_uid_from_args_or_reply(m: Message, command: CommandObject) -> int |
 
 @router.message(Command("admin"))
 async def admin_home(m: Message):
-    if not (await is_admin(m.from_user.id)):
+    if not is_admin(m.from_user.id):
         return await m.answer("\u200F⛔ این بخش مخصوص ادمین‌هاست.")
     await m.answer(
         "\u200Fپَنل ادمین:\n"
         "• /admins — فهرست ادمین‌ها\n"
         "• /add_admin <uid> — افزودن ادمین (فقط Root)\n"
         "• /remove_admin <uid> — حذف ادمین (فقط Root)\n"
+        "• /broadcast &lt;متن&gt; — ارسال همگانی (یا ریپلای روی پیام)\n"
+        "• /broadcast_status — وضعیت ارسال‌های همگانی\n"
+        "• /inbox [pending] — صندوق بررسی رسیدهای پرداخت\n"
+        "• /topup &lt;sub_id|tg_id&gt; &lt;گیگ&gt; [روز] — شارژ/فعال‌سازی دوبارهٔ اشتراک\n"
+        "• /compact_xray — پاک‌سازی کلاینت‌های منقضی از کانفیگ (فقط Root)\n"
+        "• /stats — آمار فروش و مصرف\n"
+        "• /export &lt;orders|payments|usage&gt; [csv|jsonl] [روز] — خروجی حسابداری\n"
+        "• /metrics — شمارنده‌های عملکرد\n"
         "• /whoami — اطلاعات شما\n"
         "• /ping — تست"
     )
 
 @router.message(Command("whoami"))
 async def whoami(m: Message):
-    role = "Root" if is_root_admin(m.from_user.id) else ("Admin" if (await is_admin_db(m.from_user.id)) else "User")
+    role = "Root" if is_root_admin(m.from_user.id) else ("Admin" if is_admin(m.from_user.id) else "User")
     await m.answer(
         "\u200F"
         f"uid: <code>{m.from_user.id}</code>\n"
@@ -58,14 +69,48 @@ async def whoami(m: Message):
 async def ping(m: Message):
     await m.answer("\u200Fpong ✅")
 
+@router.message(Command("metrics"))
+async def metrics_cmd(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    lines = ["\u200F📈 <b>Throttled</b>"]
+    if THROTTLED:
+        for action, n in sorted(THROTTLED.items()):
+            lines.append(f"• {action}: <code>{n}</code>")
+    else:
+        lines.append("— (هیچ)")
+    lines.append("")
+    lines.append(f"🛰 <b>Xray</b> — breaker: <code>{breaker.state}</code> | soft: <code>{soft_breaker.state}</code>")
+    for k in ("ok", "failed", "queued", "shed"):
+        lines.append(f"• {k}: <code>{XRAY_CALLS.get(k, 0)}</code>")
+    lines.append("")
+    lines.append("⏱ <b>Queue wait</b> (avg / max ms)")
+    if QUEUE_WAIT:
+        for name, st in sorted(QUEUE_WAIT.items(), key=lambda kv: -kv[1]["max"]):
+            avg_ms = st["total"] / max(1, st["count"]) * 1000
+            lines.append(f"• {name}: <code>{avg_ms:.0f} / {st['max'] * 1000:.0f}</code> ×{int(st['count'])}")
+    else:
+        lines.append("— (هیچ)")
+    await m.answer("\n".join(lines), parse_mode="HTML")
+
+@router.message(Command("compact_xray"))
+async def compact_xray_cmd(m: Message):
+    if not is_root_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ فقط Root Admin.")
+    try:
+        report = await run_compaction()
+    except Exception as e:
+        return await m.answer(f"\u200F⚠️ خطا در فشرده‌سازی: {e}")
+    await m.answer(format_compaction_report(report))
+
 @router.message(Command("admins"))
 async def admins_cmd(m: Message):
-    if not (await is_admin(m.from_user.id)):
+    if not is_admin(m.from_user.id):
         return await m.answer("\u200F⛔ دسترسی ندارید.")
     rows = await list_admins()
     lines = ["\u200F👑 <b>Root Admins</b>"]
-    if ADMIN_IDS:
-        lines.append(f"👑 Root — <code>{ADMIN_IDS[0]}</code>")
+    if ROOT_ADMIN_ID is not None:
+        lines.append(f"👑 Root — <code>{ROOT_ADMIN_ID}</code>")
     else:
         lines.append("— (تعریف نشده)")
     norm = [r for r in rows]
@@ -87,6 +132,7 @@ async def add_admin_cmd(m: Message, command: CommandObject):
     if is_root_admin(uid):
         return await m.answer("ℹ️ این کاربر Root است.")
     ok = await add_admin(uid=uid, username=m.from_user.username, added_by=m.from_user.id)
+    await refresh_admins()
     await m.answer(
         f"✅ ادمین با ID <code>{uid}</code> اضافه شد." if ok else "ℹ️ این کاربر قبلاً ادمین بوده.",
         parse_mode="HTML"
@@ -102,7 +148,139 @@ async def remove_admin_cmd(m: Message, command: CommandObject):
     if is_root_admin(uid):
         return await m.answer("❌ نمی‌توان Root Admin را حذف کرد.")
     ok = await remove_admin(uid)
+    await refresh_admins()
     await m.answer(
         f"🗑 ادمین با ID <code>{uid}</code> حذف شد." if ok else "ℹ️ چنین ادمینی در DB نیست.",
         parse_mode="HTML"
     )
+
+async def _topup_target(ref: str) -> dict | None:
+    """شناسهٔ اشتراک (۲۴ کاراکتر hex) یا tg_id کاربر → آخرین اشتراکش."""
+    if ObjectId.is_valid(ref):
+        return await subscriptions_col.find_one({"_id": ObjectId(ref)})
+    if ref.isdigit():
+        user = await get_user_by_tg_id(int(ref))
+        if user:
+            return await subscriptions_col.find_one({"user_id": user["_id"]}, sort=[("start_at", -1)])
+    return None
+
+@router.message(Command("topup"))
+async def topup_cmd(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    args = (command.args or "").split()
+    if len(args) not in (2, 3) or not all(a.isdigit() for a in args[1:]):
+        return await m.answer("فرمت: /topup &lt;sub_id|tg_id&gt; &lt;گیگ&gt; [روز]")
+    gb, days = int(args[1]), int(args[2]) if len(args) == 3 else 0
+
+    sub = await _topup_target(args[0])
+    if not sub:
+        return await m.answer("\u200F❌ اشتراک پیدا نشد.")
+
+    try:
+        doc = await reactivate_subscription(
+            sub,
+            add_quota_mb=gb * 1024,
+            extend_days=days,
+            push={"topups": {"by": m.from_user.id, "gb": gb, "days": days, "at": datetime.utcnow()}},
+        )
+    except Exception as e:
+        return await m.answer(f"\u200F⚠️ خطا در فعال‌سازی: {e}")
+    if not doc:
+        return await m.answer("\u200F⚠️ با این مقدار هم اشتراک منقضی یا بدون حجم می‌ماند؛ روز/حجم بیشتری بدهید.")
+
+    await m.answer(
+        "\u200F✅ اشتراک شارژ و فعال شد.\n"
+        f"• شناسه: <code>{doc['_id']}</code>\n"
+        f"• حجم: {doc['used_mb']} / {doc['quota_mb']} مگ\n"
+        f"• پایان: {doc['end_at']:%Y-%m-%d %H:%M} UTC"
+    )
+
+    user = await users_col.find_one({"_id": doc["user_id"]}, {"tg_id": 1})
+    if user and user.get("tg_id") is not None:
+        try:
+            await m.bot.send_message(
+                int(user["tg_id"]),
+                "\u200F🔋 اشتراک شما توسط پشتیبانی شارژ شد و فعال است.\n"
+                "لینک‌های قبلی بدون تغییر کار می‌کنند."
+            )
+        except Exception:
+            pass
+
+def _fmt_window(title: str, per_plan: dict[str, dict]) -> list[str]:
+    tot = {k: sum(p[k] for p in per_plan.values()) for k in ("orders", "paid", "revenue", "new_subs", "traffic_bytes")}
+    conv = f"{tot['paid'] / tot['orders'] * 100:.0f}%" if tot["orders"] else "-"
+    return [
+        f"<b>{title}</b>",
+        f"• سفارش: {tot['orders']} | پرداخت: {tot['paid']} ({conv})",
+        f"• درآمد: {tot['revenue']:,} ت",
+        f"• اشتراک جدید: {tot['new_subs']} | ترافیک: {tot['traffic_bytes'] / 1024 ** 3:.1f} GB",
+    ]
+
+@router.message(Command("stats"))
+async def stats_cmd(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    # فقط اسناد رول‌آپ خوانده می‌شوند؛ رول‌آپ کار stats_loop است
+    (today, week, month), (active, active_at) = await asyncio.gather(
+        read_windows(1, 7, 30), read_active()
+    )
+
+    lines = ["\u200F📊 <b>آمار</b>", ""]
+    lines += _fmt_window("امروز", today) + [""]
+    lines += _fmt_window("۷ روز اخیر", week) + [""]
+    lines += _fmt_window("۳۰ روز اخیر", month) + [""]
+
+    lines.append("<b>به تفکیک پلن (۳۰ روز)</b>")
+    for plan, t in sorted(month.items(), key=lambda kv: -kv[1]["revenue"]):
+        conv = f"{t['paid'] / t['orders'] * 100:.0f}%" if t["orders"] else "-"
+        lines.append(f"• {plan}: {t['paid']}/{t['orders']} ({conv}) — {t['revenue']:,} ت")
+    lines.append("")
+
+    updated = f" ({fmt_dt(active_at)})" if active_at else ""
+    lines.append(f"<b>اشتراک‌های فعال:</b> {sum(active.values())}{updated}")
+    for plan, n in sorted(active.items(), key=lambda kv: -kv[1]):
+        lines.append(f"• {plan}: {n}")
+    await m.answer("\n".join(lines))
+
+# سقف آپلود سند ربات در تلگرام
+TG_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+@router.message(Command("export"))
+async def export_cmd(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    usage = ("\u200Fفرمت: /export &lt;orders|payments|usage&gt; [csv|jsonl] [روز|YYYY-MM-DD..YYYY-MM-DD]\n"
+             "مثال: /export orders csv 30")
+    args = (command.args or "").split()
+    if not args or args[0] not in EXPORTS:
+        return await m.answer(usage)
+    kind = args[0]
+    fmt = args[1] if len(args) > 1 and args[1] in FORMATS else "csv"
+    rest = [a for a in args[1:] if a not in FORMATS]
+    try:
+        since, until = parse_range(rest[0] if rest else "30")
+    except ValueError:
+        return await m.answer(usage)
+
+    status = await m.answer("\u200F⏳ در حال تهیهٔ خروجی…")
+    path = None
+    try:
+        path, rows = await export_to_file(kind, fmt, since, until)
+        size = os.path.getsize(path)
+        if size > TG_DOCUMENT_LIMIT:
+            return await status.edit_text(
+                f"\u200F⚠️ فایل ({size // 1024 ** 2} مگ) از سقف تلگرام بزرگ‌تر است؛ "
+                f"بازه را کوچک‌تر کنید یا از <code>python -m services.export {kind}</code> استفاده کنید."
+            )
+        name = f"{kind}-{datetime.now(TEHRAN):%Y%m%d-%H%M}.{fmt}.gz"
+        await m.answer_document(FSInputFile(path, filename=name), caption=f"\u200F📦 {kind}: {rows:,} ردیف")
+        await status.delete()
+    except Exception as e:
+        await status.edit_text(f"\u200F⚠️ خطا در تهیهٔ خروجی: {e}")
+    finally:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,65 @@
+# handlers/broadcast.py
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+from bson.errors import InvalidId
+
+from services.admin_roles import is_admin
+from services.broadcast import cancel_broadcast, list_broadcasts, start_broadcast
+
+router = Router()
+
+
+@router.message(Command("broadcast"))
+async def broadcast_cmd(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+
+    # ریپلای روی یک پیام → همان پیام (با مدیا) کپی می‌شود؛ وگرنه متن بعد از دستور
+    if m.reply_to_message:
+        job_id = await start_broadcast(
+            m.bot, m.from_user.id,
+            from_chat_id=m.chat.id, message_id=m.reply_to_message.message_id,
+        )
+    elif command.args and command.args.strip():
+        # parse_mode پیش‌فرض HTML است؛ html_text قالب‌بندی ادمین را نگه می‌دارد و < و & را escape می‌کند
+        text = m.html_text.split(None, 1)[1].strip()
+        job_id = await start_broadcast(m.bot, m.from_user.id, text=text)
+    else:
+        return await m.answer(
+            "فرمت: /broadcast &lt;متن&gt;\n"
+            "یا روی پیام موردنظر ریپلای و دستور را بفرست."
+        )
+
+    await m.answer(
+        f"\u200F📣 ارسال همگانی شروع شد.\nشناسه: <code>{job_id}</code>\n"
+        "وضعیت: /broadcast_status",
+        parse_mode="HTML"
+    )
+
+
+@router.message(Command("broadcast_status"))
+async def broadcast_status_cmd(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    jobs = await list_broadcasts()
+    if not jobs:
+        return await m.answer("\u200Fهنوز ارسال همگانی‌ای ثبت نشده.")
+    lines = ["\u200F📣 <b>ارسال‌های همگانی اخیر</b>"]
+    for j in jobs:
+        lines.append(
+            f"• <code>{j['_id']}</code> — {j['status']}\n"
+            f"  ✅ {j.get('delivered', 0)} | 🚫 {j.get('blocked', 0)} | ⚠️ {j.get('failed', 0)}"
+        )
+    await m.answer("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("broadcast_cancel"))
+async def broadcast_cancel_cmd(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return await m.answer("\u200F⛔ دسترسی ندارید.")
+    try:
+        ok = await cancel_broadcast((command.args or "").strip())
+    except (InvalidId, TypeError):
+        return await m.answer("فرمت: /broadcast_cancel &lt;id&gt;")
+    await m.answer("\u200F🛑 لغو شد." if ok else "\u200Fجاب در حال اجرایی با این شناسه نیست.")
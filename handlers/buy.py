@@ -1,4 +1,5 @@
 # handlers/buy.py
+import asyncio
 from datetime import datetime, timedelta
 
 from aiogram import Router, F, types
@@ -8,13 +9,14 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import settings
 from db.mongo_crud import (
-    get_or_create_user, get_plan_by_code, create_order, get_order,
+    get_or_create_user, get_plan_by_code, get_or_create_open_order, get_order,
     update_order_status,  # برای cancel
     create_payment_request, attach_proof_to_payment,
     get_payment_by_id, get_user_by_id,
     approve_c2c_payment_and_mark_order_paid, reject_c2c_payment,
-    expire_open_payments_for_order, is_admin_db,
+    expire_open_payments_for_order,
 )
+from services.admin_roles import is_admin
 
 router = Router()
 
@@ -180,7 +182,8 @@ async def on_buy_plan(cq: types.CallbackQuery):
     if not plan:
         return await cq.answer("\u200Fپلن نامعتبر یا غیرفعال است.", show_alert=True)
 
-    order = await create_order(user_id=user["_id"], plan_code=plan["code"], amount_toman=plan["price_toman"])
+    # کلیک دوباره/برگشت از change_plan سفارش جدید نمی‌سازد؛ سفارش باز همین پلن برمی‌گردد
+    order = await get_or_create_open_order(user_id=user["_id"], plan_code=plan["code"], amount_toman=plan["price_toman"])
 
     await cq.message.edit_text(
         "\u200F"
@@ -339,7 +342,7 @@ async def receive_c2c_proof(m: types.Message, state: FSMContext):
     )
     admin_kb = build_admin_decision_kb(payment_id)
 
-    for admin_id in admins:
+    async def _notify_admin(admin_id: int):
         try:
             if proof_file_id and m.photo:
                 await m.bot.send_photo(admin_id, proof_file_id, caption=caption, reply_markup=admin_kb)
@@ -351,6 +354,9 @@ async def receive_c2c_proof(m: types.Message, state: FSMContext):
         except Exception:
             pass
 
+    # ارسال موازی به همه ادمین‌ها
+    await asyncio.gather(*[_notify_admin(admin_id) for admin_id in admins])
+
     await m.answer(
         rtl("✅ رسید دریافت شد. پس از بررسی توسط پشتیبانی، اشتراک شما فعال می‌شود. برای تسریع، می‌توانید به پشتیبانی پیام دهید."),
         reply_markup=build_c2c_back_kb(order_id, plan_key)
@@ -359,19 +365,6 @@ async def receive_c2c_proof(m: types.Message, state: FSMContext):
 
 # ===== ادمین: تایید/رد =====
 
-def is_admin(user_id: int) -> bool:
-    # Owner هم ادمین محسوب میشه
-    try:
-        from config import settings
-        if int(user_id) == int(getattr(settings, "OWNER_UID")):
-            return True
-    except Exception:
-        pass
-    # بقیه ادمین‌ها از DB
-    import asyncio
-    return asyncio.get_event_loop().run_until_complete(is_admin_db(user_id))
-
-
 @router.callback_query(F.data.startswith("approve_payment:"))
 async def on_approve_payment(cq: types.CallbackQuery):
     if not is_admin(cq.from_user.id):
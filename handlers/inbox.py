@@ -0,0 +1,142 @@
+# handlers/inbox.py
+from datetime import datetime, timedelta
+
+from aiogram import Router, F, types
+from aiogram.filters import Command, CommandObject
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from db.mongo_crud import count_payments, get_order, get_payment_by_id, get_user_by_id, list_payments_page
+from handlers.buy import build_admin_decision_kb, fmt_price
+from services.admin_roles import is_admin
+from utils.locale import fa_num, fmt_dt, rtl
+
+router = Router()
+
+PAGE_SIZE = 5
+# کد یک‌حرفی وضعیت در callback_data (سقف ۶۴ بایت)
+STATUS_CODES = {"s": "submitted", "p": "pending_proof"}
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _encode_key(doc: dict) -> str:
+    ms = int((doc["created_at"] - _EPOCH) / timedelta(milliseconds=1))
+    return f"{ms}:{doc['_id']}"
+
+
+def _decode_key(ms: str, oid: str) -> tuple[datetime, ObjectId]:
+    # Mongo تاریخ را با دقت میلی‌ثانیه نگه می‌دارد؛ رفت‌وبرگشت دقیق است
+    return _EPOCH + timedelta(milliseconds=int(ms)), ObjectId(oid)
+
+
+def _page_text(status: str, docs: list[dict], total: int) -> str:
+    title = "رسیدهای در انتظار بررسی" if status == "submitted" else "پرداخت‌های بدون رسید"
+    lines = [rtl(f"📥 {title} — <b>{fa_num(total)}</b>"), ""]
+    if not docs:
+        lines.append(rtl("— خالی است ✅"))
+    for n, p in enumerate(docs, 1):
+        proof = (p.get("proofs") or [{}])[-1].get("type", "-")
+        lines.append(rtl(
+            f"{fa_num(n)}) #{str(p['order_id'])[-6:]} — {fmt_price(int(p.get('amount_toman') or 0))}"
+            f" — {fmt_dt(p['created_at'])} — {proof}"
+        ))
+    return "\n".join(lines)
+
+
+def _page_kb(code: str, docs: list[dict], has_prev: bool, has_next: bool) -> types.InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for n, p in enumerate(docs, 1):
+        kb.button(text=f"🔍 {fa_num(n)}", callback_data=f"inbox:v:{p['_id']}")
+    nav = 0
+    if not docs:
+        # صفحه در این فاصله خالی شده (رسیدها بررسی شدند) → ناوبری بی‌معناست
+        has_prev = has_next = False
+    if has_prev:
+        kb.button(text=rtl("⬅️ قبلی"), callback_data=f"inbox:p:{code}:{_encode_key(docs[0])}")
+        nav += 1
+    if has_next:
+        kb.button(text=rtl("بعدی ➡️"), callback_data=f"inbox:n:{code}:{_encode_key(docs[-1])}")
+        nav += 1
+    kb.adjust(*([len(docs)] if docs else []), *([nav] if nav else []))
+    return kb.as_markup()
+
+
+async def _render(code: str, after=None, before=None) -> tuple[str, types.InlineKeyboardMarkup]:
+    status = STATUS_CODES[code]
+    docs, more = await list_payments_page(status, after=after, before=before, limit=PAGE_SIZE)
+    total = await count_payments(status)
+    if before:
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+    return _page_text(status, docs, total), _page_kb(code, docs, has_prev, has_next)
+
+
+@router.message(Command("inbox"))
+async def inbox_cmd(m: types.Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return await m.answer(rtl("⛔ دسترسی ندارید."))
+    # /inbox → رسیدهای ارسال‌شده؛ /inbox pending → پرداخت‌هایی که هنوز رسید ندارند
+    code = "p" if (command.args or "").strip() == "pending" else "s"
+    text, kb = await _render(code)
+    await m.answer(text, reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("inbox:"))
+async def inbox_nav(cq: types.CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        return await cq.answer("اجازه دسترسی ندارید.", show_alert=True)
+    parts = cq.data.split(":")
+
+    if parts[1] == "v":
+        return await _show_payment(cq, parts[2])
+
+    try:
+        code, key = parts[2], _decode_key(parts[3], parts[4])
+    except (IndexError, ValueError, InvalidId):
+        return await cq.answer()
+    if code not in STATUS_CODES:
+        return await cq.answer()
+    if parts[1] == "n":
+        text, kb = await _render(code, after=key)
+    else:
+        text, kb = await _render(code, before=key)
+    try:
+        await cq.message.edit_text(text, reply_markup=kb)
+    except Exception:
+        pass
+    await cq.answer()
+
+
+async def _show_payment(cq: types.CallbackQuery, payment_id: str):
+    try:
+        payment = await get_payment_by_id(payment_id)
+    except InvalidId:
+        payment = None
+    if not payment:
+        return await cq.answer("پرداخت یافت نشد.", show_alert=True)
+
+    order = await get_order(payment["order_id"])
+    user = await get_user_by_id(order["user_id"]) if order else None
+    caption = "\n".join([
+        rtl(f"🧾 رسید — سفارش #{str(payment['order_id'])[-6:]}"),
+        rtl(f"• مبلغ: {fmt_price(int(payment.get('amount_toman') or 0))}"),
+        rtl(f"• وضعیت: {payment['status']}"),
+        rtl(f"• کاربر: @{(user or {}).get('username') or 'بدون‌نام‌کاربری'} ({(user or {}).get('tg_id', '-')})"),
+        rtl(f"• ثبت: {fmt_dt(payment['created_at'])}"),
+    ])
+    kb = build_admin_decision_kb(str(payment["_id"])) if payment["status"] == "submitted" else None
+
+    proof = (payment.get("proofs") or [{}])[-1]
+    try:
+        if proof.get("type") == "photo":
+            await cq.message.answer_photo(proof["file_id"], caption=caption, reply_markup=kb)
+        elif proof.get("type") == "document":
+            await cq.message.answer_document(proof["file_id"], caption=caption, reply_markup=kb)
+        else:
+            extra = ("\n" + rtl(f"متن: {proof['text'][:400]}")) if proof.get("text") else ""
+            await cq.message.answer(caption + extra, reply_markup=kb)
+    except Exception:
+        await cq.message.answer(caption, reply_markup=kb)
+    await cq.answer()
@@ -1,11 +1,30 @@
 # handlers/mysubs.py
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
 from aiogram import Router, types, F
-from db.mongo_crud import get_or_create_user
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from db.mongo_crud import get_or_create_user, get_user_by_tg_id, ensure_sub_token
 from db.mongo import subscriptions_col
+from services.live_usage import live_consumed_bytes
+from services.sub_http import subscription_links_enabled, subscription_url
 from utils.locale import rtl, fa_num, fmt_dt
 
 router = Router()
 
+PAGE_SIZE = 5
+_CACHE_MAX = 10_000
+_EPOCH = datetime(1970, 1, 1)
+
+# sub_id -> (version, بلوک HTML)؛ هر نوشتنی که متن نمایشی را عوض کند version را $inc می‌کند
+_blocks: "OrderedDict[ObjectId, tuple[int, str]]" = OrderedDict()
+# فقط همین فیلدها برای تشخیص hit/miss خوانده می‌شوند؛ سند کامل فقط برای miss
+_HEAD = {"version": 1, "status": 1, "source_plan": 1, "start_at": 1}
+
+
 def _to_links_list(cfg_ref) -> list[str]:
     if not cfg_ref:
         return []
@@ -16,50 +35,160 @@ def _to_links_list(cfg_ref) -> list[str]:
         return [s for s in cfg_ref if isinstance(s, str) and s.strip()]
     return []
 
+
+def _render_block(s: dict) -> str:
+    quota_mb = int(s.get("quota_mb") or 0)
+    used_mb  = int(s.get("used_mb")  or 0)
+    left_mb  = max(0, quota_mb - used_mb)
+    devices  = int(s.get("devices")  or 1)
+    status   = s.get("status") or "unknown"
+
+    # لینک‌ها را به لیست نرمال کنیم
+    links = _to_links_list(s.get("config_ref"))
+
+    # تیتر هر سطر
+    title = s.get("source_plan") or "—"
+    # ساخت متن
+    lines = [
+        rtl(f"• پلن: {title}"),
+        rtl(
+            f"  حجم: {fa_num(quota_mb)} مگ | مصرف: {fa_num(used_mb)} مگ | باقی: {fa_num(left_mb)} مگ"
+        ),
+        rtl(
+            f"  دستگاه: {fa_num(devices)} | وضعیت: {status}"
+        ),
+        rtl(
+            f"  از: {fmt_dt(s['start_at'])} تا: {fmt_dt(s['end_at'])}"
+        ),
+    ]
+
+    if links:
+        lines.append(rtl("  لینک‌ها:"))
+        for i, link in enumerate(links, 1):
+            lines.append(f"{fa_num(i)}) <code>{link}</code>")
+
+    # لینک اشتراک HTTP برای آپدیت خودکار کلاینت
+    if status == "active" and subscription_links_enabled() and s.get("sub_token"):
+        lines.append(rtl("  لینک اشتراک:"))
+        lines.append(f"<code>{subscription_url(s['sub_token'])}</code>")
+
+    return "\n".join(lines)
+
+
+async def _blocks_for(heads: list[dict]) -> list[str]:
+    """بلوک‌های کش‌شده با version فعلی مستقیم؛ بقیه یک‌جا خوانده و دوباره رندر می‌شوند."""
+    stale = [h["_id"] for h in heads if (_blocks.get(h["_id"]) or (None,))[0] != h.get("version", 0)]
+    if stale:
+        async for s in subscriptions_col.find({"_id": {"$in": stale}}):
+            if s.get("status") == "active" and subscription_links_enabled() and not s.get("sub_token"):
+                # اشتراک‌های قدیمی توکن را همین‌جا می‌گیرند (version هم بالا می‌رود)
+                s["sub_token"] = await ensure_sub_token(s["_id"])
+                s["version"] = int(s.get("version", 0)) + 1
+            _blocks[s["_id"]] = (s.get("version", 0), _render_block(s))
+    out = []
+    for h in heads:
+        hit = _blocks.get(h["_id"])
+        if hit:  # بین دو کوئری حذف نشده باشد
+            _blocks.move_to_end(h["_id"])
+            out.append(hit[1])
+    while len(_blocks) > _CACHE_MAX:
+        _blocks.popitem(last=False)
+    return out
+
+
+def _encode_key(doc: dict) -> str:
+    ms = int((doc["start_at"] - _EPOCH) / timedelta(milliseconds=1))
+    return f"{ms}:{doc['_id']}"
+
+
+async def _page(user_id: ObjectId, after: tuple[datetime, ObjectId] | None = None
+                ) -> tuple[str | None, types.InlineKeyboardMarkup | None]:
+    """یک صفحه از اشتراک‌ها، جدیدترین اول؛ کرسر keyset روی (start_at, _id)."""
+    filt: dict = {"user_id": user_id}
+    if after:
+        c, i = after
+        filt = {"$or": [{"user_id": user_id, "start_at": {"$lt": c}},
+                        {"user_id": user_id, "start_at": c, "_id": {"$lt": i}}]}
+    cursor = subscriptions_col.find(filt, _HEAD).sort([("start_at", -1), ("_id", -1)]).limit(PAGE_SIZE + 1)
+    heads = [h async for h in cursor]
+    more = len(heads) > PAGE_SIZE
+    heads = heads[:PAGE_SIZE]
+    if not heads:
+        return None, None
+
+    blocks = await _blocks_for(heads)
+
+    kb = InlineKeyboardBuilder()
+    for n, h in enumerate(heads, 1):
+        if h.get("status") == "active":
+            kb.button(text=rtl(f"🔄 مصرف لحظه‌ای {fa_num(n)} ({h.get('source_plan') or '—'})"),
+                      callback_data=f"usage:{h['_id']}")
+    nav = []
+    if after:
+        nav.append(("🔝 جدیدترین‌ها", "mysubs:f"))
+    if more:
+        nav.append(("قدیمی‌تر ➡️", f"mysubs:n:{_encode_key(heads[-1])}"))
+    for text, data in nav:
+        kb.button(text=rtl(text), callback_data=data)
+    active = sum(1 for h in heads if h.get("status") == "active")
+    kb.adjust(*([1] * active), *([len(nav)] if nav else []))
+    return "\n\n".join(blocks), kb.as_markup()
+
+
 @router.message(F.text == "📦 اشتراک‌های من")
 async def my_subs(m: types.Message):
     user = await get_or_create_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
+    text, kb = await _page(user["_id"])
+    if not text:
+        return await m.answer(rtl("فعلاً اشتراکی نداری. بعد از خرید، اینجا لیست می‌کنیم 📋"))
+    # چون از <code> استفاده می‌کنیم، parse_mode باید HTML باشد
+    await m.answer(text, reply_markup=kb, disable_web_page_preview=True, parse_mode="HTML")
 
-    # آخرین ۵ اشتراک کاربر
-    cursor = subscriptions_col.find({"user_id": user["_id"]}).sort("start_at", -1).limit(5)
-    subs = [s async for s in cursor]
 
-    if not subs:
-        return await m.answer(rtl("فعلاً اشتراکی نداری. بعد از خرید، اینجا لیست می‌کنیم 📋"))
+@router.callback_query(F.data.startswith("mysubs:"))
+async def my_subs_nav(cq: types.CallbackQuery):
+    user = await get_user_by_tg_id(cq.from_user.id)
+    if not user:
+        return await cq.answer()
+    parts = cq.data.split(":")
+    after = None
+    if parts[1] == "n":
+        try:
+            after = (_EPOCH + timedelta(milliseconds=int(parts[2])), ObjectId(parts[3]))
+        except (IndexError, ValueError, InvalidId):
+            return await cq.answer()
+    text, kb = await _page(user["_id"], after)
+    if text:
+        try:
+            await cq.message.edit_text(text, reply_markup=kb, disable_web_page_preview=True, parse_mode="HTML")
+        except Exception:
+            # متن عوض نشده (message is not modified)
+            pass
+    await cq.answer()
 
-    blocks = []
-    for s in subs:
-        quota_mb = int(s.get("quota_mb") or 0)
-        used_mb  = int(s.get("used_mb")  or 0)
-        left_mb  = max(0, quota_mb - used_mb)
-        devices  = int(s.get("devices")  or 1)
-        status   = s.get("status") or "unknown"
-
-        # لینک‌ها را به لیست نرمال کنیم
-        links = _to_links_list(s.get("config_ref"))
-
-        # تیتر هر سطر
-        title = s.get("source_plan") or "—"
-        # ساخت متن
-        lines = [
-            rtl(f"• پلن: {title}"),
-            rtl(
-                f"  حجم: {fa_num(quota_mb)} مگ | مصرف: {fa_num(used_mb)} مگ | باقی: {fa_num(left_mb)} مگ"
-            ),
-            rtl(
-                f"  دستگاه: {fa_num(devices)} | وضعیت: {status}"
-            ),
-            rtl(
-                f"  از: {fmt_dt(s['start_at'])} تا: {fmt_dt(s['end_at'])}"
-            ),
-        ]
-
-        if links:
-            lines.append(rtl("  لینک‌ها:"))
-            for i, link in enumerate(links, 1):
-                lines.append(f"{fa_num(i)}) <code>{link}</code>")
-
-        blocks.append("\n".join(lines))
 
-    # چون از <code> استفاده می‌کنیم، parse_mode باید HTML باشد
-    await m.answer("\n\n".join(blocks), disable_web_page_preview=True, parse_mode="HTML")
+@router.callback_query(F.data.startswith("usage:"))
+async def refresh_usage(cq: types.CallbackQuery):
+    user = await get_user_by_tg_id(cq.from_user.id)
+    try:
+        sub_id = ObjectId(cq.data.split(":", 1)[1])
+    except InvalidId:
+        return await cq.answer()
+    # فقط اشتراک خود کاربر
+    sub = await subscriptions_col.find_one({"_id": sub_id, "user_id": user["_id"]}) if user else None
+    if not sub:
+        return await cq.answer(rtl("اشتراک پیدا نشد."), show_alert=True)
+
+    quota_mb = int(sub.get("quota_mb") or 0)
+    try:
+        used_mb = await live_consumed_bytes(sub) // (1024 * 1024)
+        note = ""
+    except Exception:
+        # Xray در دسترس نیست → آخرین عدد ثبت‌شده
+        used_mb = int(sub.get("used_mb") or 0)
+        note = "\n(آمار لحظه‌ای در دسترس نیست؛ آخرین مقدار ثبت‌شده)"
+    left_mb = max(0, quota_mb - used_mb)
+    await cq.answer(
+        rtl(f"مصرف: {fa_num(used_mb)} مگ از {fa_num(quota_mb)} مگ\nباقی‌مانده: {fa_num(left_mb)} مگ{note}"),
+        show_alert=True,
+    )
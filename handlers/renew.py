@@ -1,28 +1,39 @@
 # handlers/renew.py
 from aiogram import Router, types, F
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from db.mongo_crud import get_or_create_user, get_plan_by_code
+from bson import ObjectId
+from bson.errors import InvalidId
+from db.mongo_crud import get_or_create_open_order, get_or_create_user, get_plan_by_code
 from db.mongo import subscriptions_col
 from utils.locale import rtl, fa_num, fmt_dt
 
 router = Router()
 
-def quick_kb(plan_code: str | None):
+def quick_kb(plan_code: str | None, sub_id: ObjectId | None = None):
     kb = InlineKeyboardBuilder()
     if plan_code:
-        kb.button(text=rtl("🔁 تمدید همین پلن"), callback_data=f"renew:{plan_code}")
+        kb.button(text=rtl("🔁 تمدید همین پلن"), callback_data=f"renew:{plan_code}:{sub_id}")
     kb.button(text=rtl("🛒 مشاهده پلن‌ها"), callback_data="renew:plans")
     kb.adjust(1)
     return kb.as_markup()
 
+async def _renewable_sub(user_id: ObjectId) -> dict | None:
+    """اشتراک فعال؛ وگرنه آخرین اشتراک پولی (منقضی/تعلیق) که با همان لینک‌ها قابل تمدید است."""
+    active = await subscriptions_col.find_one({"user_id": user_id, "status": "active"})
+    if active:
+        return active
+    return await subscriptions_col.find_one(
+        {"user_id": user_id, "source_plan": {"$ne": "trial"}}, sort=[("start_at", -1)]
+    )
+
 @router.message(F.text == "🔁 تمدید سرویس")
 async def renew_handler(m: types.Message):
     user = await get_or_create_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
 
-    active = await subscriptions_col.find_one({"user_id": user["_id"], "status": "active"})
+    active = await _renewable_sub(user["_id"])
     if not active:
         return await m.answer(rtl(
-            "در حال حاضر اشتراک فعالی ندارید.\nاز «🛒 خرید اشتراک» یک پلن انتخاب کنید."
+            "در حال حاضر اشتراکی برای تمدید ندارید.\nاز «🛒 خرید اشتراک» یک پلن انتخاب کنید."
         ))
 
     # اگر از پلن پولی بوده، همون کد رو پیشنهاد بده (trial رو پیشنهاد نده)
@@ -32,18 +43,19 @@ async def renew_handler(m: types.Message):
     text = rtl(
         "🔁 تمدید سرویس:\n\n"
         f"• نوع: {active['source_plan']}\n"
+        f"• وضعیت: {active['status']}\n"
         f"• ظرفیت: {fa_num(active.get('quota_mb', 0))} مگ\n"
         f"• دستگاه: {fa_num(active['devices'])}\n"
         f"• شروع: {fmt_dt(active['start_at'])}\n"
         f"• پایان: {fmt_dt(active['end_at'])}\n"
         "یکی از گزینه‌ها را انتخاب کنید:"
     )
-    await m.answer(text, reply_markup=quick_kb(plan_code))
+    await m.answer(text, reply_markup=quick_kb(plan_code, active["_id"]))
 
 # اکشن‌های تمدید
 @router.callback_query(F.data.startswith("renew:"))
 async def renew_actions(cq: types.CallbackQuery):
-    cmd = cq.data.split(":", 1)[1]
+    _, cmd, *rest = cq.data.split(":")
     if cmd == "plans":
         # ارجاع به لیست پلن‌ها (همون هندلر خریدت)
         await cq.message.edit_text(rtl("در حال انتقال به فهرست پلن‌ها…"))
@@ -58,9 +70,37 @@ async def renew_actions(cq: types.CallbackQuery):
     if not plan:
         await cq.answer(rtl("پلن قابل تمدید یافت نشد."), show_alert=True)
         return
-    # اینجا می‌تونی مستقیم سفارش تمدید بسازی یا ببری به فلو خرید همان پلن
-    from handlers.buy import build_plan_actions_kb
+
+    # سفارش تمدید: بعد از پرداخت همان اشتراک تمدید می‌شود (provision.renew_subscription)
+    user = await get_or_create_user(cq.from_user.id, cq.from_user.username, cq.from_user.first_name)
+    sub = None
+    try:
+        if rest:
+            sub = await subscriptions_col.find_one({"_id": ObjectId(rest[0]), "user_id": user["_id"]})
+    except InvalidId:
+        pass
+    if sub is None:
+        # دکمه‌های قدیمی بدون شناسهٔ اشتراک
+        sub = await _renewable_sub(user["_id"])
+
+    from handlers.buy import build_after_order_kb, build_plan_actions_kb
+    if not sub or sub.get("source_plan") == "trial":
+        await cq.message.edit_text(
+            rtl(f"تمدید پلن «{plan['title']}»"), reply_markup=build_plan_actions_kb(plan["code"])
+        )
+        return await cq.answer()
+
+    order = await get_or_create_open_order(
+        user_id=user["_id"], plan_code=plan["code"], amount_toman=plan["price_toman"], renew_sub_id=sub["_id"]
+    )
     await cq.message.edit_text(
-        rtl(f"تمدید پلن «{plan['title']}»"), reply_markup=build_plan_actions_kb(plan["code"])
+        rtl(
+            f"🔁 سفارش تمدید ثبت شد (#{str(order['_id'])[-6:]})\n"
+            f"• پلن: {plan['title']}\n"
+            f"• مبلغ: {fa_num(format(plan['price_toman'], ','))} ت\n\n"
+            "بعد از تایید پرداخت، همین اشتراک تمدید می‌شود و لینک‌هایتان تغییری نمی‌کند.\n"
+            "روش پرداخت را انتخاب کنید:"
+        ),
+        reply_markup=build_after_order_kb(str(order["_id"]), plan["code"])
     )
     await cq.answer()
@@ -1,12 +1,16 @@
 # handlers/trial.py
+import asyncio
 from datetime import datetime, timedelta
 
 from aiogram import Router, types, F
-from aiogram.types import BufferedInputFile, InputMediaPhoto
+from aiogram.types import InputMediaPhoto
+from bson import ObjectId
 
 from db.mongo import subscriptions_col
-from db.mongo_crud import get_or_create_user
-from services.qrcode_gen import make_qr_png_bytes
+from db.mongo_crud import claim_trial, finish_trial_claim, get_or_create_user, new_sub_token
+from services.account_index import register_subscription, trial_account_email
+from services.qr_delivery import qr_media, remember_file_id
+from services.xray_runner import run_xray
 from services.xray_service import add_client
 
 
@@ -45,7 +49,7 @@ def _fmt_trial_msg(links: list[str], end_at: datetime) -> str:
     return "\n".join(lines)
 
 
-async def _ensure_trial_links(user_id: int, sub_id, dev_count: int) -> tuple[list[str], list[dict]]:
+async def _ensure_trial_links(sub_id, dev_count: int) -> tuple[list[str], list[dict]]:
     """
     مطمئن می‌شود برای اشتراک تِست، به تعداد devices لینک/UUID وجود دارد.
     اگر نبود، می‌سازد و در DB ذخیره می‌کند.
@@ -76,8 +80,8 @@ async def _ensure_trial_links(user_id: int, sub_id, dev_count: int) -> tuple[lis
     made_new = False
     while len(links) < dev_count:
         i = len(links) + 1
-        email = f"trial-{user_id}-{i}@bot"
-        uuid_str, vless_link = add_client(email)
+        email = trial_account_email(sub_id, i)
+        uuid_str, vless_link = await run_xray(add_client, email)
         links.append(vless_link)
         accounts.append({"email": email, "uuid": uuid_str})
         made_new = True
@@ -85,7 +89,7 @@ async def _ensure_trial_links(user_id: int, sub_id, dev_count: int) -> tuple[lis
     if made_new:
         await subscriptions_col.update_one(
             {"_id": sub_id},
-            {"$set": {"config_ref": links, "xray": accounts}}
+            {"$set": {"config_ref": links, "xray": accounts}, "$inc": {"version": 1}}
         )
     return links, accounts
 
@@ -96,6 +100,8 @@ async def _send_links_with_qr(m: types.Message, links: list[str], end_at: dateti
       - اگر 0 لینک: فقط متن
       - اگر 1 لینک: send_photo
       - اگر >=2 لینک: media_group
+    QRها از services.qr_delivery می‌آیند: اگر قبلاً آپلود شده‌اند با file_id
+    (بدون رندر و آپلود)، وگرنه PNG کش‌شده/رندرشده روی ترد جدا.
     """
     caption = _fmt_trial_msg(links, end_at)
 
@@ -103,50 +109,103 @@ async def _send_links_with_qr(m: types.Message, links: list[str], end_at: dateti
         await m.answer(caption, parse_mode="HTML")
         return
 
-    # ساخت QRهای همه لینک‌ها
-    photos: list[InputMediaPhoto] = []
-    pngs: list[bytes] = []
-    for link in links:
-        try:
-            pngs.append(make_qr_png_bytes(link))
-        except Exception:
-            pngs.append(None)
-
-    if len(links) == 1:
-        # یک عکس
-        if pngs[0]:
-            await m.answer_photo(
-                photo=BufferedInputFile(pngs[0], filename="trial_1.png"),
-                caption=caption,
-                parse_mode="HTML"
-            )
-        else:
-            await m.answer(caption, parse_mode="HTML")
+    # ورودی عکس برای همه لینک‌ها (file_id یا PNG یا None)
+    medias = await asyncio.gather(*[
+        qr_media(link, f"trial_{idx}.png") for idx, link in enumerate(links, 1)
+    ])
+    valid = [(link, media) for link, media in zip(links, medias) if media]
+
+    if not valid:
+        # اگر QR تولید نشد، حداقل کپشن متن را بفرستیم
+        await m.answer(caption, parse_mode="HTML")
+        return
+
+    if len(valid) == 1:
+        # اگر به هر دلیلی فقط یک آیتم معتبر شد، تک‌عکس بفرستیم نه مدیاگروپ
+        link, media = valid[0]
+        msg = await m.answer_photo(photo=media, caption=caption, parse_mode="HTML")
+        remember_file_id(link, msg)
         return
 
     # گروه (حداقل ۲)
-    for idx, (link, png) in enumerate(zip(links, pngs), 1):
-        if png:
-            photos.append(InputMediaPhoto(
-                media=BufferedInputFile(png, filename=f"trial_{idx}.png"),
-                caption=caption if idx == 1 else None,
-                parse_mode="HTML"
-            ))
-        else:
-            # اگر QR تولید نشد، حداقل کپشن متن را جدا بفرستیم (یک‌بار)
-            if idx == 1:
-                await m.answer(caption, parse_mode="HTML")
-
-    if photos:
-        # اگر به هر دلیلی فقط یک آیتم معتبر شد، باز هم باید تک‌عکس بفرستیم نه مدیاگروپ
-        if len(photos) == 1:
-            await m.answer_photo(
-                photo=photos[0].media,
-                caption=caption,
-                parse_mode="HTML"
-            )
-        else:
-            await m.answer_media_group(photos)
+    photos = [
+        InputMediaPhoto(
+            media=media,
+            caption=caption if idx == 0 else None,
+            parse_mode="HTML"
+        )
+        for idx, (_, media) in enumerate(valid)
+    ]
+    msgs = await m.answer_media_group(photos)
+    for (link, _), msg in zip(valid, msgs or []):
+        remember_file_id(link, msg)
+
+
+# تپ‌های هم‌زمان یک کاربر روی یک عملیات ساخت سوار می‌شوند (کلید: users._id)
+_inflight: dict[ObjectId, asyncio.Task] = {}
+
+
+async def _issue_trial(user_id: ObjectId) -> tuple[str, dict | None]:
+    """
+    خروجی: ("new" | "existing", sub) یا ("used", sub | None) یا ("busy", None)
+    استحقاق با claim اتمیک در trial_claims تعیین می‌شود؛ فقط برندهٔ claim سراغ Xray می‌رود.
+    """
+    now = datetime.utcnow()
+    won, claim = await claim_trial(user_id, ObjectId())
+    if not won:
+        if claim.get("status") == "provisioning":
+            return "busy", None
+        sub = await subscriptions_col.find_one({"_id": claim.get("sub_id")})
+        if sub and sub.get("status") == "active" and sub["end_at"] > now:
+            return "existing", sub
+        return "used", sub
+
+    # تست قدیمی (قبل از trial_claims) یا درج‌شده قبل از کرش: claim را به آن وصل کن
+    # sort هم‌جهت با ایندکس (user_id, source_plan, status, end_at): active قبل از expired/suspended
+    prior = await subscriptions_col.find_one(
+        {"user_id": user_id, "source_plan": "trial"}, sort=[("status", 1), ("end_at", 1)]
+    )
+    if prior:
+        await finish_trial_claim(user_id, "issued", prior["_id"])
+        if prior.get("status") == "active" and prior["end_at"] > now:
+            return "existing", prior
+        return "used", prior
+
+    sub_id = claim["sub_id"]  # از قبل، تا ایمیل حساب‌ها از شناسهٔ اشتراک ساخته شود
+    dev_count = int(TRIAL_CONF["devices"])
+    try:
+        links: list[str] = []
+        accounts: list[dict] = []
+        for i in range(dev_count):
+            email = trial_account_email(sub_id, i + 1)
+            uuid_str, vless_link = await run_xray(add_client, email)
+            links.append(vless_link)
+            accounts.append({"email": email, "uuid": uuid_str})
+
+        sub_doc = {
+            "_id": sub_id,
+            "user_id": user_id,
+            "order_id": None,
+            "source_plan": "trial",
+            "trial_of": user_id,  # ایندکس یکتا: حداکثر یک تست به ازای کاربر
+            "quota_mb": TRIAL_CONF["quota_mb"],
+            "used_mb": 0,
+            "devices": dev_count,
+            "start_at": now,
+            "end_at": now + timedelta(hours=TRIAL_CONF["hours"]),
+            "status": "active",
+            "config_ref": links,  # لیست لینک‌ها
+            "xray": accounts,  # لیست ایمیل/UUID
+            "sub_token": new_sub_token(),  # لینک اشتراک HTTP
+        }
+        await subscriptions_col.insert_one(sub_doc)
+    except Exception:
+        await finish_trial_claim(user_id, "failed")
+        raise
+
+    await finish_trial_claim(user_id, "issued", sub_id)
+    register_subscription(sub_doc)
+    return "new", sub_doc
 
 
 @router.message(F.text == "🧪 اکانت تست")
@@ -156,45 +215,31 @@ async def trial_handler(m: types.Message):
         username=m.from_user.username,
         first_name=m.from_user.first_name,
     )
-
-    now = datetime.utcnow()
-    dev_count = int(TRIAL_CONF["devices"])
-
-    # اگر قبلاً تست فعال دارد و تمام نشده، همان را نشان بده (و در صورت نیاز لینک‌ها را کامل کن)
-    existed = await subscriptions_col.find_one({
-        "user_id": user["_id"],
-        "source_plan": "trial",
-        "status": "active",
-        "end_at": {"$gt": now},
-    })
-    if existed:
-        links, _ = await _ensure_trial_links(m.from_user.id, existed["_id"], dev_count)
-        await _send_links_with_qr(m, links, existed["end_at"])
-        return
-
-    # ساخت تِست جدید
-    end_at = now + timedelta(hours=TRIAL_CONF["hours"])
-    links: list[str] = []
-    accounts: list[dict] = []
-    for i in range(dev_count):
-        email = f"trial-{m.from_user.id}-{i + 1}@bot"
-        uuid_str, vless_link = add_client(email)
-        links.append(vless_link)
-        accounts.append({"email": email, "uuid": uuid_str})
-
-    sub_doc = {
-        "user_id": user["_id"],
-        "order_id": None,
-        "source_plan": "trial",
-        "quota_mb": TRIAL_CONF["quota_mb"],
-        "used_mb": 0,
-        "devices": dev_count,
-        "start_at": now,
-        "end_at": end_at,
-        "status": "active",
-        "config_ref": links,  # لیست لینک‌ها
-        "xray": accounts,  # لیست ایمیل/UUID
-    }
-    await subscriptions_col.insert_one(sub_doc)
-
-    await _send_links_with_qr(m, links, end_at)
+    uid = user["_id"]
+
+    task = _inflight.get(uid)
+    if task is None:
+        task = asyncio.create_task(_issue_trial(uid))
+        _inflight[uid] = task
+        task.add_done_callback(lambda _t: _inflight.pop(uid, None))
+
+    try:
+        # shield: لغو یک هندلر، ساختِ مشترک بقیه را لغو نکند
+        kind, sub = await asyncio.shield(task)
+    except Exception:
+        return await m.answer(rtl("⚠️ ساخت اکانت تست با خطا مواجه شد؛ چند دقیقهٔ دیگر دوباره تلاش کنید."))
+
+    if kind == "busy":
+        return await m.answer(rtl("⏳ اکانت تست شما در حال ساخت است؛ چند لحظهٔ دیگر دوباره امتحان کنید."))
+    if kind == "used":
+        return await m.answer(rtl(
+            "⛔ شما قبلاً از اکانت تست استفاده کرده‌اید.\n"
+            "برای ادامه از «🛒 خرید اشتراک» یک پلن انتخاب کنید."
+        ))
+
+    if kind == "existing":
+        # اگر قبلاً تست فعال دارد و تمام نشده، همان را نشان بده (و در صورت نیاز لینک‌ها را کامل کن)
+        links, _ = await _ensure_trial_links(sub["_id"], int(TRIAL_CONF["devices"]))
+    else:
+        links = sub["config_ref"]
+    await _send_links_with_qr(m, links, sub["end_at"])
@@ -1,31 +1,68 @@
 # main.py
 import asyncio
 import signal
+import time
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 
 from config import settings
-from db.mongo import ensure_indexes
+from db.fsm_storage import build_fsm_storage
 from db.mongo_crud import ensure_default_plans
 from db.schema import ensure_collections_and_validators
-from handlers import admin_manage, debug
+from handlers import admin_manage, broadcast, debug, inbox
 from handlers import start, trial, buy, renew, wallet, mysubs, help as help_h, support
+from middlewares.ordering import ChatSerialMiddleware, QueueWaitMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+from services.account_index import account_index_loop, warm_account_index
+from services.admin_roles import admin_refresh_loop, refresh_admins
+from services.broadcast import broadcast_resume_loop
+from services.compactor import compaction_loop
+from services.device_enforcer import device_limit_loop
 from services.enforcer import expire_loop
 from services.quota_enforcer import quota_loop
+from services.stats import stats_loop
+from services.sub_http import run_subscription_server
+from services.sweeper import sweeper_loop
+from services.webhook import run_webhook
 
 
 async def main():
     bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    # اگر قبلاً وبهوک بوده، قطعش کن و پیام‌های معوقه رو نادیده بگیر
-    await bot.delete_webhook(drop_pending_updates=True)
 
-    # دیتابیس و اسکیمای اولیه
-    await ensure_collections_and_validators()
-    await ensure_indexes()
-    await ensure_default_plans()
+    # دیتابیس و اسکیمای اولیه (اگر hash اسکیما عوض نشده باشد validator/ایندکس رد می‌شود)
+    t_start = time.perf_counter()
+    timings = await ensure_collections_and_validators()
 
-    dp = Dispatcher()
+    # مراحل مستقل هم‌زمان؛ پلن‌ها بعد از اسکیما چون به validator/ایندکس یکتای code تکیه دارند
+    async def _timed(name, coro):
+        t0 = time.perf_counter()
+        try:
+            await coro
+        finally:
+            timings[name] = time.perf_counter() - t0
+
+    await asyncio.gather(
+        _timed("default_plans", ensure_default_plans()),
+        _timed("admins", refresh_admins()),
+        _timed("account_index", warm_account_index()),
+    )
+    breakdown = ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items())
+    print(f"⏱ startup {(time.perf_counter() - t_start) * 1000:.0f}ms ({breakdown})")
+
+    # FSM پایدار تا چک‌اوت نیمه‌کاره با ری‌استارت/چند رپلیکا از دست نرود
+    dp = Dispatcher(storage=build_fsm_storage())
+
+    # اجرای هم‌زمان با ترتیب حفظ‌شده برای هر چت + زمان انتظار هر هندلر
+    dp.update.outer_middleware(ChatSerialMiddleware(settings.UPDATE_CONCURRENCY))
+    queue_wait = QueueWaitMiddleware()
+    dp.message.middleware(queue_wait)
+    dp.callback_query.middleware(queue_wait)
+
+    # ضد فلود (یک نمونه برای پیام و callback تا سطل‌ها مشترک باشند)
+    throttling = ThrottlingMiddleware()
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
 
     # Routers
     dp.include_router(start.router)
@@ -37,21 +74,35 @@ async def main():
     dp.include_router(help_h.router)
     dp.include_router(support.router)
     dp.include_router(admin_manage.router)
+    dp.include_router(inbox.router)
+    dp.include_router(broadcast.router)
     dp.include_router(debug.router)
 
+    # هندل سیگنال برای توقف تمیز
+    stop_event = asyncio.Event()
+
+    def _stop(*_):
+        stop_event.set()
+
     # تسک‌های پس‌زمینه
     bg_tasks = [
         asyncio.create_task(expire_loop(), name="expire_loop"),
         asyncio.create_task(quota_loop(bot), name="quota_loop"),
+        asyncio.create_task(admin_refresh_loop(), name="admin_refresh_loop"),
+        asyncio.create_task(account_index_loop(), name="account_index_loop"),
+        asyncio.create_task(device_limit_loop(bot), name="device_limit_loop"),
+        asyncio.create_task(compaction_loop(bot), name="compaction_loop"),
+        asyncio.create_task(sweeper_loop(), name="sweeper_loop"),
+        asyncio.create_task(stats_loop(), name="stats_loop"),
+        # ارسال‌های همگانی نیمه‌کاره (lease منقضی) از آخرین checkpoint ادامه پیدا می‌کنند
+        asyncio.create_task(broadcast_resume_loop(bot), name="broadcast_resume_loop"),
     ]
 
-    print("🤖 Bot is running...")
-
-    # هندل سیگنال برای توقف تمیز
-    stop_event = asyncio.Event()
+    if settings.SUB_HTTP_ENABLED and settings.RUN_MODE != "webhook":
+        # در حالت webhook روی همان سرور وبهوک سرو می‌شود
+        bg_tasks.append(asyncio.create_task(run_subscription_server(stop_event), name="sub_http"))
 
-    def _stop(*_):
-        stop_event.set()
+    print(f"🤖 Bot is running ({settings.RUN_MODE})...")
 
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
@@ -61,14 +112,20 @@ async def main():
             # روی ویندوز ممکنه در دسترس نباشه
             pass
 
-    # polling
     try:
-        await dp.start_polling(bot, allowed_updates=None)
+        if settings.RUN_MODE == "webhook":
+            # وبهوک: چند رپلیکا پشت لودبالانسر، تخلیهٔ تمیز روی SIGTERM
+            await run_webhook(bot, dp, stop_event)
+        else:
+            # اگر قبلاً وبهوک بوده، قطعش کن و پیام‌های معوقه رو نادیده بگیر
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, allowed_updates=None, handle_as_tasks=True)
     finally:
         # توقف تمیز تسک‌ها
         for t in bg_tasks:
             t.cancel()
         await asyncio.gather(*bg_tasks, return_exceptions=True)
+        await dp.storage.close()
         await bot.session.close()
 
 
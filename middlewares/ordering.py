@@ -0,0 +1,77 @@
+# middlewares/ordering.py
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# handler name -> {"count", "total", "max"} (ثانیه)؛ برای /metrics
+QUEUE_WAIT: dict[str, dict[str, float]] = {}
+
+
+class ChatSerialMiddleware(BaseMiddleware):
+    """
+    اجرای هم‌زمان آپدیت‌ها با دو قید:
+      - آپدیت‌های یک چت به ترتیب و پشت سر هم (FSM به‌هم نریزد)
+      - حداکثر `limit` آپدیت در کل هم‌زمان در حال اجرا
+    روی dp.update به‌صورت outer ثبت می‌شود؛ polling/webhook هر آپدیت را به‌صورت task می‌فرستند.
+    """
+
+    def __init__(self, limit: int):
+        self._sem = asyncio.Semaphore(max(1, int(limit)))
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._refs: Counter = Counter()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat else (user.id if user else None)
+
+        t0 = time.monotonic()
+        if key is None:
+            async with self._sem:
+                data["queue_wait"] = time.monotonic() - t0
+                return await handler(event, data)
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] += 1
+        try:
+            # اول قفل چت، بعد اسلات سراسری؛ چتِ در صف اسلاتی اشغال نمی‌کند
+            async with lock:
+                async with self._sem:
+                    data["queue_wait"] = time.monotonic() - t0
+                    return await handler(event, data)
+        finally:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._refs[key]
+                self._locks.pop(key, None)
+
+
+class QueueWaitMiddleware(BaseMiddleware):
+    """زمان انتظار در صف (از ChatSerialMiddleware) را به تفکیک هندلر جمع می‌زند."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        wait = data.get("queue_wait")
+        handler_obj = data.get("handler")
+        if wait is not None and handler_obj is not None:
+            name = getattr(handler_obj.callback, "__name__", "?")
+            st = QUEUE_WAIT.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            st["count"] += 1
+            st["total"] += wait
+            st["max"] = max(st["max"], wait)
+        return await handler(event, data)
@@ -0,0 +1,112 @@
+# middlewares/throttling.py
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from services.admin_roles import is_admin
+
+# کلاس‌های اکشن: ظرفیت سطل و تعداد توکن در ثانیه
+THROTTLE_RULES = {
+    # DB write / provision Xray / reload کانفیگ / کوئری مصرف لحظه‌ای
+    "expensive": {"capacity": 3, "rate": 1 / 5},
+    # بقیه: منو، برگشت، متن‌های ساده
+    "cheap": {"capacity": 10, "rate": 2.0},
+}
+
+EXPENSIVE_TEXTS = {"🧪 اکانت تست", "📦 اشتراک‌های من", "🔁 تمدید سرویس"}
+EXPENSIVE_CALLBACK_PREFIXES = ("buy:", "pay_c2c:", "renew:", "cancel_order:", "usage:")
+
+# شمارندهٔ رویدادهای رد شده به تفکیک کلاس (برای /metrics)
+THROTTLED: Counter = Counter()
+
+_MAX_BUCKETS = 50_000
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, capacity: float):
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.warned = False
+
+    def take(self, capacity: float, rate: float) -> bool:
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+
+def classify(event: TelegramObject) -> str:
+    if isinstance(event, CallbackQuery):
+        data = event.data or ""
+        return "expensive" if data.startswith(EXPENSIVE_CALLBACK_PREFIXES) else "cheap"
+    if isinstance(event, Message):
+        return "expensive" if (event.text or "") in EXPENSIVE_TEXTS else "cheap"
+    return "cheap"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    ضد فلود با token bucket درون‌حافظه‌ای برای هر (کاربر، کلاس اکشن).
+    درخواست رد شده هیچ کاری با DB ندارد؛ callback فوراً جواب می‌گیرد.
+    """
+
+    def __init__(self):
+        self._buckets: dict[tuple[int, str], _Bucket] = {}
+
+    def _bucket(self, uid: int, action: str) -> _Bucket:
+        key = (uid, action)
+        b = self._buckets.get(key)
+        if b is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                self._prune()
+            b = self._buckets[key] = _Bucket(THROTTLE_RULES[action]["capacity"])
+        return b
+
+    def _prune(self) -> None:
+        # سطل‌هایی که دیگر پر شده‌اند هیچ اطلاعاتی ندارند
+        now = time.monotonic()
+        for key in list(self._buckets):
+            rule = THROTTLE_RULES[key[1]]
+            b = self._buckets[key]
+            if b.tokens + (now - b.updated) * rule["rate"] >= rule["capacity"]:
+                del self._buckets[key]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or is_admin(user.id):
+            return await handler(event, data)
+
+        action = classify(event)
+        rule = THROTTLE_RULES[action]
+        bucket = self._bucket(user.id, action)
+        if bucket.take(rule["capacity"], rule["rate"]):
+            return await handler(event, data)
+
+        THROTTLED[action] += 1
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer("\u200F⏳ کمی صبر کنید…")
+            except Exception:
+                pass
+        elif not bucket.warned:
+            # فقط یک‌بار در هر دورهٔ فلود هشدار بده
+            bucket.warned = True
+            try:
+                await event.answer("\u200F⏳ درخواست‌ها خیلی سریع است؛ چند ثانیه صبر کنید.")
+            except Exception:
+                pass
+        return None
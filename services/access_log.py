@@ -0,0 +1,209 @@
+# services/access_log.py
+# دنبال کردن access log ایکس‌ری و نگه‌داشتن IPهای هر ایمیل در یک پنجرهٔ زمانی.
+# عمداً به config/DB وابسته نیست تا بنچمارک بدون محیط ربات اجرا شود:
+#   python -m services.access_log bench /var/log/xray/access.log --repeat 5
+#   python -m services.access_log bench --lines 500000   (بدون مسیر: لاگ نمونهٔ ساختگی با seed ثابت)
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+# نمونه خط‌ها (بسته به نسخهٔ Xray):
+#   2024/05/01 10:00:00 1.2.3.4:5678 accepted tcp:example.com:443 [vless-ws >> direct] email: abc-1@bot
+#   2024/05/01 10:00:00.123456 from 1.2.3.4:5678 accepted tcp:example.com:443 [vless-ws -> direct] email: abc-1@bot
+#   2024/05/01 10:00:00 from [2001:db8::1]:5678 accepted udp:1.1.1.1:53 [vless-ws >> direct] email: abc-1@bot
+_SRC_RE = re.compile(r" (?:from )?(?:tcp:|udp:)?\[?([0-9A-Fa-f.:]+?)\]?:\d+ accepted ")
+
+_EMAIL_SEP = " email: "
+
+
+def parse_line(line: str) -> tuple[str, str] | None:
+    """(email, ip) یا None. مسیر سریع: خط‌های بدون accepted/email بدون regex رد می‌شوند."""
+    if " accepted " not in line:
+        return None
+    head, sep, email = line.rpartition(_EMAIL_SEP)
+    if not sep:
+        return None
+    m = _SRC_RE.search(head)
+    if not m:
+        return None
+    return email.strip(), m.group(1)
+
+
+class LogTailer:
+    """
+    خواندن افزایشی فایل لاگ با نگه‌داشتن offset.
+    چرخش لاگ (inode جدید) و truncate (اندازهٔ کوچک‌تر از offset) تشخیص داده می‌شود.
+    inotify در stdlib نیست؛ فراخواننده هر ثانیه read_lines را صدا می‌زند و stat ارزان است.
+    """
+
+    def __init__(self, path: str, from_start: bool = False):
+        self.path = path
+        self._fh = None
+        self._ino: int | None = None
+        self._partial = b""
+        self._eof = True
+        self._from_start = from_start
+
+    def _open(self, st: os.stat_result, seek_end: bool) -> None:
+        if self._fh:
+            self._fh.close()
+        self._fh = open(self.path, "rb")
+        self._ino = st.st_ino
+        self._partial = b""
+        if seek_end:
+            self._fh.seek(0, os.SEEK_END)
+
+    def read_lines(self, max_bytes: int = 4 * 1024 * 1024) -> list[str]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+
+        out: list[bytes] = []
+        if self._fh is None:
+            self._open(st, seek_end=not self._from_start)
+        elif st.st_ino != self._ino:
+            # چرخش: فایل قدیمی تا انتها (در هر فراخوانی حداکثر max_bytes) خوانده می‌شود،
+            # بعد خط نیمه‌کارهٔ آخرش و سپس فایل جدید از ابتدا
+            out.extend(self._drain(max_bytes))
+            if not self._eof:
+                return [b.decode("utf-8", "replace") for b in out]
+            if self._partial:
+                out.append(self._partial)
+            self._open(st, seek_end=False)
+        elif st.st_size < self._fh.tell():
+            # truncate (copytruncate در logrotate)
+            self._fh.seek(0)
+            self._partial = b""
+
+        out.extend(self._drain(max_bytes))
+        return [b.decode("utf-8", "replace") for b in out]
+
+    def _drain(self, max_bytes: int) -> list[bytes]:
+        data = self._fh.read(max_bytes)
+        self._eof = len(data) < max_bytes
+        if not data:
+            return []
+        data = self._partial + data
+        lines = data.split(b"\n")
+        # آخرین تکه ممکن است نیمه‌کاره باشد
+        self._partial = lines.pop()
+        return lines
+
+    def close(self) -> None:
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+
+
+class DeviceWindow:
+    """
+    برای هر ایمیل: IP → آخرین زمان دیده‌شدن، فقط در window_sec ثانیهٔ اخیر.
+    حافظه محدود است: حداکثر max_ips IP برای هر ایمیل (قدیمی‌ترین دور ریخته می‌شود).
+    """
+
+    def __init__(self, window_sec: float = 600, max_ips: int = 32):
+        self.window_sec = float(window_sec)
+        self.max_ips = int(max_ips)
+        self._seen: dict[str, dict[str, float]] = {}
+
+    def observe(self, email: str, ip: str, now: float) -> None:
+        ips = self._seen.get(email)
+        if ips is None:
+            ips = self._seen[email] = {}
+        elif ip not in ips and len(ips) >= self.max_ips:
+            del ips[min(ips, key=ips.get)]
+        ips[ip] = now
+
+    def ips(self, email: str, now: float) -> set[str]:
+        cutoff = now - self.window_sec
+        return {ip for ip, ts in self._seen.get(email, {}).items() if ts >= cutoff}
+
+    def prune(self, now: float) -> None:
+        cutoff = now - self.window_sec
+        for email in list(self._seen):
+            ips = self._seen[email]
+            for ip in [ip for ip, ts in ips.items() if ts < cutoff]:
+                del ips[ip]
+            if not ips:
+                del self._seen[email]
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+# ===== Benchmark =====
+def _generate(path: str, lines: int, emails: int = 2000, seed: int = 1) -> None:
+    """
+    لاگ نمونه با هر سه قالب خط بالا (IPv4/IPv6) و ~۱۰٪ خط بی‌ربط (DNS، rejected)؛
+    هر ایمیل از چند IP ثابت وصل می‌شود تا پنجره شبیه ترافیک واقعی پر شود.
+    """
+    rnd = random.Random(seed)
+    pool = [[f"10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(1, 255)}"
+             for _ in range(rnd.randint(1, 4))] for _ in range(emails)]
+    with open(path, "w") as f:
+        for i in range(lines):
+            ts = f"2024/05/01 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}"
+            r = rnd.random()
+            if r < 0.1:
+                f.write(f"{ts} [Info] app/dns: UDP:1.1.1.1:53 got answer: example.com. -> [93.184.216.34]\n")
+                continue
+            n = rnd.randrange(emails)
+            ip = rnd.choice(pool[n])
+            port = rnd.randrange(1024, 65536)
+            if r < 0.15:
+                src = f"from [2001:db8::{n:x}]:{port}"
+            elif r < 0.6:
+                src = f"from {ip}:{port}"
+            else:
+                src = f"{ip}:{port}"
+            f.write(f"{ts} {src} accepted tcp:example.com:443 [vless-ws >> direct] email: {n:06d}-1@bot\n")
+
+
+def _bench(path: str, repeat: int = 1) -> None:
+    """لاگ ضبط‌شده را از طریق parser + پنجره بازپخش می‌کند و throughput را چاپ می‌کند."""
+    with open(path, "rb") as f:
+        raw = [b.decode("utf-8", "replace") for b in f.read().split(b"\n")]
+
+    window = DeviceWindow()
+    matched = 0
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        now = time.monotonic()
+        for line in raw:
+            parsed = parse_line(line)
+            if parsed:
+                matched += 1
+                window.observe(parsed[0], parsed[1], now)
+    window.prune(time.monotonic())
+    dt = time.perf_counter() - t0
+
+    total = len(raw) * repeat
+    size_mb = os.path.getsize(path) * repeat / (1024 * 1024)
+    print(f"lines:    {total}")
+    print(f"matched:  {matched}")
+    print(f"emails:   {len(window)}")
+    print(f"elapsed:  {dt:.3f}s")
+    print(f"rate:     {total / dt:,.0f} lines/s  ({size_mb / dt:,.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0] != "bench":
+        print("usage: python -m services.access_log bench [<access.log>] [--repeat N] [--lines N]")
+        sys.exit(2)
+    rep = int(args[args.index("--repeat") + 1]) if "--repeat" in args else 1
+    if len(args) > 1 and not args[1].startswith("--"):
+        _bench(args[1], rep)
+    else:
+        n = int(args[args.index("--lines") + 1]) if "--lines" in args else 200_000
+        fd, sample = tempfile.mkstemp(prefix="xray-access-", suffix=".log")
+        os.close(fd)
+        try:
+            _generate(sample, n)
+            _bench(sample, rep)
+        finally:
+            os.remove(sample)
@@ -0,0 +1,108 @@
+# services/account_index.py
+import asyncio
+import base64
+
+from bson import ObjectId
+
+from db.mongo import subscriptions_col
+
+# ===== شناسهٔ حساب Xray =====
+# ایمیل‌های قدیمی از ۶ کاراکتر آخر ObjectId ساخته می‌شدند و امکان تصادم داشتند.
+# حالا کل ۱۲ بایت ObjectId با base32 (۲۰ کاراکتر، فقط a-z2-7) فشرده می‌شود: یکتا و کوتاه.
+
+
+def compact_id(oid: ObjectId | str) -> str:
+    raw = ObjectId(str(oid)).binary
+    return base64.b32encode(raw).decode().rstrip("=").lower()
+
+
+def paid_account_email(order_id: ObjectId | str, i: int) -> str:
+    """ایمیل حساب دستگاه i ام یک سفارش پولی (یکتا به ازای سفارش)."""
+    return f"{compact_id(order_id)}-{i}@bot"
+
+
+def trial_account_email(sub_id: ObjectId | str, i: int) -> str:
+    """ایمیل حساب دستگاه i ام یک اشتراک تست (یکتا به ازای اشتراک)."""
+    return f"t{compact_id(sub_id)}-{i}@bot"
+
+
+# ===== ایندکس معکوس email → subscription =====
+# فقط اشتراک‌های active؛ برای نسبت دادن آمار/لاگ Xray بدون کوئری DB
+
+_email_to_sub: dict[str, ObjectId] = {}
+_sub_emails: dict[ObjectId, tuple[str, ...]] = {}
+_sub_devices: dict[ObjectId, int] = {}
+
+
+def _emails_of(sub: dict) -> list[str]:
+    x = sub.get("xray") or []
+    if isinstance(x, dict):
+        return [x["email"]] if x.get("email") else []
+    return [xi["email"] for xi in x if xi and xi.get("email")]
+
+
+def register_subscription(sub: dict) -> None:
+    """بعد از ساخت/فعال‌سازی اشتراک صدا زده می‌شود."""
+    emails = _emails_of(sub)
+    if not emails:
+        return
+    sub_id = sub["_id"]
+    # حساب‌هایی که از اشتراک حذف شده‌اند (مثلاً تمدید با دستگاه کمتر) دیگر به آن نسبت داده نشوند
+    for em in _sub_emails.get(sub_id, ()):
+        if em not in emails and _email_to_sub.get(em) == sub_id:
+            del _email_to_sub[em]
+    _sub_emails[sub_id] = tuple(emails)
+    _sub_devices[sub_id] = int(sub.get("devices") or len(emails))
+    for em in emails:
+        _email_to_sub[em] = sub_id
+
+
+def forget_subscription(sub_id: ObjectId) -> None:
+    """بعد از تعلیق/انقضا."""
+    for em in _sub_emails.pop(sub_id, ()):
+        if _email_to_sub.get(em) == sub_id:
+            del _email_to_sub[em]
+    _sub_devices.pop(sub_id, None)
+
+
+def sub_for_email(email: str) -> ObjectId | None:
+    return _email_to_sub.get(email)
+
+
+def emails_for_sub(sub_id: ObjectId) -> tuple[str, ...]:
+    return _sub_emails.get(sub_id, ())
+
+
+def devices_for_sub(sub_id: ObjectId) -> int:
+    return _sub_devices.get(sub_id, 1)
+
+
+async def warm_account_index() -> int:
+    """کل ایندکس را از اشتراک‌های active می‌سازد و یکجا جایگزین می‌کند."""
+    global _email_to_sub, _sub_emails, _sub_devices
+    email_to_sub: dict[str, ObjectId] = {}
+    sub_emails: dict[ObjectId, tuple[str, ...]] = {}
+    sub_devices: dict[ObjectId, int] = {}
+
+    cursor = subscriptions_col.find({"status": "active"}, {"xray.email": 1, "devices": 1})
+    async for sub in cursor:
+        emails = _emails_of(sub)
+        if not emails:
+            continue
+        sub_emails[sub["_id"]] = tuple(emails)
+        sub_devices[sub["_id"]] = int(sub.get("devices") or len(emails))
+        for em in emails:
+            email_to_sub[em] = sub["_id"]
+
+    _email_to_sub, _sub_emails, _sub_devices = email_to_sub, sub_emails, sub_devices
+    return len(sub_emails)
+
+
+async def account_index_loop(interval_sec: int = 600):
+    """بازسازی دوره‌ای (برای تغییراتی که در رپلیکای دیگر رخ داده)."""
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            await warm_account_index()
+        except Exception:
+            pass
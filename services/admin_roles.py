@@ -0,0 +1,39 @@
+# services/admin_roles.py
+import asyncio
+
+from config import settings
+from db.mongo import admins_col
+
+# ادمین‌های .env (ADMIN_CHAT_IDS)؛ اولین آیتم Root است
+ROOT_IDS: frozenset[int] = frozenset(int(x) for x in settings.ADMIN_CHAT_IDS)
+ROOT_ADMIN_ID: int | None = int(settings.ADMIN_CHAT_IDS[0]) if settings.ADMIN_CHAT_IDS else None
+
+# ادمین‌های جدول admins؛ با refresh_admins کل مجموعه یکجا جایگزین می‌شود
+_db_admins: frozenset[int] = frozenset()
+
+
+def is_root_admin(uid: int) -> bool:
+    """RootAdmin = اولین آیتمِ ADMIN_CHAT_IDS در .env"""
+    return ROOT_ADMIN_ID is not None and int(uid) == ROOT_ADMIN_ID
+
+
+def is_admin(uid: int) -> bool:
+    """ادمین = یکی از ADMIN_CHAT_IDS یا داخل جدول admins (بدون کوئری DB)."""
+    uid = int(uid)
+    return uid in ROOT_IDS or uid in _db_admins
+
+
+async def refresh_admins() -> None:
+    """مجموعهٔ ادمین‌های DB را از نو می‌خواند (بعد از add/remove و به‌صورت دوره‌ای)."""
+    global _db_admins
+    _db_admins = frozenset([int(d["uid"]) async for d in admins_col.find({}, {"uid": 1})])
+
+
+async def admin_refresh_loop(interval_sec: int = 300):
+    """همگام‌سازی دوره‌ای؛ برای تغییراتی که از رپلیکای دیگر یا مستقیم در DB انجام شده."""
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            await refresh_admins()
+        except Exception:
+            pass
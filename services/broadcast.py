@@ -0,0 +1,200 @@
+# services/broadcast.py
+import asyncio
+import os
+import socket
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from db.mongo import broadcasts_col, users_col
+
+# تلگرام حدود ۳۰ پیام در ثانیه به چت‌های مختلف اجازه می‌دهد؛ کمی پایین‌تر می‌مانیم
+BROADCAST_RATE = 25
+# تعداد کاربرانی که در هر رفت‌وبرگشت از DB خوانده می‌شوند
+BATCH_SIZE = 200
+# هر جاب فقط در یک رپلیکا اجرا می‌شود: مالک (OWNER) تا lease_until، که در هر checkpoint تمدید می‌شود.
+# اگر رپلیکا بمیرد، بعد از انقضای lease رپلیکای دیگری جاب را از آخرین checkpoint برمی‌دارد.
+LEASE_SEC = 120
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+_running: dict[ObjectId, asyncio.Task] = {}
+
+
+async def start_broadcast(
+    bot: Bot,
+    created_by: int,
+    text: str | None = None,
+    from_chat_id: int | None = None,
+    message_id: int | None = None,
+) -> ObjectId:
+    """
+    جاب ارسال همگانی می‌سازد و اجرا می‌کند.
+    یا text ساده، یا (from_chat_id, message_id) برای copy_message (عکس/فایل هم پشتیبانی می‌شود).
+    """
+    now = datetime.utcnow()
+    doc = {
+        "status": "running",
+        "owner": OWNER,
+        "lease_until": now + timedelta(seconds=LEASE_SEC),
+        "created_by": created_by,
+        "created_at": now,
+        "updated_at": now,
+        "text": text,
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "last_user_id": None,   # کرسر: آخرین users._id پردازش‌شده
+        "delivered": 0,
+        "blocked": 0,
+        "failed": 0,
+    }
+    res = await broadcasts_col.insert_one(doc)
+    _spawn(bot, res.inserted_id)
+    return res.inserted_id
+
+
+async def _claim(job_id: ObjectId) -> dict | None:
+    """lease جاب را اتمیک می‌گیرد (اگر آزاد/منقضی است یا مال خودمان است)."""
+    now = datetime.utcnow()
+    return await broadcasts_col.find_one_and_update(
+        {"_id": job_id, "status": "running",
+         "$or": [{"owner": OWNER}, {"lease_until": {"$not": {"$gt": now}}}]},
+        {"$set": {"owner": OWNER, "lease_until": now + timedelta(seconds=LEASE_SEC)}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def resume_broadcasts(bot: Bot) -> int:
+    """
+    جاب‌های running که lease آن‌ها منقضی شده (رپلیکای مالک مرده/ری‌استارت شده) را
+    از آخرین checkpoint ادامه می‌دهد؛ ادعای واقعی داخل _run_job با _claim است.
+    """
+    n = 0
+    now = datetime.utcnow()
+    async for job in broadcasts_col.find(
+        {"status": "running", "lease_until": {"$not": {"$gt": now}}}, {"_id": 1}
+    ):
+        _spawn(bot, job["_id"])
+        n += 1
+    return n
+
+
+async def broadcast_resume_loop(bot: Bot, interval_sec: int = LEASE_SEC):
+    """جاب‌های بی‌صاحب را دوره‌ای برمی‌دارد (نه فقط هنگام استارت)."""
+    while True:
+        try:
+            await resume_broadcasts(bot)
+        except Exception:
+            # اجازه نمی‌دهیم لوپ از کار بیفتد
+            pass
+        await asyncio.sleep(interval_sec)
+
+
+async def cancel_broadcast(job_id: ObjectId | str) -> bool:
+    res = await broadcasts_col.update_one(
+        {"_id": ObjectId(str(job_id)), "status": "running"},
+        {"$set": {"status": "canceled", "updated_at": datetime.utcnow()}}
+    )
+    return res.modified_count > 0
+
+
+async def list_broadcasts(limit: int = 5) -> list[dict]:
+    cursor = broadcasts_col.find({}).sort("created_at", -1).limit(limit)
+    return [doc async for doc in cursor]
+
+
+def _spawn(bot: Bot, job_id: ObjectId) -> None:
+    if job_id in _running and not _running[job_id].done():
+        return
+    task = asyncio.create_task(_run_job(bot, job_id), name=f"broadcast-{job_id}")
+    _running[job_id] = task
+    task.add_done_callback(lambda _t: _running.pop(job_id, None))
+
+
+async def _send_one(bot: Bot, job: dict, chat_id: int) -> str:
+    """ارسال به یک کاربر؛ خروجی: delivered | blocked | failed"""
+    for _ in range(2):
+        try:
+            if job.get("message_id"):
+                await bot.copy_message(chat_id, job["from_chat_id"], job["message_id"])
+            else:
+                await bot.send_message(chat_id, job["text"])
+            return "delivered"
+        except TelegramRetryAfter as e:
+            # فلود کنترل تلگرام: صبر و یک‌بار دیگر
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception:
+            return "failed"
+    return "failed"
+
+
+async def _run_job(bot: Bot, job_id: ObjectId) -> None:
+    job = await _claim(job_id)
+    if not job:
+        # رپلیکای دیگری مالک است یا جاب تمام/لغو شده
+        return
+
+    last_id = job.get("last_user_id")
+    while True:
+        # لغو از طرف ادمین (یا رپلیکای دیگر) بین هر بچ چک می‌شود
+        cur = await broadcasts_col.find_one({"_id": job_id}, {"status": 1})
+        if not cur or cur.get("status") != "running":
+            return
+
+        filt = {"_id": {"$gt": last_id}} if last_id else {}
+        cursor = users_col.find(filt, {"tg_id": 1}).sort("_id", 1).limit(BATCH_SIZE)
+        batch = [u async for u in cursor]
+        if not batch:
+            break
+
+        # هر تکه = حداکثر BROADCAST_RATE پیام در یک ثانیه
+        for i in range(0, len(batch), BROADCAST_RATE):
+            chunk = batch[i:i + BROADCAST_RATE]
+            started = time.monotonic()
+            results = await asyncio.gather(*[
+                _send_one(bot, job, int(u["tg_id"])) for u in chunk if u.get("tg_id") is not None
+            ])
+            counts = Counter(results)
+            last_id = chunk[-1]["_id"]
+            # checkpoint بعد از هر تکه (+ تمدید lease)؛ بعد از ری‌استارت حداکثر یک تکه تکرار می‌شود
+            now = datetime.utcnow()
+            res = await broadcasts_col.update_one(
+                {"_id": job_id, "owner": OWNER},
+                {"$set": {"last_user_id": last_id, "updated_at": now,
+                          "lease_until": now + timedelta(seconds=LEASE_SEC)},
+                 "$inc": {k: counts.get(k, 0) for k in ("delivered", "blocked", "failed")}}
+            )
+            if not res.matched_count:
+                # lease از دست رفته (مثلاً مکث طولانی)؛ رپلیکای دیگر ادامه می‌دهد
+                return
+            elapsed = time.monotonic() - started
+            if elapsed < 1:
+                await asyncio.sleep(1 - elapsed)
+
+    res = await broadcasts_col.update_one(
+        {"_id": job_id, "status": "running", "owner": OWNER},
+        {"$set": {"status": "done", "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()}}
+    )
+    if not res.modified_count:
+        # لغو شده یا مالک دیگری دارد؛ گزارش پایان فقط یک‌بار و از طرف مالک
+        return
+
+    done = await broadcasts_col.find_one({"_id": job_id})
+    if done and done.get("created_by"):
+        try:
+            await bot.send_message(
+                int(done["created_by"]),
+                "\u200F📣 ارسال همگانی تمام شد.\n"
+                f"• موفق: {done.get('delivered', 0)}\n"
+                f"• بلاک‌کرده: {done.get('blocked', 0)}\n"
+                f"• خطا: {done.get('failed', 0)}"
+            )
+        except Exception:
+            pass
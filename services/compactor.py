@@ -0,0 +1,83 @@
+# services/compactor.py
+import asyncio
+from datetime import datetime
+
+from aiogram import Bot
+
+from config import settings
+from db.mongo import subscriptions_col
+from services.admin_roles import ROOT_ADMIN_ID
+from services.xray_runner import run_xray
+from services.xray_service import compact_clients, list_client_emails
+from utils.locale import TEHRAN
+
+# کمتر از این تعداد کلاینت اضافه ارزش یک reload را ندارد
+MIN_STALE_CLIENTS = 20
+
+_last_run_day: str | None = None
+
+
+async def _active_emails() -> set[str]:
+    cursor = subscriptions_col.find({"status": "active"}, {"xray.email": 1})
+    emails: set[str] = set()
+    async for s in cursor:
+        x = s.get("xray") or []
+        if isinstance(x, dict):
+            x = [x]
+        emails.update(xi["email"] for xi in x if xi and xi.get("email"))
+    return emails
+
+
+def format_compaction_report(r: dict) -> str:
+    return (
+        "\u200F🧹 فشرده‌سازی کانفیگ Xray\n"
+        f"• کلاینت‌ها: {r['clients_before']} → {r['clients_after']}\n"
+        f"• حجم فایل: {r['size_before'] // 1024}KB → {r['size_after'] // 1024}KB"
+    )
+
+
+async def run_compaction() -> dict:
+    """کلاینت‌های بدون اشتراک active را از فایل حذف می‌کند و گزارش برمی‌گرداند."""
+    keep = await _active_emails()
+    report = await run_xray(compact_clients, keep, critical=False)
+    print(
+        f"🧹 xray compaction: clients {report['clients_before']} -> {report['clients_after']}, "
+        f"size {report['size_before']} -> {report['size_after']} bytes"
+    )
+    return report
+
+
+async def compaction_loop(bot: Bot, interval_sec: int = 600):
+    """
+    هر interval_sec ثانیه بررسی می‌کند:
+      - ساعت خلوت (XRAY_COMPACT_HOUR به وقت تهران، روزی یک‌بار)، یا
+      - سهم کلاینت‌های بی‌اشتراک ≥ XRAY_COMPACT_STALE_RATIO
+    """
+    global _last_run_day
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            now = datetime.now(TEHRAN)
+            today = now.strftime("%Y-%m-%d")
+            quiet = now.hour == int(settings.XRAY_COMPACT_HOUR) and _last_run_day != today
+
+            keep = await _active_emails()
+            in_file = await run_xray(list_client_emails, critical=False)
+            stale = len({e for e in in_file if e.endswith("@bot")} - keep)
+            ratio = stale / len(in_file) if in_file else 0.0
+
+            if stale < MIN_STALE_CLIENTS and not (quiet and stale):
+                continue
+            if not quiet and ratio < float(settings.XRAY_COMPACT_STALE_RATIO):
+                continue
+
+            report = await run_compaction()
+            _last_run_day = today
+            if ROOT_ADMIN_ID is not None:
+                try:
+                    await bot.send_message(ROOT_ADMIN_ID, format_compaction_report(report))
+                except Exception:
+                    pass
+        except Exception:
+            # اجازه نمی‌دهیم لوپ از کار بیفتد
+            pass
@@ -0,0 +1,131 @@
+# services/device_enforcer.py
+import asyncio
+import time
+from datetime import datetime
+
+from aiogram import Bot
+
+from config import settings
+from db.mongo import subscriptions_col, users_col
+from services.access_log import DeviceWindow, LogTailer, parse_line
+from services.account_index import devices_for_sub, emails_for_sub, forget_subscription, sub_for_email
+from services.sub_http import invalidate_subscription_bundle
+from services.xray_runner import run_xray
+from services.xray_service import remove_client
+
+# هر چند ثانیه یک‌بار اشتراک‌های لمس‌شده بررسی می‌شوند
+CHECK_EVERY_SEC = 30
+# هر اشتراک حداکثر یک‌بار در این بازه گزارش می‌شود
+FLAG_COOLDOWN_SEC = 3600
+
+_last_flagged: dict = {}
+
+
+def _read_batch(tailer: LogTailer) -> list[tuple[str, str]]:
+    """خواندن + پارس در ترد جدا (IO و CPU روی event loop نباشد)."""
+    out = []
+    for line in tailer.read_lines():
+        parsed = parse_line(line)
+        if parsed:
+            out.append(parsed)
+    return out
+
+
+async def _notify_admins(bot: Bot, text: str) -> None:
+    for admin_id in settings.ADMIN_CHAT_IDS:
+        try:
+            await bot.send_message(int(admin_id), text)
+        except Exception:
+            pass
+
+
+async def _handle_violation(bot: Bot, sub_id, ip_count: int, allowed: int) -> None:
+    now = time.monotonic()
+    if now - _last_flagged.get(sub_id, -FLAG_COOLDOWN_SEC) < FLAG_COOLDOWN_SEC:
+        return
+    _last_flagged[sub_id] = now
+
+    violation = {"ips": ip_count, "allowed": allowed, "at": datetime.utcnow()}
+    suspend = settings.DEVICE_LIMIT_ACTION == "suspend"
+
+    if suspend:
+        emails = list(emails_for_sub(sub_id))
+        await asyncio.gather(*[run_xray(remove_client, em) for em in emails], return_exceptions=True)
+        before = await subscriptions_col.find_one_and_update(
+            {"_id": sub_id, "status": "active"},
+            {"$set": {"status": "suspended", "suspend_reason": "device_limit", "device_violation": violation},
+             "$inc": {"version": 1}},
+            projection={"sub_token": 1},
+        )
+        forget_subscription(sub_id)
+        invalidate_subscription_bundle((before or {}).get("sub_token"))
+    else:
+        await subscriptions_col.update_one({"_id": sub_id}, {"$set": {"device_violation": violation}})
+
+    await _notify_admins(
+        bot,
+        "\u200F🚨 استفادهٔ بیش از حد دستگاه\n"
+        f"• اشتراک: {sub_id}\n"
+        f"• IP متمایز در {settings.DEVICE_WINDOW_SEC // 60} دقیقه: {ip_count} (مجاز: {allowed})\n"
+        f"• اقدام: {'تعلیق' if suspend else 'فقط گزارش'}"
+    )
+
+    if suspend:
+        sub = await subscriptions_col.find_one({"_id": sub_id}, {"user_id": 1})
+        user = await users_col.find_one({"_id": sub["user_id"]}, {"tg_id": 1}) if sub else None
+        if user and user.get("tg_id") is not None:
+            try:
+                await bot.send_message(
+                    int(user["tg_id"]),
+                    "\u200F⛔ اشتراک شما به‌دلیل اتصال هم‌زمان بیش از تعداد دستگاه مجاز تعلیق شد.\n"
+                    "برای بررسی با پشتیبانی در تماس باشید."
+                )
+            except Exception:
+                pass
+
+
+async def device_limit_loop(bot: Bot, interval_sec: float = 1.0):
+    """
+    access log را دنبال می‌کند و برای هر اشتراک، IPهای متمایز همه ایمیل‌هایش را
+    در DEVICE_WINDOW_SEC اخیر با devices + DEVICE_IP_TOLERANCE مقایسه می‌کند.
+    """
+    if not settings.XRAY_ACCESS_LOG:
+        return
+
+    tailer = LogTailer(settings.XRAY_ACCESS_LOG)
+    window = DeviceWindow(settings.DEVICE_WINDOW_SEC)
+    touched: set[str] = set()
+    next_check = time.monotonic() + CHECK_EVERY_SEC
+
+    try:
+        while True:
+            try:
+                batch = await asyncio.to_thread(_read_batch, tailer)
+                now = time.monotonic()
+                for email, ip in batch:
+                    window.observe(email, ip, now)
+                    touched.add(email)
+
+                if now >= next_check:
+                    next_check = now + CHECK_EVERY_SEC
+                    window.prune(now)
+                    for k in [k for k, t in _last_flagged.items() if now - t >= FLAG_COOLDOWN_SEC]:
+                        del _last_flagged[k]
+                    subs = {sub_for_email(em) for em in touched}
+                    touched.clear()
+                    for sub_id in subs:
+                        if sub_id is None:
+                            continue
+                        ips: set[str] = set()
+                        for em in emails_for_sub(sub_id):
+                            ips |= window.ips(em, now)
+                        allowed = devices_for_sub(sub_id) + int(settings.DEVICE_IP_TOLERANCE)
+                        if len(ips) > allowed:
+                            await _handle_violation(bot, sub_id, len(ips), allowed)
+            except Exception:
+                # اجازه نمی‌دهیم لوپ از کار بیفتد
+                pass
+
+            await asyncio.sleep(interval_sec)
+    finally:
+        tailer.close()
@@ -2,6 +2,9 @@
 import asyncio
 from datetime import datetime, timezone
 from db.mongo import subscriptions_col
+from services.account_index import forget_subscription
+from services.sub_http import invalidate_subscription_bundle
+from services.xray_runner import run_xray
 from services.xray_service import remove_client
 
 async def expire_loop(interval_sec: int = 180):
@@ -24,14 +27,16 @@ async def expire_loop(interval_sec: int = 180):
 
             for em in emails:
                 try:
-                    remove_client(em)
+                    await run_xray(remove_client, em)
                 except Exception:
                     pass
 
             await subscriptions_col.update_one(
                 {"_id": s["_id"]},
-                {"$set": {"status": "expired"}}
+                {"$set": {"status": "expired"}, "$inc": {"version": 1}}
             )
+            forget_subscription(s["_id"])
+            invalidate_subscription_bundle(s.get("sub_token"))
             count += 1
 
         await asyncio.sleep(interval_sec)
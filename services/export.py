@@ -0,0 +1,151 @@
+# services/export.py
+# خروجی حسابداری: سفارش‌ها / پرداخت‌ها / مصرف اشتراک‌ها به CSV یا JSONL فشرده (gzip).
+#   python -m services.export orders --since 2026-01-01 --until 2026-02-01 --format csv --out orders.csv.gz
+# اسناد به‌صورت جریانی (cursor با batch_size) خوانده و بچ‌به‌بچ نوشته می‌شوند؛ کل کالکشن در حافظه نمی‌آید.
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from config import settings
+from db.mongo import orders_col, payments_col, subscriptions_col
+from utils.locale import TEHRAN
+
+# kind -> (کالکشن، فیلد تاریخ دارای ایندکس برای بازه، ستون‌ها)
+# ستون‌ها همان projection هستند؛ فیلدهای نقطه‌دار (xray.email و ...) عمداً نیامده‌اند.
+EXPORTS = {
+    "orders": (orders_col, "created_at",
+               ["_id", "user_id", "plan_code", "amount_toman", "status", "created_at", "paid_at", "renew_sub_id"]),
+    "payments": (payments_col, "created_at",
+                 ["_id", "order_id", "amount_toman", "status", "created_at", "due_at", "reviewed_at"]),
+    "usage": (subscriptions_col, "start_at",
+              ["_id", "user_id", "source_plan", "status", "start_at", "end_at",
+               "quota_mb", "used_mb", "consumed_bytes", "devices"]),
+}
+FORMATS = ("csv", "jsonl")
+
+
+def _cell(v):
+    if isinstance(v, ObjectId):
+        return str(v)
+    if isinstance(v, datetime):
+        # تاریخ‌ها در DB به UTC (naive) ذخیره شده‌اند
+        return v.replace(tzinfo=timezone.utc).isoformat()
+    return v
+
+
+class _Writer:
+    """نویسندهٔ gzip؛ متدهایش در ترد جدا اجرا می‌شوند تا فشرده‌سازی event loop را نگیرد."""
+
+    def __init__(self, path: str, fmt: str, columns: list[str]):
+        self.fmt = fmt
+        self.columns = columns
+        self._f = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.writer(self._f)
+            self._csv.writerow(columns)
+
+    def write(self, docs: list[dict]) -> None:
+        for d in docs:
+            row = [_cell(d.get(c)) for c in self.columns]
+            if self._csv:
+                self._csv.writerow(["" if v is None else v for v in row])
+            else:
+                self._f.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n")
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def tehran_day(s: str) -> datetime:
+    """«YYYY-MM-DD» (روز تهران) → ابتدای آن روز به UTC naive، هم‌شکل تاریخ‌های DB."""
+    d = datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=TEHRAN)
+    return d.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def export_to_file(kind: str, fmt: str, since: datetime | None, until: datetime | None,
+                         path: str | None = None) -> tuple[str, int]:
+    """
+    بازهٔ [since, until) روی فیلد تاریخِ ایندکس‌دار را به فایل gzip می‌نویسد.
+    خروجی: (مسیر فایل، تعداد ردیف). اگر path ندهید فایل موقت ساخته می‌شود (حذفش با صدازننده است).
+    """
+    col, date_field, columns = EXPORTS[kind]
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}")
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix=f"{kind}-", suffix=f".{fmt}.gz")
+        os.close(fd)
+
+    rng = {}
+    if since:
+        rng["$gte"] = since
+    if until:
+        rng["$lt"] = until
+    # بدون بازه هم روی همان ایندکس پیمایش می‌کنیم (sort روی فیلد تاریخ) تا خروجی مرتب باشد
+    filt = {date_field: rng} if rng else {}
+    batch_size = int(settings.EXPORT_BATCH_SIZE)
+    cursor = (
+        col.find(filt, {c: 1 for c in columns})
+        .sort(date_field, 1)
+        .batch_size(batch_size)
+    )
+
+    writer = await asyncio.to_thread(_Writer, path, fmt, columns)
+    rows = 0
+    chunk: list[dict] = []
+    try:
+        async for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) >= batch_size:
+                await asyncio.to_thread(writer.write, chunk)
+                rows += len(chunk)
+                chunk = []
+        if chunk:
+            await asyncio.to_thread(writer.write, chunk)
+            rows += len(chunk)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return path, rows
+
+
+def parse_range(arg: str) -> tuple[datetime | None, datetime | None]:
+    """
+    «30» → ۳۰ روز اخیر؛ «2026-01-01..2026-02-01» → بازهٔ روزهای تهران (پایان انحصاری)؛
+    «2026-01-01..» → از آن روز تا الان.
+    """
+    if ".." in arg:
+        a, b = arg.split("..", 1)
+        return (tehran_day(a) if a else None), (tehran_day(b) if b else None)
+    days = int(arg)
+    if days <= 0:
+        raise ValueError("days must be positive")
+    return datetime.utcnow() - timedelta(days=days), None
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="streaming gzip export of orders / payments / usage")
+    ap.add_argument("kind", choices=sorted(EXPORTS))
+    ap.add_argument("--since", help="YYYY-MM-DD (Tehran day, inclusive)")
+    ap.add_argument("--until", help="YYYY-MM-DD (Tehran day, exclusive)")
+    ap.add_argument("--format", choices=FORMATS, default="csv")
+    ap.add_argument("--out", help="output path (default: <kind>-<today>.<format>.gz)")
+    args = ap.parse_args(argv)
+
+    since = tehran_day(args.since) if args.since else None
+    until = tehran_day(args.until) if args.until else None
+    out = args.out or f"{args.kind}-{datetime.now(TEHRAN):%Y-%m-%d}.{args.format}.gz"
+    path, rows = asyncio.run(export_to_file(args.kind, args.format, since, until, out))
+    print(f"wrote {rows} rows to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
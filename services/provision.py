@@ -4,11 +4,27 @@ from aiogram import Bot
 from bson import ObjectId
 
 from db.mongo import subscriptions_col, plans_col, orders_col, users_col
-from services.xray_service import add_client
+from db.mongo_crud import new_sub_token
+from services.account_index import paid_account_email, register_subscription
+from services.xray_runner import run_xray
+from services.reactivation import reactivate_subscription, stored_accounts
+from services.xray_service import add_client, remove_client
 from services.links import vless_ws_link  # سازنده لینک یکدست و تمیز
+from services.sub_http import subscription_url
+from utils.locale import fmt_dt
 from config import settings               # تا XRAY_* را از .env بخوانیم
 
 
+def _device_link(uuid_str: str, user: dict, n: int) -> str:
+    # مقادیر اتصال از .env / settings
+    host     = getattr(settings, "XRAY_HOST", getattr(settings, "XRAY_DOMAIN", "127.0.0.1"))
+    port     = int(getattr(settings, "XRAY_PORT", 8081))
+    ws_path  = getattr(settings, "XRAY_WS_PATH", "/ws8081")
+    security = getattr(settings, "XRAY_SECURITY", "none")
+    tag = f"{(user.get('username') or str(user.get('tg_id') or 'user')).replace('@','')}-{n}"
+    return vless_ws_link(uuid_str, host, port, ws_path, security, tag)
+
+
 async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
     # --- اعتبارسنجی سفارش/کاربر/پلن ---
     order = await orders_col.find_one({"_id": ObjectId(str(order_id))})
@@ -23,6 +39,12 @@ async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
     if not plan:
         return False
 
+    # --- تمدید درجا: همان اشتراک، همان حساب‌ها و لینک‌ها ---
+    if order.get("renew_sub_id"):
+        sub = await subscriptions_col.find_one({"_id": order["renew_sub_id"], "user_id": user["_id"]})
+        if sub and sub.get("source_plan") != "trial":
+            return await renew_subscription(sub, order, plan, user, bot)
+
     # --- تعداد دستگاه ---
     dev_count = int(plan.get("devices", 1))
 
@@ -30,22 +52,15 @@ async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
     links: list[str] = []
     xray_accounts: list[dict] = []
 
-    # مقادیر اتصال از .env / settings
-    host     = getattr(settings, "XRAY_HOST", getattr(settings, "XRAY_DOMAIN", "127.0.0.1"))
-    port     = int(getattr(settings, "XRAY_PORT", 8081))
-    ws_path  = getattr(settings, "XRAY_WS_PATH", "/ws8081")
-    security = getattr(settings, "XRAY_SECURITY", "none")
-
     for i in range(dev_count):
         # ایمیل یکتا برای آمار و مدیریت
-        email = f"{str(user['_id'])[-6:]}-{str(order['_id'])[-6:]}-{i+1}@bot"
+        email = paid_account_email(order["_id"], i + 1)
 
         # add_client: یوزر را به Xray اضافه می‌کند و UUID می‌دهد
-        uuid_str, _unused_link = add_client(email)
+        uuid_str, _unused_link = await run_xray(add_client, email)
 
         # لینک استاندارد و تمیز با سازنده‌ی مشترک
-        tag = f"{(user.get('username') or str(user.get('tg_id') or 'user')).replace('@','')}-{i+1}"
-        link = vless_ws_link(uuid_str, host, port, ws_path, security, tag)
+        link = _device_link(uuid_str, user, i + 1)
 
         links.append(link)
         xray_accounts.append({"email": email, "uuid": uuid_str})
@@ -64,8 +79,10 @@ async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
         "status": "active",
         "config_ref": links,      # لیست لینک‌ها
         "xray": xray_accounts,    # ایمیل/UUID برای مدیریت و آمار
+        "sub_token": new_sub_token(),  # لینک اشتراک HTTP
     }
     await subscriptions_col.insert_one(sub_doc)
+    register_subscription(sub_doc)
 
     # --- ارسال لینک‌ها به کاربر ---
     tg_id = user.get("tg_id")
@@ -82,6 +99,9 @@ async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
         ]
         for idx, link in enumerate(links, 1):
             lines.append(f"{idx}) <code>{link}</code>")
+        sub_url = subscription_url(sub_doc["sub_token"])
+        if sub_url:
+            lines.append(f"• لینک اشتراک (آپدیت خودکار): <code>{sub_url}</code>")
         lines.append("")
         lines.append("راهنما: هر دستگاه از یکی از لینک‌ها استفاده کند.")
 
@@ -97,3 +117,86 @@ async def provision_paid_order(order_id: ObjectId, bot: Bot) -> bool:
             pass
 
     return True
+
+
+async def renew_subscription(sub: dict, order: dict, plan: dict, user: dict, bot: Bot) -> bool:
+    """
+    تمدید درجا با reactivate_subscription: end_at جلو می‌رود، حجم اضافه (اشتراک فعال) یا ریست
+    (منقضی/تعلیق) می‌شود و همان ایمیل/UUIDها دوباره فعال می‌شوند؛ بدون reload و بدون لینک جدید.
+    دستگاه اضافهٔ پلن جدید (اگر بیشتر باشد) تنها جایی است که add_client لازم می‌شود؛
+    اگر پلن جدید دستگاه کمتری دارد، حساب‌های اضافه (آخرین‌ها) حذف می‌شوند.
+    """
+    now = datetime.utcnow()
+    was_active = sub.get("status") == "active" and sub["end_at"] > now
+    plan_mb = int(plan["gb"]) * 1024
+
+    accounts = stored_accounts(sub)
+    links = sub.get("config_ref") or []
+    links = [links] if isinstance(links, str) else list(links)
+    plan_devices = int(plan.get("devices", 1))
+
+    # --- پلن با دستگاه کمتر: لینک i ام مال حساب i ام است؛ اضافه‌ها کنار می‌روند ---
+    dropped = accounts[plan_devices:]
+    accounts = accounts[:plan_devices]
+    links = links[:plan_devices]
+
+    # --- دستگاه‌های اضافه (فقط اگر پلن جدید دستگاه بیشتری دارد) ---
+    new_links: list[str] = []
+    for i in range(len(accounts), plan_devices):
+        email = paid_account_email(order["_id"], i + 1)
+        uuid_str, _ = await run_xray(add_client, email)
+        accounts.append({"email": email, "uuid": uuid_str})
+        new_links.append(_device_link(uuid_str, user, i + 1))
+    links.extend(new_links)
+
+    renewed = await reactivate_subscription(
+        {**sub, "xray": accounts},
+        extend_days=int(plan["days"]),
+        # اشتراک فعال: باقی‌ماندهٔ حجم حفظ می‌شود؛ منقضی/تعلیق: از نو
+        add_quota_mb=plan_mb if was_active else 0,
+        quota_mb=None if was_active else plan_mb,
+        reset_usage=not was_active,
+        extra_set={
+            "source_plan": plan["code"],
+            "devices": len(accounts),
+            "config_ref": links,
+            "renewed_at": now,
+        },
+        # هر سفارش فقط یک‌بار اعمال می‌شود (تایید تکراری ادمین)
+        extra_filter={"renewals.order_id": {"$ne": order["_id"]}},
+        push={"renewals": {"order_id": order["_id"], "plan": plan["code"], "at": now}},
+    )
+    if not renewed:
+        return True
+
+    # بعد از ثبت تمدید، تا اگر تمدید اعمال نشد دستگاه‌های فعلی قطع نشوند
+    for acc in dropped:
+        try:
+            await run_xray(remove_client, acc["email"])
+        except Exception as e:
+            print(f"⚠️ renew: remove extra device {acc['email']} failed: {e!r}")
+
+    tg_id = user.get("tg_id")
+    if tg_id is not None:
+        lines = [
+            "\u200F",
+            "🔁 اشتراک شما تمدید شد.",
+            "",
+            f"• پلن: {plan['title']}",
+            f"• حجم کل: {renewed['quota_mb'] // 1024} گیگ / دستگاه: {renewed['devices']}",
+            f"• پایان: {fmt_dt(renewed['end_at'])}",
+            "",
+            "لینک‌های قبلی شما بدون تغییر کار می‌کنند؛ نیازی به تنظیم دوباره نیست.",
+        ]
+        if dropped:
+            lines.append(f"• پلن جدید {plan_devices} دستگاهی است؛ لینک دستگاه‌های بعد از {plan_devices} غیرفعال شد.")
+        if new_links:
+            lines.append("• لینک دستگاه‌های جدید:")
+            for idx, link in enumerate(new_links, len(links) - len(new_links) + 1):
+                lines.append(f"{idx}) <code>{link}</code>")
+        try:
+            await bot.send_message(int(tg_id), "\n".join(lines), parse_mode="HTML", disable_web_page_preview=True)
+        except Exception:
+            pass
+
+    return True
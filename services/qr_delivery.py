@@ -0,0 +1,89 @@
+# services/qr_delivery.py
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.types import BufferedInputFile, Message
+
+from config import settings
+from services.qrcode_gen import make_qr_png_bytes
+
+# رندر segno CPU-bound است؛ روی ترد جدا تا event loop آزاد بماند
+_executor = ThreadPoolExecutor(
+    max_workers=max(1, int(settings.QR_RENDER_WORKERS)),
+    thread_name_prefix="qr",
+)
+
+# link -> PNG و link -> file_id تلگرام (هر دو LRU محدود)
+_png_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+# رندرهای در جریان؛ درخواست‌های هم‌زمان برای یک لینک منتظر همان یکی می‌مانند
+_inflight: dict[str, asyncio.Future] = {}
+
+
+def _lru_get(cache: OrderedDict, key: str):
+    val = cache.get(key)
+    if val is not None:
+        cache.move_to_end(key)
+    return val
+
+
+def _lru_put(cache: OrderedDict, key: str, val) -> None:
+    cache[key] = val
+    cache.move_to_end(key)
+    while len(cache) > max(1, int(settings.QR_CACHE_SIZE)):
+        cache.popitem(last=False)
+
+
+async def render_qr_png(link: str) -> bytes:
+    """
+    PNG مربوط به لینک را از کش برمی‌گرداند؛ اگر نبود در ترد جدا رندر و کش می‌کند.
+    """
+    png = _lru_get(_png_cache, link)
+    if png is not None:
+        return png
+
+    fut = _inflight.get(link)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(_executor, make_qr_png_bytes, link)
+    _inflight[link] = fut
+    try:
+        png = await fut
+    finally:
+        _inflight.pop(link, None)
+    _lru_put(_png_cache, link, png)
+    return png
+
+
+def cached_file_id(link: str) -> str | None:
+    return _lru_get(_file_ids, link)
+
+
+def remember_file_id(link: str, msg: Message | None) -> None:
+    """file_id عکسِ آپلودشده را نگه می‌دارد تا دفعه بعد بدون رندر/آپلود ارسال شود."""
+    if not msg or not msg.photo:
+        return
+    _lru_put(_file_ids, link, msg.photo[-1].file_id)
+    # وقتی file_id داریم، PNG دیگر لازم نیست
+    _png_cache.pop(link, None)
+
+
+async def qr_media(link: str, filename: str) -> str | BufferedInputFile | None:
+    """
+    ورودی مناسب send_photo / InputMediaPhoto:
+      - اگر قبلاً آپلود شده: file_id (بدون رندر و بدون آپلود)
+      - وگرنه: PNG رندرشده (از کش یا تازه)
+      - اگر رندر شکست خورد: None
+    """
+    file_id = cached_file_id(link)
+    if file_id:
+        return file_id
+    try:
+        png = await render_qr_png(link)
+    except Exception:
+        return None
+    return BufferedInputFile(png, filename=filename)
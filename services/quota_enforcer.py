@@ -1,11 +1,16 @@
 # services/quota_enforcer.py
 import asyncio
+from collections import Counter
 from datetime import datetime, timezone
 
 from aiogram import Bot
 
 from db.mongo import subscriptions_col, users_col
-from services.xray_service import get_user_traffic_bytes, remove_client
+from services.account_index import forget_subscription
+from services.stats import record_traffic
+from services.sub_http import invalidate_subscription_bundle
+from services.xray_runner import run_xray
+from services.xray_service import get_user_traffic_bytes, query_all_user_traffic, remove_client
 
 BYTES_PER_MB = 1024 * 1024
 
@@ -94,17 +99,17 @@ async def _notify_expired(bot: Bot, sub: dict):
 
 async def _current_total_bytes(email: str) -> int:
     """
-    گرفتن ترافیک کل (uplink+downlink) از Xray (در ترد جدا).
+    گرفتن ترافیک کل (uplink+downlink) از Xray (روی executor مخصوص Xray؛ غیرحیاتی).
     """
-    _, __, tot = await asyncio.to_thread(get_user_traffic_bytes, email)
+    _, __, tot = await run_xray(get_user_traffic_bytes, email, critical=False)
     return int(tot or 0)
 
 
 async def _suspend_and_remove_all(emails: list[str]):
     """
-    حذف دسترسی همه ایمیل‌ها از Xray در ترد جدا.
+    حذف دسترسی همه ایمیل‌ها از Xray (حیاتی؛ اگر Xray ناسالم است در صف می‌ماند).
     """
-    tasks = [asyncio.to_thread(remove_client, em) for em in emails]
+    tasks = [run_xray(remove_client, em) for em in emails]
     # در صورت بروز خطا، نمی‌خوایم کل لوپ بترکه
     try:
         await asyncio.gather(*tasks, return_exceptions=True)
@@ -125,6 +130,14 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
     """
     while True:
         try:
+            # یک snapshot از آمار همه کاربران؛ اگر نشد، برای هر ایمیل جدا کوئری می‌زنیم
+            try:
+                snapshot: dict[str, int] | None = await run_xray(query_all_user_traffic, critical=False)
+            except Exception:
+                snapshot = None
+
+            # مصرف این دور به ازای پلن، برای داشبورد /stats
+            traffic: Counter = Counter()
             cursor = subscriptions_col.find({"status": "active"})
             async for sub in cursor:
                 # ---------- چک تاریخ انقضا ----------
@@ -144,8 +157,10 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
                         already_notified = bool(sub.get("expired_notified"))
                         await subscriptions_col.update_one(
                             {"_id": sub["_id"]},
-                            {"$set": {"status": "suspended", "expired_notified": True}}
+                            {"$set": {"status": "suspended", "expired_notified": True}, "$inc": {"version": 1}}
                         )
+                        forget_subscription(sub["_id"])
+                        invalidate_subscription_bundle(sub.get("sub_token"))
                         if not already_notified:
                             await _notify_expired(bot, sub)
                         # وقتی منقضی شد، ادامه‌ی محاسبه‌ی مصرف لازم نیست
@@ -156,8 +171,8 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
                 if quota_mb <= 0:
                     # اگر سهمیه تعریف نشده/صفره، فقط used_mb را صفر نگه دار
                     await subscriptions_col.update_one(
-                        {"_id": sub["_id"]},
-                        {"$set": {"used_mb": 0}}
+                        {"_id": sub["_id"], "used_mb": {"$ne": 0}},
+                        {"$set": {"used_mb": 0}, "$inc": {"version": 1}}
                     )
                     continue
 
@@ -174,8 +189,12 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
                 new_last_bytes = dict(last_bytes)  # کپی برای آپدیت
                 increments_sum = 0
 
-                # به صورت موازی از Xray بگیر
-                totals = await asyncio.gather(*[_current_total_bytes(em) for em in emails], return_exceptions=True)
+                if snapshot is not None:
+                    # ایمیلی که در snapshot نیست هنوز شمارنده‌ای در Xray ندارد
+                    totals = [snapshot.get(em, 0) for em in emails]
+                else:
+                    # به صورت موازی از Xray بگیر
+                    totals = await asyncio.gather(*[_current_total_bytes(em) for em in emails], return_exceptions=True)
 
                 for em, cur in zip(emails, totals):
                     if isinstance(cur, Exception):
@@ -199,17 +218,19 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
                         # افزایشی 0 تا دو بار حساب نشه
 
                 consumed_bytes += increments_sum
+                traffic[sub.get("source_plan") or "?"] += increments_sum
                 used_mb = consumed_bytes // BYTES_PER_MB
 
                 # ---------- ذخیره‌ی وضعیت ----------
-                await subscriptions_col.update_one(
-                    {"_id": sub["_id"]},
-                    {"$set": {
-                        "used_mb": int(used_mb),
-                        "consumed_bytes": int(consumed_bytes),
-                        "last_bytes": new_last_bytes
-                    }}
-                )
+                update = {"$set": {
+                    "used_mb": int(used_mb),
+                    "consumed_bytes": int(consumed_bytes),
+                    "last_bytes": new_last_bytes
+                }}
+                if int(used_mb) != int(sub.get("used_mb") or 0):
+                    # فقط وقتی عدد نمایشی عوض شده، کش «اشتراک‌های من» باطل شود
+                    update["$inc"] = {"version": 1}
+                await subscriptions_col.update_one({"_id": sub["_id"]}, update)
 
                 # ---------- اعمال محدودیت سهمیه ----------
                 if used_mb >= quota_mb:
@@ -220,11 +241,16 @@ async def quota_loop(bot: Bot, interval_sec: int = 120):
                     already_notified = bool(sub.get("quota_notified"))
                     await subscriptions_col.update_one(
                         {"_id": sub["_id"]},
-                        {"$set": {"status": "suspended", "quota_notified": True}}
+                        {"$set": {"status": "suspended", "quota_notified": True}, "$inc": {"version": 1}}
                     )
+                    forget_subscription(sub["_id"])
+                    invalidate_subscription_bundle(sub.get("sub_token"))
                     if not already_notified:
                         await _notify_quota_exhausted(bot, sub, used_mb)
 
+            if traffic:
+                await record_traffic(traffic)
+
         except Exception:
             # اجازه نمی‌دهیم لوپ از کار بیفتد
             pass
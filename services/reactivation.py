@@ -0,0 +1,98 @@
+# services/reactivation.py
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from db.mongo import subscriptions_col
+from services.account_index import register_subscription
+from services.sub_http import invalidate_subscription_bundle
+from services.xray_runner import run_xray
+from services.xray_service import add_client, enable_clients
+
+
+def stored_accounts(sub: dict) -> list[dict]:
+    """حساب‌های ذخیره‌شده (email/uuid) در قالب لیست؛ سند قدیمی ممکن است dict باشد."""
+    x = sub.get("xray") or []
+    if isinstance(x, dict):
+        x = [x]
+    return [dict(a) for a in x if a and a.get("email")]
+
+
+async def reactivate_subscription(
+    sub: dict,
+    *,
+    add_quota_mb: int = 0,
+    quota_mb: int | None = None,
+    reset_usage: bool = False,
+    extend_days: int = 0,
+    extra_set: dict | None = None,
+    extra_filter: dict | None = None,
+    push: dict | None = None,
+) -> dict | None:
+    """
+    برگرداندن اشتراک به active با همان ایمیل/UUIDها:
+      - همهٔ حساب‌ها با یک فراخوانی enable_clients از Runtime API اضافه می‌شوند (بدون reload)
+      - status/end_at/quota در یک find_one_and_update اتمیک عوض می‌شوند
+    quota_mb مقدار مطلق است (مثلاً تمدید اشتراک منقضی)، add_quota_mb افزایشی (شارژ).
+    extra_filter برای idempotency (مثل renewals.order_id) و push برای تاریخچه.
+    خروجی: سند جدید، یا None اگر بعد از تغییرات هنوز منقضی/بی‌حجم باشد یا فیلتر نخورد.
+    """
+    now = datetime.utcnow()
+    end_at = sub["end_at"]
+    if extend_days:
+        end_at = max(end_at, now) + timedelta(days=int(extend_days))
+    new_quota = int(quota_mb if quota_mb is not None else sub.get("quota_mb") or 0) + int(add_quota_mb)
+    used = 0 if reset_usage else int(sub.get("used_mb") or 0)
+    if end_at <= now or new_quota <= used:
+        return None
+
+    accounts = stored_accounts(sub)
+    for acc in accounts:
+        if not acc.get("uuid"):
+            # سند قدیمی بدون UUID: add_client کلاینت موجود در فایل را برمی‌گرداند
+            acc["uuid"], _ = await run_xray(add_client, acc["email"])
+    update: dict = {
+        "$set": {
+            "status": "active",
+            "end_at": end_at,
+            "expired_notified": False,
+            "quota_notified": False,
+            "xray": accounts,
+            "reactivated_at": now,
+            **(extra_set or {}),
+        },
+        "$unset": {"suspend_reason": ""},
+        "$inc": {"version": 1},
+    }
+    if quota_mb is not None:
+        update["$set"]["quota_mb"] = new_quota
+    elif add_quota_mb:
+        update["$inc"]["quota_mb"] = int(add_quota_mb)
+    if reset_usage:
+        update["$set"].update({"used_mb": 0, "consumed_bytes": 0})
+    if push:
+        update["$push"] = push
+
+    # quota_loop/device_enforcer اول کلاینت‌ها را حذف و بعد status را عوض می‌کنند؛ پس:
+    #   - enable_clients همیشه (حتی اگر سند خوانده‌شده active باشد) — idempotent است
+    #   - update فقط اگر status از زمان خواندن عوض نشده؛ وگرنه دوباره enable و تلاش مجدد
+    expected = sub.get("status")
+    doc = None
+    for _ in range(3):
+        if accounts:
+            await run_xray(enable_clients, [(a["email"], a["uuid"]) for a in accounts])
+        doc = await subscriptions_col.find_one_and_update(
+            {"_id": sub["_id"], "status": expected, **(extra_filter or {})}, update,
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            break
+        fresh = await subscriptions_col.find_one({"_id": sub["_id"]}, {"status": 1})
+        if not fresh or fresh.get("status") == expected:
+            # miss از extra_filter بوده (مثلاً همین تمدید قبلاً اعمال شده)
+            break
+        expected = fresh.get("status")
+    if doc:
+        register_subscription(doc)
+        invalidate_subscription_bundle(doc.get("sub_token"))
+    return doc
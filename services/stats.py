@@ -0,0 +1,156 @@
+# services/stats.py
+import asyncio
+from datetime import datetime, time, timedelta, timezone
+
+from db.mongo import meta_col, orders_col, stats_daily_col, subscriptions_col
+from utils.locale import TEHRAN
+
+# رول‌آپ روزانه در stats_daily؛ هر سند = (روز تهران، پلن) با _id «YYYY-MM-DD|plan»
+# تا گزارش N روز اخیر یک range scan روی _id باشد.
+TZ = "Asia/Tehran"
+# نوشتن‌های دیرهنگام (تایم‌استمپ قبل از watermark، commit بعد از آن): روزهای این بازه دوباره شمرده می‌شوند
+SETTLE = timedelta(hours=1)
+WATERMARK_ID = "stats_watermark"
+# شمارش اشتراک‌های فعال به ازای پلن (عکس لحظه‌ای هر rollup)؛ /stats فقط همین سند را می‌خواند
+ACTIVE_ID = "stats_active"
+COUNTERS = ("orders", "paid", "revenue", "new_subs")
+
+_lock = asyncio.Lock()
+
+
+def _day_key(date_field: str) -> dict:
+    return {"$dateToString": {"format": "%Y-%m-%d", "date": date_field, "timezone": TZ}}
+
+
+def _merge_stage(fields: tuple[str, ...]) -> dict:
+    """
+    $merge با $set: شمارنده‌های روز/پلن با مقدار تازه‌شمرده جایگزین می‌شوند (تکرار بی‌ضرر است)؛
+    traffic_bytes که record_traffic افزایشی می‌نویسد دست نمی‌خورد.
+    """
+    return {"$merge": {
+        "into": stats_daily_col.name,
+        "on": "_id",
+        "whenMatched": [{"$set": {f: f"$$new.{f}" for f in fields}}],
+        "whenNotMatched": "insert",
+    }}
+
+
+def _rollup_pipeline(date_field: str, plan_field: str, match: dict, counters: dict) -> list[dict]:
+    day = _day_key(f"${date_field}")
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"$concat": [day, "|", {"$ifNull": [f"${plan_field}", "?"]}]},
+            "day": {"$first": day},
+            "plan": {"$first": {"$ifNull": [f"${plan_field}", "?"]}},
+            **counters,
+        }},
+        _merge_stage(tuple(counters)),
+    ]
+
+
+def _day_start(ts: datetime) -> datetime:
+    """ابتدای روز تهرانِ ts (UTC naive) → UTC naive؛ مرز گروه‌بندی $dateToString."""
+    d = ts.replace(tzinfo=timezone.utc).astimezone(TEHRAN).date()
+    return datetime.combine(d, time.min, TEHRAN).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def rollup() -> bool:
+    """
+    روزهای تهرانی از (watermark - SETTLE) تا امروز را کامل از نو می‌شمارد و با $set ادغام می‌کند.
+    watermark فقط وقتی جلو می‌رود که هر سه ادغام موفق شوند؛ شکست یا اجرای هم‌زمان دو رپلیکا
+    چیزی را دوبار نمی‌شمارد چون هر اجرا همان اعداد را دوباره می‌نویسد. اولین اجرا کل تاریخچه را می‌شمارد.
+    """
+    async with _lock:
+        now = datetime.utcnow()
+        wm = await meta_col.find_one({"_id": WATERMARK_ID})
+        lo = wm["hi"] - SETTLE if wm else datetime(1970, 1, 1)
+        since = {"$gte": _day_start(lo)}
+        pipelines = [
+            (orders_col, _rollup_pipeline(
+                "created_at", "plan_code", {"created_at": since}, {"orders": {"$sum": 1}})),
+            (orders_col, _rollup_pipeline(
+                "paid_at", "plan_code", {"status": "paid", "paid_at": since},
+                {"paid": {"$sum": 1}, "revenue": {"$sum": "$amount_toman"}})),
+            (subscriptions_col, _rollup_pipeline(
+                "start_at", "source_plan", {"start_at": since}, {"new_subs": {"$sum": 1}})),
+        ]
+        results = await asyncio.gather(
+            *[col.aggregate(p).to_list(None) for col, p in pipelines],
+            _refresh_active(now),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # watermark سر جایش می‌ماند؛ اجرای بعدی همین روزها را دوباره می‌شمارد
+            for e in errors[1:]:
+                print(f"⚠️ stats rollup step failed: {e!r}")
+            raise errors[0]
+        # $max: رپلیکای کندتر watermark را عقب نمی‌برد
+        await meta_col.update_one({"_id": WATERMARK_ID}, {"$max": {"hi": now}}, upsert=True)
+        return True
+
+
+def _today() -> str:
+    return datetime.now(TEHRAN).strftime("%Y-%m-%d")
+
+
+async def record_traffic(per_plan: dict[str, int]) -> None:
+    """افزایش مصرف هر پلن در سند امروز؛ quota_loop بعد از هر دور صدا می‌زند."""
+    day = _today()
+    await asyncio.gather(*[
+        stats_daily_col.update_one(
+            {"_id": f"{day}|{plan}"},
+            {"$inc": {"traffic_bytes": int(n)}, "$setOnInsert": {"day": day, "plan": plan}},
+            upsert=True,
+        )
+        for plan, n in per_plan.items() if n
+    ])
+
+
+async def _refresh_active(now: datetime) -> None:
+    """
+    شمارش اشتراک‌های active (فقط در rollup پس‌زمینه). $match از ایندکس partial اشتراک‌های فعال
+    استفاده می‌کند، ولی source_plan در آن ایندکس نیست و هر اشتراک فعال یک‌بار FETCH می‌شود.
+    کد پلن کلید دیکشنری Mongo نمی‌شود (ممکن است نقطه داشته باشد)؛ لیست ذخیره می‌شود.
+    """
+    cursor = subscriptions_col.aggregate([
+        {"$match": {"status": "active"}},
+        {"$group": {"_id": "$source_plan", "n": {"$sum": 1}}},
+    ])
+    per_plan = [{"plan": d["_id"] or "?", "n": d["n"]} async for d in cursor]
+    await meta_col.update_one({"_id": ACTIVE_ID}, {"$set": {"per_plan": per_plan, "at": now}}, upsert=True)
+
+
+async def read_active() -> tuple[dict[str, int], datetime | None]:
+    """آخرین شمارش اشتراک‌های فعال از rollup (یک point read) + زمان آن."""
+    doc = await meta_col.find_one({"_id": ACTIVE_ID}) or {}
+    return {p["plan"]: int(p["n"]) for p in doc.get("per_plan") or []}, doc.get("at")
+
+
+async def read_windows(*windows: int) -> list[dict[str, dict]]:
+    """
+    جمع رول‌آپ N روز اخیر (شامل امروز) به ازای پلن، برای هر N در windows؛
+    یک range scan روی _id برای بزرگ‌ترین پنجره.
+    """
+    today = datetime.now(TEHRAN)
+    starts = [(today - timedelta(days=n - 1)).strftime("%Y-%m-%d") for n in windows]
+    out: list[dict[str, dict]] = [{} for _ in windows]
+    async for d in stats_daily_col.find({"_id": {"$gte": f"{min(starts)}|"}}):
+        for start, totals in zip(starts, out):
+            if d.get("day", "") < start:
+                continue
+            t = totals.setdefault(d.get("plan", "?"), dict.fromkeys((*COUNTERS, "traffic_bytes"), 0))
+            for k in t:
+                t[k] += int(d.get(k) or 0)
+    return out
+
+
+async def stats_loop(interval_sec: int = 600):
+    while True:
+        try:
+            await rollup()
+        except Exception:
+            # اجازه نمی‌دهیم لوپ از کار بیفتد
+            pass
+        await asyncio.sleep(interval_sec)
@@ -0,0 +1,167 @@
+# services/sub_http.py
+import asyncio
+import base64
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from datetime import timezone
+
+from aiohttp import web
+
+from config import settings
+from db.mongo import subscriptions_col
+from services.links import vless_ws_link
+
+_CACHE_MAX = 10_000
+_MISSING_MAX = 2_000
+
+# token -> (checked_at, version, etag, body, headers)
+# ورودی تا وقتی version اشتراک عوض نشده معتبر است؛ هر SUB_REVALIDATE_SEC فقط version دوباره خوانده می‌شود.
+_bundle_cache: "OrderedDict[str, tuple[float, int, str, bytes, dict]]" = OrderedDict()
+# توکن‌های ناشناخته (404) جدا و کوتاه‌مدت، تا اسکن توکن‌های تصادفی ورودی‌های واقعی را بیرون نیندازد
+_missing: "OrderedDict[str, float]" = OrderedDict()
+# خروجی secrets.token_urlsafe(18)؛ بقیه بدون DB و کش 404 می‌گیرند
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{24}$")
+
+
+def subscription_links_enabled() -> bool:
+    return bool(settings.SUB_HTTP_ENABLED and settings.SUB_BASE_URL)
+
+
+def subscription_url(token: str | None) -> str | None:
+    """آدرس عمومی لینک اشتراک؛ اگر سرویس خاموش است None."""
+    if not token or not subscription_links_enabled():
+        return None
+    return f"{settings.SUB_BASE_URL.rstrip('/')}/sub/{token}"
+
+
+def invalidate_subscription_bundle(token: str | None) -> None:
+    """ابطال فوری در همین پردازه؛ رپلیکاهای دیگر با تغییر version در revalidate بعدی می‌فهمند."""
+    if token:
+        _bundle_cache.pop(token, None)
+        _missing.pop(token, None)
+
+
+def _sub_links(sub: dict) -> list[str]:
+    """لینک‌های ذخیره‌شده (config_ref)؛ اگر نبود از روی xray ساخته می‌شوند."""
+    ref = sub.get("config_ref")
+    if isinstance(ref, str):
+        ref = [ref]
+    links = [s for s in (ref or []) if isinstance(s, str) and s.strip()]
+    if links:
+        return links
+
+    x = sub.get("xray") or []
+    accounts = [x] if isinstance(x, dict) else [a for a in x if a]
+    return [
+        vless_ws_link(
+            a["uuid"], settings.XRAY_DOMAIN, settings.XRAY_PORT,
+            settings.XRAY_WS_PATH, settings.XRAY_SECURITY, f"vira-{i}",
+        )
+        for i, a in enumerate(accounts, 1)
+        if a.get("uuid")
+    ]
+
+
+def _userinfo(sub: dict) -> str:
+    """هدر استاندارد Subscription-Userinfo (حجم/انقضا) که اکثر کلاینت‌ها نشان می‌دهند."""
+    used = int(sub.get("consumed_bytes") or int(sub.get("used_mb") or 0) * 1024 * 1024)
+    total = int(sub.get("quota_mb") or 0) * 1024 * 1024
+    end_at = sub.get("end_at")
+    if end_at and end_at.tzinfo is None:
+        # تاریخ‌ها در DB به‌صورت UTC بدون tz ذخیره شده‌اند
+        end_at = end_at.replace(tzinfo=timezone.utc)
+    expire = int(end_at.timestamp()) if end_at else 0
+    return f"upload=0; download={used}; total={total}; expire={expire}"
+
+
+async def _load_bundle(token: str) -> tuple[int, str | None, bytes, dict]:
+    sub = await subscriptions_col.find_one(
+        {"sub_token": token},
+        {"status": 1, "config_ref": 1, "xray": 1, "quota_mb": 1,
+         "used_mb": 1, "consumed_bytes": 1, "end_at": 1, "version": 1},
+    )
+    if not sub:
+        return 0, None, b"", {}
+
+    # اشتراک غیرفعال: باندل خالی تا کلاینت کانفیگ‌ها را کنار بگذارد
+    links = _sub_links(sub) if sub.get("status") == "active" else []
+    body = base64.b64encode("\n".join(links).encode()) if links else b""
+    etag = '"' + hashlib.sha1(body + _userinfo(sub).encode()).hexdigest() + '"'
+    headers = {
+        "Subscription-Userinfo": _userinfo(sub),
+        "Cache-Control": f"max-age={int(settings.SUB_CACHE_TTL_SEC)}",
+    }
+    return int(sub.get("version", 0)), etag, body, headers
+
+
+async def _get_bundle(token: str) -> tuple[str | None, bytes, dict]:
+    now = time.monotonic()
+    if not _TOKEN_RE.match(token):
+        return None, b"", {}
+    miss = _missing.get(token)
+    if miss and miss > now:
+        return None, b"", {}
+
+    hit = _bundle_cache.get(token)
+    if hit:
+        _bundle_cache.move_to_end(token)
+        if now - hit[0] < int(settings.SUB_REVALIDATE_SEC):
+            return hit[2], hit[3], hit[4]
+        # فقط version (سند کوچک)؛ باندل فقط وقتی اشتراک واقعاً عوض شده دوباره ساخته می‌شود
+        cur = await subscriptions_col.find_one({"sub_token": token}, {"version": 1})
+        if cur and int(cur.get("version", 0)) == hit[1]:
+            _bundle_cache[token] = (now, *hit[1:])
+            return hit[2], hit[3], hit[4]
+
+    version, etag, body, headers = await _load_bundle(token)
+    if etag is None:
+        _bundle_cache.pop(token, None)
+        _missing[token] = now + int(settings.SUB_CACHE_TTL_SEC)
+        _missing.move_to_end(token)
+        while len(_missing) > _MISSING_MAX:
+            _missing.popitem(last=False)
+        return None, b"", {}
+
+    _bundle_cache[token] = (now, version, etag, body, headers)
+    _bundle_cache.move_to_end(token)
+    while len(_bundle_cache) > _CACHE_MAX:
+        _bundle_cache.popitem(last=False)
+    return etag, body, headers
+
+
+async def _handle_sub(request: web.Request) -> web.Response:
+    token = request.match_info["token"]
+    etag, body, headers = await _get_bundle(token)
+    if etag is None:
+        return web.Response(status=404)
+
+    inm = request.headers.get("If-None-Match", "")
+    if etag in [t.strip().removeprefix("W/") for t in inm.split(",")]:
+        return web.Response(status=304, headers={"ETag": etag, **headers})
+
+    return web.Response(
+        body=body,
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"ETag": etag, **headers},
+    )
+
+
+def register_subscription_routes(app: web.Application) -> None:
+    app.router.add_get("/sub/{token}", _handle_sub)
+
+
+async def run_subscription_server(stop_event: asyncio.Event) -> None:
+    """سرور مستقل لینک اشتراک (وقتی ربات در حالت polling است)."""
+    app = web.Application()
+    register_subscription_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.SUB_HTTP_HOST, int(settings.SUB_HTTP_PORT))
+    await site.start()
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
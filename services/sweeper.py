@@ -0,0 +1,115 @@
+# services/sweeper.py
+import asyncio
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+from config import settings
+from db.mongo import orders_archive_col, orders_col, payments_archive_col, payments_col
+
+# وضعیت‌های پایانی که بعد از ARCHIVE_AFTER_DAYS به آرشیو می‌روند.
+# paid/approved دفتر مالی‌اند و در کالکشن اصلی می‌مانند.
+ORDER_ARCHIVE_STATUSES = ["expired", "canceled", "failed"]
+PAYMENT_ARCHIVE_STATUSES = ["expired", "rejected"]
+
+
+async def expire_overdue_payments(now: datetime) -> int:
+    """پرداخت‌های pending_proof که از due_at (+ مهلت) گذشته‌اند → expired."""
+    cutoff = now - timedelta(minutes=int(settings.PAYMENT_GRACE_MIN))
+    res = await payments_col.update_many(
+        {"status": "pending_proof", "due_at": {"$lt": cutoff}},
+        {"$set": {"status": "expired", "reviewed_at": now}}
+    )
+    return res.modified_count or 0
+
+
+async def expire_stale_orders(now: datetime) -> int:
+    """
+    سفارش‌های pending قدیمی‌تر از ORDER_PENDING_TTL_HOURS → expired.
+    سفارشی که رسیدش در انتظار بررسی ادمین است دست نمی‌خورد.
+    """
+    cutoff = now - timedelta(hours=int(settings.ORDER_PENDING_TTL_HOURS))
+    total = 0
+    last = None
+    while True:
+        filt: dict = {"status": "pending", "created_at": {"$lt": cutoff}}
+        if last is not None:
+            # keyset روی (created_at, _id) مثل list_payments_page؛ هم‌زمان‌ها با آخرین سند بچ جا نمی‌مانند
+            c, i = last
+            filt = {"$or": [{"status": "pending", "created_at": {"$gt": c, "$lt": cutoff}},
+                            {"status": "pending", "created_at": c, "_id": {"$gt": i}}]}
+        cursor = (
+            orders_col.find(filt, {"created_at": 1})
+            .sort([("created_at", 1), ("_id", 1)])
+            .limit(int(settings.ARCHIVE_BATCH))
+        )
+        batch = [o async for o in cursor]
+        if not batch:
+            return total
+
+        ids = [o["_id"] for o in batch]
+        waiting = {
+            p["order_id"] async for p in payments_col.find(
+                {"order_id": {"$in": ids}, "status": {"$in": ["pending_proof", "submitted"]}}, {"order_id": 1}
+            )
+        }
+        expire_ids = [i for i in ids if i not in waiting]
+        if expire_ids:
+            res = await orders_col.update_many(
+                {"_id": {"$in": expire_ids}, "status": "pending"},
+                {"$set": {"status": "expired", "expired_at": now}}
+            )
+            total += res.modified_count or 0
+        if len(batch) < int(settings.ARCHIVE_BATCH):
+            return total
+        # سفارش‌های منتظر بررسی pending می‌مانند؛ کرسر از (created_at, _id) آخرین بچ جلو می‌رود
+        last = (batch[-1]["created_at"], batch[-1]["_id"])
+
+
+async def _archive(col, archive_col, statuses: list[str], cutoff: datetime) -> int:
+    """
+    اسناد پایانی قدیمی را بچ‌به‌بچ منتقل می‌کند: اول درج در آرشیو، بعد حذف.
+    اگر وسط کار قطع شود، تکرار بعدی کلید تکراری را نادیده می‌گیرد و حذف را کامل می‌کند.
+    """
+    moved = 0
+    filt = {"status": {"$in": statuses}, "created_at": {"$lt": cutoff}}
+    while True:
+        batch = [d async for d in col.find(filt).limit(int(settings.ARCHIVE_BATCH))]
+        if not batch:
+            return moved
+        try:
+            await archive_col.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # فقط کلید تکراری (از اجرای نیمه‌کارهٔ قبلی) قابل چشم‌پوشی است
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        res = await col.delete_many({"_id": {"$in": [d["_id"] for d in batch]}, **filt})
+        moved += res.deleted_count or 0
+        if len(batch) < int(settings.ARCHIVE_BATCH):
+            return moved
+        # مکث کوتاه بین بچ‌ها تا DB برای کوئری‌های ربات نفس بکشد
+        await asyncio.sleep(0.1)
+
+
+async def sweep_once() -> dict[str, int]:
+    now = datetime.utcnow()
+    archive_cutoff = now - timedelta(days=int(settings.ARCHIVE_AFTER_DAYS))
+    # ترتیب مهم است: پرداخت‌های سوخته اول، تا سفارش‌هایشان هم قابل انقضا شوند
+    report = {"payments_expired": await expire_overdue_payments(now)}
+    report["orders_expired"] = await expire_stale_orders(now)
+    report["payments_archived"] = await _archive(payments_col, payments_archive_col, PAYMENT_ARCHIVE_STATUSES, archive_cutoff)
+    report["orders_archived"] = await _archive(orders_col, orders_archive_col, ORDER_ARCHIVE_STATUSES, archive_cutoff)
+    return report
+
+
+async def sweeper_loop(interval_sec: int = 900):
+    """انقضای سفارش/پرداخت‌های رهاشده + آرشیو اسناد پایانی قدیمی."""
+    while True:
+        try:
+            report = await sweep_once()
+            if any(report.values()):
+                print("🧾 sweep: " + ", ".join(f"{k}={v}" for k, v in report.items()))
+        except Exception:
+            # اجازه نمی‌دهیم لوپ از کار بیفتد
+            pass
+        await asyncio.sleep(interval_sec)
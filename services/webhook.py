@@ -0,0 +1,219 @@
+# services/webhook.py
+import asyncio
+import hmac
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from pymongo.errors import DuplicateKeyError
+
+from config import settings
+from db.mongo import processed_updates_col
+from services.sub_http import register_subscription_routes
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# update_idهای اخیر همین نمونه؛ قبل از رفتن به Mongo چک می‌شود
+_RECENT_MAX = 4096
+_recent_updates: "OrderedDict[int, None]" = OrderedDict()
+
+
+async def _claim_update(update_id: int) -> str:
+    """
+    "claimed" اگر این رپلیکا باید update_id را پردازش کند (بین همه‌ی رپلیکاها یکی).
+    "duplicate" اگر قبلاً پردازش شده یا همین نمونه در حال پردازش آن است؛
+    "busy" اگر رپلیکای دیگری در حال پردازش است (تلگرام بعداً دوباره می‌فرستد).
+    ادعایی که بیش از WEBHOOK_CLAIM_STALE_SEC در حالت processing مانده (کرش رپلیکا) پس گرفته می‌شود.
+    """
+    if update_id in _recent_updates:
+        return "duplicate"
+    now = datetime.utcnow()
+    try:
+        await processed_updates_col.insert_one({"_id": update_id, "at": now, "state": "processing"})
+    except DuplicateKeyError:
+        try:
+            stale = now - timedelta(seconds=int(settings.WEBHOOK_CLAIM_STALE_SEC))
+            taken = await processed_updates_col.find_one_and_update(
+                {"_id": update_id, "state": "processing", "at": {"$lt": stale}},
+                {"$set": {"at": now}},
+                projection={"_id": 1},
+            )
+            if not taken:
+                doc = await processed_updates_col.find_one({"_id": update_id}, {"state": 1})
+                # سندهای قدیمی state ندارند → پردازش‌شده
+                return "busy" if (doc or {}).get("state") == "processing" else "duplicate"
+        except Exception:
+            return "busy"
+    except Exception:
+        # اگر DB در دسترس نبود، پردازش کن؛ گم شدن آپدیت بدتر از تکرار است
+        pass
+
+    _recent_updates[update_id] = None
+    while len(_recent_updates) > _RECENT_MAX:
+        _recent_updates.popitem(last=False)
+    return "claimed"
+
+
+async def _finish_update(update_id: int) -> None:
+    try:
+        await processed_updates_col.update_one({"_id": update_id}, {"$set": {"state": "done"}})
+    except Exception:
+        pass
+
+
+async def _heartbeat(update_id: int) -> None:
+    """تا پردازش ادامه دارد at ادعا تازه می‌شود تا رپلیکای دیگر آن را کهنه حساب نکند و پس نگیرد."""
+    interval = max(1.0, int(settings.WEBHOOK_CLAIM_STALE_SEC) / 3)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await processed_updates_col.update_one(
+                {"_id": update_id, "state": "processing"}, {"$set": {"at": datetime.utcnow()}})
+        except Exception:
+            pass
+
+
+async def _release_update(update_id: int) -> None:
+    """پردازش تمام نشد (لغو/توقف) → ادعا آزاد می‌شود تا ارسال دوبارهٔ تلگرام پردازش شود."""
+    _recent_updates.pop(update_id, None)
+    try:
+        await processed_updates_col.delete_one({"_id": update_id, "state": "processing"})
+    except Exception:
+        pass
+
+
+class WebhookServer:
+    """
+    سرور aiohttp برای دریافت آپدیت‌ها:
+      - اعتبارسنجی secret token
+      - حذف آپدیت‌های تکراری (update_id)
+      - سقف هم‌زمانی فقط در ChatSerialMiddleware (بعد از قفل چت)؛ این‌جا اسلاتی گرفته نمی‌شود
+        تا آپدیت‌های صف‌شدهٔ یک چت پرترافیک جای بقیه را پر نکنند
+      - پاسخ 200 فقط بعد از پردازش؛ پردازش نیمه‌تمام ادعا را آزاد می‌کند تا تلگرام دوباره بفرستد
+      - تخلیهٔ تمیز آپدیت‌های در جریان (و منتظرِ جا) هنگام توقف
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self._tasks: set[asyncio.Task] = set()
+        # آپدیت‌های ادعاشده (در صف قفل چت یا در حال پردازش)؛ drain تا صفر شدنش صبر می‌کند
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._accepting = True
+
+        self.app = web.Application()
+        self.app.router.add_post(settings.WEBHOOK_PATH, self._handle_update)
+        self.app.router.add_get("/healthz", self._health)
+        if settings.SUB_HTTP_ENABLED:
+            # لینک اشتراک HTTP روی همین سرور (یک پورت برای Liara)
+            register_subscription_routes(self.app)
+
+    async def _health(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            return web.Response(status=503, text="draining")
+        return web.Response(text=f"ok inflight={self._inflight}")
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            # تلگرام دوباره می‌فرستد و رپلیکای دیگری جواب می‌دهد
+            return web.Response(status=503)
+
+        # بدون secret هر کسی با داشتن URL می‌تواند آپدیت جعلی (مثلاً از طرف ادمین) بفرستد
+        secret = settings.WEBHOOK_SECRET
+        valid = hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), secret.encode())
+        if not (secret and valid):
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400)
+
+        claim = await _claim_update(update.update_id)
+        if claim == "duplicate":
+            return web.Response()
+        if claim == "busy":
+            return web.Response(status=503)
+
+        self._enter()
+        task = asyncio.create_task(self._process(update), name=f"update-{update.update_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # قطع اتصال تلگرام پردازش را لغو نمی‌کند
+        done = await asyncio.shield(task)
+        return web.Response() if done else web.Response(status=503)
+
+    def _enter(self) -> None:
+        self._inflight += 1
+        self._idle.clear()
+
+    def _leave(self) -> None:
+        self._inflight -= 1
+        if self._inflight == 0:
+            self._idle.set()
+
+    async def _process(self, update: Update) -> bool:
+        done = False
+        hb = asyncio.create_task(_heartbeat(update.update_id))
+        try:
+            await self.dp.feed_update(self.bot, update)
+            done = True
+        except Exception as e:
+            # خطای هندلر با ارسال دوباره درست نمی‌شود؛ پردازش‌شده حساب می‌شود
+            print(f"⚠️ update {update.update_id} failed: {e!r}")
+            done = True
+        finally:
+            hb.cancel()
+            if done:
+                await _finish_update(update.update_id)
+            else:
+                await _release_update(update.update_id)
+            self._leave()
+        return done
+
+    async def drain(self, timeout: float) -> None:
+        """
+        دریافت آپدیت جدید را می‌بندد و تا timeout منتظر آپدیت‌های ادعاشده می‌ماند
+        (چه در حال پردازش، چه منتظر قفل چت). باقی‌مانده لغو و ادعایشان آزاد می‌شود.
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        pending = list(self._tasks)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, stop_event: asyncio.Event) -> None:
+    """سرور وبهوک را بالا می‌آورد، webhook را ست می‌کند و تا stop_event اجرا می‌شود."""
+    if not settings.WEBHOOK_BASE_URL:
+        raise RuntimeError("RUN_MODE=webhook requires WEBHOOK_BASE_URL")
+    if not settings.WEBHOOK_SECRET:
+        raise RuntimeError("RUN_MODE=webhook requires WEBHOOK_SECRET")
+
+    server = WebhookServer(bot, dp)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WEBHOOK_HOST, int(settings.WEBHOOK_PORT))
+    await site.start()
+
+    # چند رپلیکا همین را ست می‌کنند؛ idempotent است
+    await bot.set_webhook(
+        url=settings.WEBHOOK_BASE_URL.rstrip("/") + settings.WEBHOOK_PATH,
+        secret_token=settings.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(100, max(1, int(settings.WEBHOOK_MAX_INFLIGHT))),
+    )
+
+    try:
+        await stop_event.wait()
+    finally:
+        await server.drain(float(settings.WEBHOOK_DRAIN_SEC))
+        await runner.cleanup()
@@ -0,0 +1,114 @@
+# services/xray_runner.py
+import asyncio
+import functools
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from config import settings
+
+# executor جدا از default تا Xray هنگ‌کرده بقیهٔ to_threadها (QR، لاگ، ...) را قفل نکند
+_executor = ThreadPoolExecutor(
+    max_workers=max(1, int(settings.XRAY_WORKERS)),
+    thread_name_prefix="xray",
+)
+
+# برای /metrics
+XRAY_CALLS: Counter = Counter()
+
+
+class XrayUnavailable(RuntimeError):
+    """مدار باز است؛ Xray فعلاً سالم نیست."""
+
+
+class CircuitBreaker:
+    """
+    closed: همه رد می‌شوند
+    open: بعد از `threshold` خطای پشت‌سرهم؛ تا `reset_sec` همه فوراً رد می‌شوند
+    half_open: یک درخواست آزمایشی؛ موفق → closed، ناموفق → open
+    """
+
+    def __init__(self, threshold: int, reset_sec: float):
+        self.threshold = max(1, int(threshold))
+        self.reset_sec = float(reset_sec)
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_inflight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_sec:
+                return False
+            self.state = "half_open"
+            self._probe_inflight = False
+        # half_open: فقط یک درخواست آزمایشی
+        if self._probe_inflight:
+            return False
+        self._probe_inflight = True
+        return True
+
+    def is_open(self) -> bool:
+        """فقط خواندن: مدار باز و reset_sec هنوز نگذشته؛ درخواست آزمایشی را نمی‌گیرد."""
+        return self.state == "open" and time.monotonic() - self._opened_at < self.reset_sec
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self._failures = 0
+        self._probe_inflight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_inflight = False
+        if self.state == "half_open" or self._failures >= self.threshold:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(settings.XRAY_BREAKER_THRESHOLD, settings.XRAY_BREAKER_RESET_SEC)
+# مدار جدا برای کارهای غیرحیاتی (آمار، مصرف لحظه‌ای، compaction)؛ خطای آن‌ها
+# (مثلاً اسپم دکمهٔ مصرف) provision و حذف دسترسی را پشت مدار باز نگه نمی‌دارد
+soft_breaker = CircuitBreaker(settings.XRAY_BREAKER_THRESHOLD, settings.XRAY_BREAKER_RESET_SEC)
+
+
+async def _wait_for_breaker() -> None:
+    """کار حیاتی (provision/حذف دسترسی) در صف می‌ماند تا مدار اجازه دهد."""
+    deadline = time.monotonic() + float(settings.XRAY_CRITICAL_MAX_WAIT)
+    while not breaker.allow():
+        if time.monotonic() >= deadline:
+            raise XrayUnavailable("xray unavailable (circuit open)")
+        await asyncio.sleep(1)
+
+
+async def run_xray(fn: Callable[..., Any], *args, critical: bool = True, timeout: float | None = None) -> Any:
+    """
+    اجرای یک تابع همگام xray_service روی executor اختصاصی با timeout و circuit breaker.
+    critical=False (مثل آمار): اگر مدار اصلی (تا reset_sec) یا soft_breaker باز باشد فوراً
+    XrayUnavailable (کار حذف می‌شود)؛ نتیجه‌اش فقط در soft_breaker ثبت می‌شود.
+    critical=True (provision، حذف دسترسی): تا XRAY_CRITICAL_MAX_WAIT در صف می‌ماند.
+    """
+    cb = breaker if critical else soft_breaker
+    if not critical:
+        # مدار اصلی فقط خوانده می‌شود تا درخواست آزمایشی half_open آن را نگیریم؛ بعد از reset_sec
+        # (حتی بدون هیچ کار حیاتی) تصمیم با soft_breaker است تا quota_loop متوقف نماند
+        if breaker.is_open() or not soft_breaker.allow():
+            XRAY_CALLS["shed"] += 1
+            raise XrayUnavailable("xray unavailable (circuit open)")
+    elif not breaker.allow():
+        XRAY_CALLS["queued"] += 1
+        await _wait_for_breaker()
+
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(_executor, functools.partial(fn, *args))
+    try:
+        result = await asyncio.wait_for(fut, timeout or float(settings.XRAY_OP_TIMEOUT))
+    except Exception:
+        XRAY_CALLS["failed"] += 1
+        cb.record_failure()
+        raise
+    XRAY_CALLS["ok"] += 1
+    cb.record_success()
+    return result
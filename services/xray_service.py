@@ -5,6 +5,8 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import uuid
 from typing import Tuple, Optional
 
@@ -23,24 +25,80 @@ XRAY_BIN = os.getenv("XRAY_BIN", "/usr/local/bin/xray")
 XRAY_API_ADDR = os.getenv("XRAY_API_ADDR", "127.0.0.1:10085")
 INBOUND_TAG = os.getenv("XRAY_INBOUND_TAG", "vless-ws")  # باید در config به inbound 8081 داده شده باشد (tag)
 
+# سقف زمان هر فراخوانی پروسهٔ خارجی (xray / systemctl)؛ Xray هنگ‌کرده ترد را قفل نکند
+XRAY_CMD_TIMEOUT = float(os.getenv("XRAY_CMD_TIMEOUT", "10"))
+
+# خواندن-تغییر-نوشتن فایل کانفیگ از چند ترد نباید هم‌پوشانی داشته باشد
+_CFG_LOCK = threading.RLock()
+
+# ایمیل‌هایی که تازه اضافه شده‌اند ولی ممکن است هنوز اشتراکشان در DB ثبت نشده باشد؛
+# compaction این‌ها را نگه می‌دارد
+RECENT_ADD_GRACE_SEC = 600
+_recent_adds: dict[str, float] = {}
+
 
 # ---------- File IO helpers ----------
 def _test_config(path: str) -> None:
     """xray -test -config <path>؛ خطا بده اگر نامعتبر بود."""
     p = subprocess.run(
         [XRAY_BIN, "-test", "-config", path],
-        capture_output=True, text=True
+        capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT
     )
     if p.returncode != 0:
         msg = (p.stderr or p.stdout or "").strip()
         raise RuntimeError(f"xray -test failed: {msg}")
 
 
-def _apply_config_safely(new_cfg: dict) -> None:
+def _structure_of(cfg: dict) -> dict:
+    """نمای کانفیگ بدون لیست clients؛ برای تشخیص تغییر ساختاری."""
+    def strip(ib: dict) -> dict:
+        ib = dict(ib)
+        st = dict(ib.get("settings") or {})
+        st.pop("clients", None)
+        ib["settings"] = st
+        return ib
+    return {**cfg, "inbounds": [strip(ib) for ib in cfg.get("inbounds", [])]}
+
+
+def _validate_clients(cfg: dict) -> None:
+    """
+    اعتبارسنجی درون‌پردازه‌ای برای تغییرهایی که فقط لیست clients را عوض کرده‌اند:
+    inbound موجود باشد، id معتبر باشد، id در هر inbound تکراری نباشد (یک UUID می‌تواند روی
+    چند inbound باشد) و email در کل کانفیگ تکراری نباشد (آمار Xray به ازای email است).
+    """
+    if not _find_vless_ws_inbound(cfg):
+        raise RuntimeError("config validation failed: VLESS/WS inbound not found")
+
+    seen_emails: set[str] = set()
+    for ib in cfg.get("inbounds", []):
+        seen_ids: set[str] = set()
+        for c in (ib.get("settings") or {}).get("clients") or []:
+            cid = str(c.get("id") or "")
+            try:
+                uuid.UUID(cid)
+            except ValueError:
+                # Xray رشته‌های ۱ تا ۳۰ کاراکتری را هم به UUIDv5 نگاشت می‌کند
+                if not (1 <= len(cid) <= 30):
+                    raise RuntimeError(f"config validation failed: invalid client id {cid!r}")
+            if cid in seen_ids:
+                raise RuntimeError(
+                    f"config validation failed: duplicate client id {cid} in inbound {ib.get('tag') or '?'}")
+            seen_ids.add(cid)
+
+            em = c.get("email")
+            if em:
+                if em in seen_emails:
+                    raise RuntimeError(f"config validation failed: duplicate email {em}")
+                seen_emails.add(em)
+
+
+def _apply_config_safely(new_cfg: dict, structural: bool = True) -> None:
     """
     کانفیگ جدید را در فایل موقت می‌نویسد، تست می‌کند،
     اگر OK بود اتمیک جایگزین می‌کند و سپس reload می‌زند.
     اگر هر مرحله‌ای خطا داشت، کانفیگ قبلی برمی‌گردد.
+    structural=False یعنی فقط clients عوض شده؛ به‌جای xray -test (اجرای پروسه + پارس کامل)
+    اعتبارسنجی درون‌پردازه‌ای انجام می‌شود.
     """
     cfg_dir = os.path.dirname(XRAY_CONFIG_PATH) or "."
     backup = XRAY_CONFIG_PATH + ".bak"
@@ -53,7 +111,10 @@ def _apply_config_safely(new_cfg: dict) -> None:
             json.dump(new_cfg, f, ensure_ascii=False, indent=2)
 
         # 2) تست
-        _test_config(tmp)
+        if structural:
+            _test_config(tmp)
+        else:
+            _validate_clients(new_cfg)
 
         # 3) بکاپ و جایگزینی اتمیک
         if os.path.exists(XRAY_CONFIG_PATH):
@@ -63,13 +124,8 @@ def _apply_config_safely(new_cfg: dict) -> None:
                 pass
         os.replace(tmp, XRAY_CONFIG_PATH)
 
-        # 4) ری‌لود (HUP)؛ اگر نشد، ری‌استارت
-        try:
-            subprocess.run(["sudo", "systemctl", "reload", XRAY_SERVICE_NAME],
-                           check=True, capture_output=True, text=True)
-        except subprocess.CalledProcessError:
-            subprocess.run(["sudo", "systemctl", "restart", XRAY_SERVICE_NAME],
-                           check=True, capture_output=True, text=True)
+        # 4) ری‌لود (HUP)؛ اگر نشد یا هنگ کرد، ری‌استارت
+        _reload_xray()
 
     except Exception as e:
         # اگر هرکدام شکست خورد و فایل موقت هست پاک کن
@@ -125,33 +181,41 @@ def _save_config(cfg: dict):
 
 
 # ---------- systemd helpers ----------
+def _proc_error(e: subprocess.SubprocessError) -> str:
+    if isinstance(e, subprocess.TimeoutExpired):
+        return f"timed out after {e.timeout}s"
+    out = e.stderr or e.stdout or ""
+    if isinstance(out, bytes):
+        out = out.decode("utf-8", "replace")
+    return out.strip() or str(e)
+
+
 def _restart_xray():
     try:
         subprocess.run(
             ["sudo", "systemctl", "restart", XRAY_SERVICE_NAME],
-            check=True, capture_output=True, text=True,
+            check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT,
         )
-    except subprocess.CalledProcessError as e:
-        msg = e.stderr.strip() or e.stdout.strip() or str(e)
-        raise RuntimeError(f"Failed to restart {XRAY_SERVICE_NAME}: {msg}")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise RuntimeError(f"Failed to restart {XRAY_SERVICE_NAME}: {_proc_error(e)}")
 
 
 def _reload_xray():
-    """ترجیح با reload برای حداقل قطعی؛ اگر نبود → restart."""
+    """ترجیح با reload برای حداقل قطعی؛ اگر نشد یا در XRAY_CMD_TIMEOUT تمام نشد → restart."""
     try:
         subprocess.run(
             ["sudo", "systemctl", "reload", XRAY_SERVICE_NAME],
-            check=True, capture_output=True, text=True,
+            check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT,
         )
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         try:
             subprocess.run(
                 ["sudo", "systemctl", "restart", XRAY_SERVICE_NAME],
-                check=True, capture_output=True, text=True,
+                check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT,
             )
-        except subprocess.CalledProcessError as e2:
-            msg1 = e.stderr.strip() or e.stdout.strip() or str(e)
-            msg2 = e2.stderr.strip() or e2.stdout.strip() or str(e2)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e2:
+            msg1 = _proc_error(e)
+            msg2 = _proc_error(e2)
             raise RuntimeError(
                 f"Failed to reload {XRAY_SERVICE_NAME}: {msg1}; restart fallback failed: {msg2}"
             )
@@ -209,7 +273,7 @@ def _build_vless_ws_link(uuid_str: str, email: str) -> str:
 def _xray_api(args: list[str]) -> subprocess.CompletedProcess:
     return subprocess.run(
         [XRAY_BIN, "api", *args],
-        check=True, capture_output=True, text=True
+        check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT
     )
 
 
@@ -242,27 +306,30 @@ def _remove_user_runtime(email: str) -> bool:
 
 # ---------- Public API ----------
 def add_client(email: str) -> Tuple[str, str]:
-    cfg = _load_config()
-    _ensure_vless_ws_inbound(cfg)
+    with _CFG_LOCK:
+        cfg = _load_config()
+        before = _structure_of(cfg)
+        _ensure_vless_ws_inbound(cfg)
 
-    ib = _find_vless_ws_inbound(cfg)
-    if not ib:
-        raise RuntimeError("VLESS/WS inbound not found or failed to create.")
+        ib = _find_vless_ws_inbound(cfg)
+        if not ib:
+            raise RuntimeError("VLESS/WS inbound not found or failed to create.")
 
-    clients = ib.setdefault("settings", {}).setdefault("clients", [])
+        clients = ib.setdefault("settings", {}).setdefault("clients", [])
 
-    # اگر ایمیل وجود دارد، کانفیگ را دست نمی‌زنیم (بدون ری‌لود)
-    for c in clients:
-        if c.get("email") == email:
-            link = _build_vless_ws_link(c["id"], email)
-            return c["id"], link
+        # اگر ایمیل وجود دارد، کانفیگ را دست نمی‌زنیم (بدون ری‌لود)
+        for c in clients:
+            if c.get("email") == email:
+                link = _build_vless_ws_link(c["id"], email)
+                return c["id"], link
 
-    # افزودن کلاینت جدید
-    uid = str(uuid.uuid4())
-    clients.append({"id": uid, "email": email})
+        # افزودن کلاینت جدید
+        uid = str(uuid.uuid4())
+        clients.append({"id": uid, "email": email})
 
-    # به‌صورت امن اعمال کن (تست + رول‌بک)
-    _apply_config_safely(cfg)
+        # به‌صورت امن اعمال کن (تست + رول‌بک)؛ xray -test فقط اگر inbound تازه ساخته شده
+        _apply_config_safely(cfg, structural=_structure_of(cfg) != before)
+        _recent_adds[email] = time.time()
 
     return uid, _build_vless_ws_link(uid, email)
 
@@ -276,19 +343,111 @@ def remove_client(email: str) -> bool:
     if _remove_user_runtime(email):
         return True
 
-    cfg = _load_config()
-    ib = _find_vless_ws_inbound(cfg)
-    if not ib:
-        return False
+    with _CFG_LOCK:
+        cfg = _load_config()
+        ib = _find_vless_ws_inbound(cfg)
+        if not ib:
+            return False
+
+        clients = ib.setdefault("settings", {}).setdefault("clients", [])
+        before = len(clients)
+        clients[:] = [c for c in clients if c.get("email") != email]
+        changed = len(clients) != before
+        if changed:
+            _save_config(cfg)
+            _reload_xray()
+    return changed
 
-    clients = ib.setdefault("settings", {}).setdefault("clients", [])
-    before = len(clients)
-    clients[:] = [c for c in clients if c.get("email") != email]
-    changed = len(clients) != before
-    if changed:
-        _save_config(cfg)
+
+def enable_clients(accounts: list[tuple[str, str]]) -> bool:
+    """
+    فعال‌سازی دوبارهٔ حساب‌های موجود با همان UUID (لینک کاربر عوض نمی‌شود)، یکجا:
+    1) addUser روی Runtime API برای هر حساب (بی‌قطعی؛ «already exists» یعنی از قبل فعال است)
+    2) کلاینت‌هایی که در فایل نیستند (مثلاً compaction حذفشان کرده) با یک نوشتن اضافه می‌شوند
+       تا بعد از ری‌استارت بمانند؛ reload فقط وقتی Runtime API برای حسابی جواب نداد.
+    خروجی: آیا reload لازم شد.
+    """
+    runtime_failed = False
+    for email, uuid_str in accounts:
+        try:
+            _add_user_runtime(email, uuid_str)
+        except subprocess.CalledProcessError as e:
+            if "exist" not in ((e.stderr or "") + (e.stdout or "")).lower():
+                runtime_failed = True
+        except subprocess.TimeoutExpired:
+            runtime_failed = True
+
+    with _CFG_LOCK:
+        cfg = _load_config()
+        ib = _find_vless_ws_inbound(cfg)
+        if not ib:
+            raise RuntimeError("VLESS/WS inbound not found.")
+        clients = ib.setdefault("settings", {}).setdefault("clients", [])
+        in_file = {c.get("email") for c in clients}
+        missing = [(e, u) for e, u in accounts if e not in in_file]
+
+        if missing:
+            now = time.time()
+            for email, uuid_str in missing:
+                clients.append({"id": uuid_str, "email": email})
+                _recent_adds[email] = now
+            if not runtime_failed:
+                _validate_clients(cfg)
+                _save_config(cfg)
+                return False
+            _apply_config_safely(cfg, structural=False)
+            return True
+
+    if runtime_failed:
         _reload_xray()
-    return changed
+        return True
+    return False
+
+
+# ---------- Compaction ----------
+def list_client_emails() -> set[str]:
+    """ایمیل همه کلاینت‌های فایل کانفیگ."""
+    ib = _find_vless_ws_inbound(_load_config()) or {}
+    return {c.get("email") for c in ib.get("settings", {}).get("clients", []) if c.get("email")}
+
+
+def compact_clients(keep_emails: set[str]) -> dict:
+    """
+    remove_client در حالت عادی فقط از runtime حذف می‌کند و فایل را دست نمی‌زند؛
+    این تابع فایل را فقط با کلاینت‌های keep_emails بازنویسی می‌کند (یک نوشتن تست‌شده + reload).
+    کلاینت‌های غیر @bot (دستی) و تازه اضافه‌شده‌ها حذف نمی‌شوند.
+    خروجی: اندازهٔ فایل و تعداد کلاینت قبل/بعد.
+    """
+    with _CFG_LOCK:
+        size_before = os.path.getsize(XRAY_CONFIG_PATH)
+        cfg = _load_config()
+        ib = _find_vless_ws_inbound(cfg)
+        if not ib:
+            raise RuntimeError("VLESS/WS inbound not found.")
+
+        clients = ib.setdefault("settings", {}).setdefault("clients", [])
+        now = time.time()
+        for em in [em for em, t in _recent_adds.items() if now - t >= RECENT_ADD_GRACE_SEC]:
+            del _recent_adds[em]
+
+        def _keep(c: dict) -> bool:
+            em = str(c.get("email") or "")
+            return em in keep_emails or em in _recent_adds or not em.endswith("@bot")
+
+        kept = [c for c in clients if _keep(c)]
+        report = {
+            "clients_before": len(clients),
+            "clients_after": len(kept),
+            "size_before": size_before,
+            "size_after": size_before,
+        }
+        if len(kept) == len(clients):
+            return report
+
+        clients[:] = kept
+        _apply_config_safely(cfg, structural=False)
+        report["size_after"] = os.path.getsize(XRAY_CONFIG_PATH)
+        return report
 
 
 # ---------- Stats (traffic per user) ----------
@@ -297,17 +456,47 @@ def _xray_api_stats_query(name: str) -> int:
     xray api stats query --server=127.0.0.1:10085 --name 'user>>>EMAIL>>>traffic>>>uplink'
     خروجی برخی بیلدها «value: N» است؛ تبدیل به int می‌کنیم.
     """
+    cmd = [XRAY_BIN, "api", "stats", "query", f"--server={XRAY_API_ADDR}", "--name", name]
     try:
-        cmd = [XRAY_BIN, "api", "stats", "query", f"--server={XRAY_API_ADDR}", "--name", name]
-        p = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        p = subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT)
         out = (p.stdout or "").strip()
         if out.startswith("value:"):
             out = out.split(":", 1)[1].strip()
         return int(out or "0")
+    except subprocess.TimeoutExpired:
+        # هنگ Xray را بالا بده تا circuit breaker ببیند؛ با «۰ مصرف» اشتباه گرفته نشود
+        raise
     except Exception:
         return 0
 
 
+def query_all_user_traffic() -> dict[str, int]:
+    """
+    آمار همه کاربران با یک فراخوانی:
+    xray api statsquery --server=... -pattern 'user>>>'
+    خروجی: email → بایت کل (uplink+downlink). در صورت خطا exception می‌دهد.
+    """
+    return query_user_traffic("user>>>")
+
+
+def query_user_traffic(pattern: str) -> dict[str, int]:
+    """
+    مثل query_all_user_traffic ولی فقط آمارهایی که نامشان شامل pattern است
+    (Xray زیررشته مقایسه می‌کند؛ مثلاً 'user>>>abc-' یعنی ایمیل‌هایی که با abc- شروع می‌شوند).
+    """
+    cmd = [XRAY_BIN, "api", "statsquery", f"--server={XRAY_API_ADDR}", "-pattern", pattern]
+    p = subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=XRAY_CMD_TIMEOUT)
+    data = json.loads(p.stdout or "{}")
+    totals: dict[str, int] = {}
+    for st in data.get("stat") or []:
+        # name: user>>>EMAIL>>>traffic>>>uplink|downlink ؛ value ممکن است رشته باشد یا نباشد (=0)
+        parts = str(st.get("name") or "").split(">>>")
+        if len(parts) != 4 or parts[0] != "user":
+            continue
+        totals[parts[1]] = totals.get(parts[1], 0) + int(st.get("value") or 0)
+    return totals
+
+
 def get_user_traffic_bytes(email: str) -> tuple[int, int, int]:
     """بایت‌های (uplink, downlink, total) برای یک ایمیل کاربر."""
     up = _xray_api_stats_query(f"user>>>{email}>>>traffic>>>uplink")